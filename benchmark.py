@@ -0,0 +1,593 @@
+#!/usr/bin/env python3
+"""Benchmarks of markdown-diary's hot paths.
+
+A synthetic diary is generated (see diary_generator.py) and the time and
+peak memory of parsing, loading, searching, modifying notes and rendering
+them to HTML are measured. The results are written as JSON, so they can be
+compared across commits. Qt is only needed by the HTML rendering benchmark
+and runs headless.
+
+Usage:
+    python3 benchmark.py --notes 10000 --output new.json
+    python3 benchmark.py --notes 10000 --compare old.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import uuid
+import shutil
+import argparse
+import platform
+import datetime
+import tempfile
+import itertools
+import statistics
+import subprocess
+import tracemalloc
+import collections
+
+# Must be set before Qt is first imported
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import diary  # noqa: E402
+import diary_generator  # noqa: E402
+import markdown_math  # noqa: E402
+import segmented_diary  # noqa: E402
+from search_index import WordIndex, TrigramIndex  # noqa: E402
+
+
+class BenchmarkContext():
+    """Shared state of a benchmark run.
+
+    Holds the generated diary and everything the individual benchmarks need
+    to set themselves up.
+    """
+
+    def __init__(self, workDir, notes, noteSize, codeFraction, mathFraction,
+                 seed):
+        """Generate the diary to be benchmarked.
+
+        Args:
+            workDir (str): Directory for the diary and its working copies.
+            notes (int): Number of notes.
+            noteSize (int): Approximate length of each note in characters.
+            codeFraction (float): Fraction of notes containing a code block.
+            mathFraction (float): Fraction of notes containing math.
+            seed (int): Seed of the random number generator.
+        """
+        self.workDir = workDir
+        self.fname = os.path.join(workDir, "diary.md")
+        self.noteIds = diary_generator.generateDiary(
+            self.fname, notes, noteSize, codeFraction, mathFraction, seed)
+        self.copies = 0
+        self.qApp = None
+        self.diaryApp = None
+
+    def workCopy(self):
+        """Get a path to a fresh copy of the diary, safe to be modified."""
+        self.copies += 1
+        fname = os.path.join(self.workDir, "copy{}.md".format(self.copies))
+        shutil.copyfile(self.fname, fname)
+        return fname
+
+    def compressedCopy(self, extension):
+        """Get a path to a fresh compressed copy of the diary.
+
+        Args:
+            extension (str): Extension of the compression, see
+                diary.COMPRESSIONS.
+
+        Returns:
+            str: Path to the copy.
+
+        """
+        self.copies += 1
+        fname = os.path.join(self.workDir, "copy{}.md{}".format(
+            self.copies, extension))
+        with open(self.fname, "rb") as f:
+            compressed = diary.COMPRESSIONS[extension].compress(f.read())
+        with open(fname, "wb") as f:
+            f.write(compressed)
+        return fname
+
+    def getDiaryApp(self):
+        """Get a DiaryApp instance, isolated from the user's settings."""
+        if self.diaryApp is None:
+            # Imported here, so the other benchmarks don't depend on Qt
+            from PyQt5 import QtCore, QtWidgets
+            import markdown_diary
+
+            for settingsFormat in (QtCore.QSettings.NativeFormat,
+                                   QtCore.QSettings.IniFormat):
+                QtCore.QSettings.setPath(settingsFormat,
+                                         QtCore.QSettings.UserScope,
+                                         self.workDir)
+
+            self.qApp = (QtWidgets.QApplication.instance() or
+                         QtWidgets.QApplication(sys.argv))
+            self.diaryApp = markdown_diary.DiaryApp()
+
+        return self.diaryApp
+
+
+def benchExtractData(context):
+    """Parse all notes of a diary already read into memory."""
+    with open(context.fname, "rb") as f:
+        rawData = str(f.read(), encoding="UTF-8")
+    return lambda: diary.Diary.extractData(rawData)
+
+
+def benchStreamNotes(context):
+    """Parse all notes of a diary file, reading it in chunks."""
+    return lambda: sum(1 for _ in diary.Diary.streamNotes(context.fname))
+
+
+def benchLoad(context):
+    """Load a diary from disk."""
+    return lambda: diary.Diary(context.fname)
+
+
+def benchLoadLazy(context):
+    """Load a diary from disk in lazy mode."""
+    return lambda: diary.Diary(context.fname, lazy=True)
+
+
+def benchLoadGzip(context):
+    """Load a gzip compressed diary from disk."""
+    fname = context.compressedCopy(".gz")
+    return lambda: diary.Diary(fname)
+
+
+def benchLoadXz(context):
+    """Load an xz compressed diary from disk."""
+    fname = context.compressedCopy(".xz")
+    return lambda: diary.Diary(fname)
+
+
+def benchLoadCached(context):
+    """Load a diary using an up to date sidecar index."""
+    fname = context.workCopy()
+    diary.Diary(fname, cacheIndex=True)
+    return lambda: diary.Diary(fname, cacheIndex=True)
+
+
+def searchPatterns(context):
+    """Get patterns matching a single note, all notes and no note."""
+    return ["Note {} ".format(len(context.noteIds) // 2), "ipsum", "xyzzy"]
+
+
+def benchSearchNotes(context):
+    """Search for several patterns without any search index."""
+    searchedDiary = diary.Diary(context.fname)
+    patterns = searchPatterns(context)
+    return lambda: [searchedDiary.searchNotes(pattern)
+                    for pattern in patterns]
+
+
+def benchSearchNotesIndexed(context):
+    """Search for several patterns using the word and trigram indexes."""
+    searchedDiary = diary.Diary(context.fname, wordIndex=True,
+                                trigramIndex=True)
+    patterns = searchPatterns(context)
+    return lambda: [searchedDiary.searchNotes(pattern)
+                    for pattern in patterns]
+
+
+def benchNotesBetween(context):
+    """Get the notes of a month and of a year using the date index."""
+    queriedDiary = diary.Diary(context.fname)
+    queriedDiary.notesBetween()
+    return lambda: (queriedDiary.notesBetween("2005-06", "2005-06"),
+                    queriedDiary.notesBetween("2005", "2005"))
+
+
+def benchBuildSearchIndexes(context):
+    """Build the word and trigram indexes of a loaded diary."""
+    indexedDiary = diary.Diary(context.fname)
+    return lambda: (WordIndex(indexedDiary.iterNoteTexts()),
+                    TrigramIndex(indexedDiary.iterNoteTexts()))
+
+
+def benchUpdateNote(context):
+    """Update a note in the middle of a diary."""
+    updatedDiary = diary.Diary(context.workCopy())
+    noteId = context.noteIds[len(context.noteIds) // 2]
+    noteDate = updatedDiary.getNoteMetadata(noteId)["date"]
+    texts = [updatedDiary.getNote(noteId) + suffix for suffix in ("", "\n")]
+    updates = iter(range(sys.maxsize))
+    return lambda: updatedDiary.updateNote(
+        texts[next(updates) % 2], noteId, noteDate)
+
+
+def benchUpdateNoteSegmented(context):
+    """Update a note in the middle of a diary split into monthly segments."""
+    fname = context.workCopy()
+    manifestName = os.path.splitext(fname)[0] + ".json"
+    segmented_diary.splitDiary(fname, manifestName, "month")
+    updatedDiary = segmented_diary.SegmentedDiary(manifestName)
+    noteId = context.noteIds[len(context.noteIds) // 2]
+    noteDate = updatedDiary.getNoteMetadata(noteId)["date"]
+    texts = [updatedDiary.getNote(noteId) + suffix for suffix in ("", "\n")]
+    updates = iter(range(sys.maxsize))
+    return lambda: updatedDiary.updateNote(
+        texts[next(updates) % 2], noteId, noteDate)
+
+
+def benchDeleteNote(context):
+    """Delete notes from the middle of a diary, one per run."""
+    updatedDiary = diary.Diary(context.workCopy())
+    middle = len(context.noteIds) // 2
+    noteIds = iter(context.noteIds[middle:] + context.noteIds[:middle])
+    return lambda: updatedDiary.deleteNote(next(noteIds))
+
+
+def appendNote(context, durability):
+    """Set up appending a new note to a diary.
+
+    Args:
+        context (BenchmarkContext): State shared by the benchmarks.
+        durability (str): Durability of the saves, one of
+            diary.DURABILITIES.
+
+    Returns:
+        The function to be measured.
+
+    """
+    updatedDiary = diary.Diary(context.workCopy(), durability=durability)
+    note = diary_generator.generateNote(
+        random.Random(0), len(context.noteIds))
+    noteDate = datetime.date.today().isoformat()
+    return lambda: updatedDiary.saveNote(note, str(uuid.uuid1()), noteDate)
+
+
+def benchSaveNote(context):
+    """Append a new note to a diary, syncing the files and directory."""
+    return appendNote(context, diary.DURABILITY_DIRECTORY)
+
+
+def benchSaveNoteSyncFile(context):
+    """Append a new note to a diary, syncing the files and the journal."""
+    return appendNote(context, diary.DURABILITY_FILE)
+
+
+def benchSaveNoteNoSync(context):
+    """Append a new note to a diary by replacing it, syncing nothing."""
+    return appendNote(context, diary.DURABILITY_NONE)
+
+
+def benchSaveNoteGzip(context):
+    """Append a new note to a gzip compressed diary.
+
+    The diary is compressed in the background, each run only waits for the
+    previous run's write.
+    """
+    updatedDiary = diary.Diary(context.compressedCopy(".gz"))
+    note = diary_generator.generateNote(
+        random.Random(0), len(context.noteIds))
+    noteDate = datetime.date.today().isoformat()
+    return lambda: updatedDiary.saveNote(note, str(uuid.uuid1()), noteDate)
+
+
+def redateNotes(context, batch):
+    """Set up changing the dates of 100 notes spread over a diary.
+
+    Args:
+        context (BenchmarkContext): State shared by the benchmarks.
+        batch (bool): Make all the changes in a single Diary.batch().
+
+    Returns:
+        The function to be measured.
+
+    """
+    updatedDiary = diary.Diary(context.workCopy())
+    noteIds = context.noteIds[::max(len(context.noteIds) // 100, 1)]
+    dates = ("2000-01-01", "2000-01-02")
+    runs = iter(range(sys.maxsize))
+
+    def redate():
+        noteDate = dates[next(runs) % 2]
+        for noteId in noteIds:
+            updatedDiary.changeNoteDate(noteId, noteDate)
+
+    def redateInBatch():
+        with updatedDiary.batch():
+            redate()
+
+    return redateInBatch if batch else redate
+
+
+def benchChangeNoteDates(context):
+    """Change the dates of 100 notes, saving the diary after each one."""
+    return redateNotes(context, False)
+
+
+def benchChangeNoteDatesBatch(context):
+    """Change the dates of 100 notes in a batch, saving the diary once."""
+    return redateNotes(context, True)
+
+
+def renderedNotes():
+    """Get a plain note, a note with code and a note with math."""
+    rng = random.Random(0)
+    return [diary_generator.generateNote(rng, 0, 2000, 0, 0),
+            diary_generator.generateNote(rng, 1, 2000, 1, 0),
+            diary_generator.generateNote(rng, 2, 2000, 0, 1)]
+
+
+def createHTMLAfresh(diaryApp, note):
+    """Render a note without reusing any of its rendered blocks."""
+    diaryApp.toMarkdown.clearCache()
+    return markdown_math.createHTML(
+        note, diaryApp.toMarkdown, diaryApp.mathjax)
+
+
+def benchCreateHTML(context):
+    """Render a plain note, a note with code and a note with math."""
+    diaryApp = context.getDiaryApp()
+    notes = renderedNotes()
+    return lambda: [createHTMLAfresh(diaryApp, note) for note in notes]
+
+
+def benchCreateHTMLCached(context):
+    """Display the three rendered notes again, as when switching notes."""
+    diaryApp = context.getDiaryApp()
+    notes = renderedNotes()
+    for note in notes:
+        diaryApp.createHTML(note)
+    return lambda: [diaryApp.createHTML(note) for note in notes]
+
+
+def codeNote():
+    """Get a note with 30 code blocks in several languages."""
+    parts = ["# Code\n\n"]
+    for number in range(30):
+        language, code = diary_generator.CODE_BLOCKS[
+            number % len(diary_generator.CODE_BLOCKS)]
+        parts.append("Block {}:\n\n```{}\n{}```\n\n".format(
+            number, language, code * 3))
+    return "".join(parts)
+
+
+def benchCreateHTMLCode(context):
+    """Render a note with 30 code blocks, highlighting each one again."""
+    diaryApp = context.getDiaryApp()
+    note = codeNote()
+
+    def createHTML():
+        markdown_math.HighlightRenderer.highlightCache.clear()
+        return createHTMLAfresh(diaryApp, note)
+    return createHTML
+
+
+def benchCreateHTMLCodeMemoized(context):
+    """Render a note with 30 code blocks highlighted before."""
+    diaryApp = context.getDiaryApp()
+    note = codeNote()
+    createHTMLAfresh(diaryApp, note)
+    return lambda: createHTMLAfresh(diaryApp, note)
+
+
+def editedNotes(diaryApp, edit):
+    """Render a 50 page note, then edit and render it again repeatedly.
+
+    Args:
+        diaryApp (DiaryApp): The app rendering the note.
+        edit (function): Returns the note edited for the given time.
+
+    Returns:
+        function: Edits and renders the note once.
+
+    """
+    rng = random.Random(0)
+    note = "".join(diary_generator.generateNote(rng, number, 3000, 0.3, 0.3)
+                   for number in range(50))
+    createHTMLAfresh(diaryApp, note)
+    edits = itertools.count()
+    return lambda: markdown_math.createHTML(
+        edit(note, next(edits)), diaryApp.toMarkdown, diaryApp.mathjax)
+
+
+def benchCreateHTMLEdited(context):
+    """Render a 50 page note after editing a paragraph in its middle."""
+    def edit(note, number):
+        middle = note.index("\n\n", len(note) // 2)
+        return "{} Edit {}.{}".format(note[:middle], number, note[middle:])
+    return editedNotes(context.getDiaryApp(), edit)
+
+
+def benchCreateHTMLAppended(context):
+    """Render a 50 page note after adding a paragraph at its end."""
+    def edit(note, number):
+        return "{}\nParagraph {}.\n".format(note, number)
+    return editedNotes(context.getDiaryApp(), edit)
+
+
+BENCHMARKS = collections.OrderedDict([
+    ("extractData", benchExtractData),
+    ("streamNotes", benchStreamNotes),
+    ("load", benchLoad),
+    ("loadLazy", benchLoadLazy),
+    ("loadGzip", benchLoadGzip),
+    ("loadXz", benchLoadXz),
+    ("loadCached", benchLoadCached),
+    ("searchNotes", benchSearchNotes),
+    ("searchNotesIndexed", benchSearchNotesIndexed),
+    ("notesBetween", benchNotesBetween),
+    ("buildSearchIndexes", benchBuildSearchIndexes),
+    ("updateNote", benchUpdateNote),
+    ("updateNoteSegmented", benchUpdateNoteSegmented),
+    ("deleteNote", benchDeleteNote),
+    ("saveNote", benchSaveNote),
+    ("saveNoteSyncFile", benchSaveNoteSyncFile),
+    ("saveNoteNoSync", benchSaveNoteNoSync),
+    ("saveNoteGzip", benchSaveNoteGzip),
+    ("changeNoteDates", benchChangeNoteDates),
+    ("changeNoteDatesBatch", benchChangeNoteDatesBatch),
+    ("createHTML", benchCreateHTML),
+    ("createHTMLCode", benchCreateHTMLCode),
+    ("createHTMLCodeMemoized", benchCreateHTMLCodeMemoized),
+    ("createHTMLEdited", benchCreateHTMLEdited),
+    ("createHTMLAppended", benchCreateHTMLAppended),
+    ("createHTMLCached", benchCreateHTMLCached),
+])
+
+
+def runBenchmark(setup, context, repeat):
+    """Measure the run time and peak memory of a benchmark.
+
+    The timed runs are done without tracing memory allocations, as that
+    slows Python down considerably; the memory is measured in an extra run.
+
+    Args:
+        setup (function): Takes the context and returns the function to be
+            measured.
+        context (BenchmarkContext): State shared by the benchmarks.
+        repeat (int): Number of timed runs.
+
+    Returns:
+        A dictionary with the run times (in seconds), their minimum and
+        median, the peak memory allocated by a run and the memory still
+        held by its result, e.g., a loaded diary (in bytes).
+
+    """
+    func = setup(context)
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        result = func()
+        retainedMemory, peakMemory = tracemalloc.get_traced_memory()
+        del result
+    finally:
+        tracemalloc.stop()
+
+    return {"times": times,
+            "min": min(times),
+            "median": statistics.median(times),
+            "peakMemory": peakMemory,
+            "retainedMemory": retainedMemory}
+
+
+def gitCommit():
+    """Get the commit the benchmarked code comes from, if known."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compareResults(old, new):
+    """Get a human-readable comparison of two benchmark results.
+
+    Args:
+        old (dict): Baseline results, as written by this module.
+        new (dict): Current results.
+
+    Returns:
+        A table of median times, peak memory and retained memory of both
+        results.
+
+    """
+    row = "{:<20}{:>10}{:>10}{:>7}{:>10}{:>10}{:>10}{:>10}"
+    lines = [row.format("benchmark", "old [s]", "new [s]", "ratio",
+                        "old peak", "new peak", "old kept", "new kept"),
+             row.format("", "", "", "", "[MB]", "[MB]", "[MB]", "[MB]")]
+    for name, result in new["benchmarks"].items():
+        if name not in old["benchmarks"]:
+            continue
+        oldResult = old["benchmarks"][name]
+        ratio = (result["median"] / oldResult["median"]
+                 if oldResult["median"] else float("inf"))
+        lines.append(row.format(
+            name, "{:.4f}".format(oldResult["median"]),
+            "{:.4f}".format(result["median"]), "{:.2f}".format(ratio),
+            *("{:.1f}".format(res.get(key, 0) / 1e6)
+              for key in ("peakMemory", "retainedMemory")
+              for res in (oldResult, result))))
+
+    return "\n".join(lines)
+
+
+def main():
+    """Run the benchmarks according to command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help="benchmarks to run, one of: {} (default: all)"
+                        .format(", ".join(BENCHMARKS)))
+    parser.add_argument("--notes", type=int, default=1000,
+                        help="number of notes (default: %(default)s)")
+    parser.add_argument("--note-size", type=int, default=1000,
+                        help="approximate note length in characters "
+                        "(default: %(default)s)")
+    parser.add_argument("--code", type=float, default=0.1,
+                        help="fraction of notes with a code block "
+                        "(default: %(default)s)")
+    parser.add_argument("--math", type=float, default=0.1,
+                        help="fraction of notes with math "
+                        "(default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of timed runs (default: %(default)s)")
+    parser.add_argument("--output", default="-",
+                        help="JSON results file (default: stdout)")
+    parser.add_argument("--compare", metavar="JSON",
+                        help="print a comparison with earlier results")
+    args = parser.parse_args()
+
+    names = args.benchmarks or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: {}".format(name))
+    if args.notes < args.repeat + 1:
+        parser.error("--notes must be greater than --repeat")
+
+    results = collections.OrderedDict()
+    with tempfile.TemporaryDirectory() as workDir:
+        context = BenchmarkContext(workDir, args.notes, args.note_size,
+                                   args.code, args.math, args.seed)
+        diaryBytes = os.path.getsize(context.fname)
+        for name in names:
+            print("Running {}...".format(name), file=sys.stderr)
+            results[name] = runBenchmark(BENCHMARKS[name], context,
+                                         args.repeat)
+
+    output = {
+        "commit": gitCommit(),
+        "date": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {"notes": args.notes,
+                       "noteSize": args.note_size,
+                       "code": args.code,
+                       "math": args.math,
+                       "seed": args.seed,
+                       "repeat": args.repeat,
+                       "diaryBytes": diaryBytes},
+        "benchmarks": results,
+    }
+
+    if args.output == "-":
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print(compareResults(json.load(f), output), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,1735 @@
 """Module containing markdown-diary's actual Diary class."""
+import io
 import os
 import re
+import sys
+import bz2
+import gzip
+import lzma
+import zlib
+import bisect
 import datetime
 import binascii
+import functools
 import tempfile
+import mmap
+import struct
+import contextlib
+import collections
+import collections.abc
+
+from search_index import WordIndex, TrigramIndex, DateIndex
+
+HEADER_PATTERN = r"""
+    ^<!---                         # Beggining of Markdown comment
+    (?:\n|\r\n)                    # Unix|Windows non-capturing \n
+    markdown-diary\ note\ metadata # Mandatory first line
+    (.*?)                          # Any characters including \n
+    --->                           # End of Markdown comment
+    """
+
+reHeader = re.compile(HEADER_PATTERN, re.MULTILINE | re.VERBOSE | re.DOTALL)
+reHeaderBytes = re.compile(HEADER_PATTERN.encode(),
+                           re.MULTILINE | re.VERBOSE | re.DOTALL)
+
+# A note found by Diary.scanNotes(). The offsets are the start of the note's
+# metadata header, the end of the header (the body with the date and title
+# lines follows it), the start of the note's text and the end of the note.
+HEADER_PREFIXES = ("<!---\nmarkdown-diary note metadata",
+                   "<!---\r\nmarkdown-diary note metadata")
+
+NoteRecord = collections.namedtuple(
+    "NoteRecord",
+    ["start", "metadata", "date", "title", "bodyStart", "textStart", "end"])
+
+# Sidecar index cache layout: a header with magic, format version, diary
+# size, mtime (ns), CRC32 and number of notes, then for each note its byte
+# offset, the byte offset of its body and the number of metadata items,
+# followed by the items as length-prefixed UTF-8 keys and values.
+INDEX_MAGIC = b"MDDIDX"
+INDEX_VERSION = 1
+indexHeader = struct.Struct("<6sHQQII")
+indexNote = struct.Struct("<QQH")
+indexString = struct.Struct("<I")
+
+# Codecs of compressed diaries, by the diary file's extension
+COMPRESSIONS = {".gz": gzip, ".xz": lzma, ".bz2": bz2}
+
+# Durability of saves, from the fastest to the safest: not syncing anything,
+# syncing the written files and syncing the directory entries as well
+DURABILITY_NONE = "none"
+DURABILITY_FILE = "file"
+DURABILITY_DIRECTORY = "directory"
+DURABILITIES = (DURABILITY_NONE, DURABILITY_FILE, DURABILITY_DIRECTORY)
+
+
+if hasattr(str, "isascii"):
+    # Doesn't make a copy of the string
+    isAsciiText = str.isascii
+else:
+    def isAsciiText(text):
+        """Check whether a string consists of ASCII characters only.
+
+        Same as str.isascii(), which is only available since Python 3.7.
+        """
+        try:
+            text.encode("ascii")
+        except UnicodeEncodeError:
+            return False
+        return True
+
+
+class Note(collections.abc.MutableMapping):
+    """Compact record of a note's metadata and text.
+
+    Behaves like the dictionary of the note's metadata and text it replaces,
+    so note["title"], dict(note), note == {...} etc. work as before. The keys
+    every note has are kept in slots instead of a per-note dictionary, dates
+    are interned, as many notes share them, and any other metadata is kept
+    in a dictionary only created when there is some.
+    """
+
+    __slots__ = ("note_id", "date", "title", "text", "extra")
+    fields = ("note_id", "date", "title", "text")
+
+    def __init__(self, data=()):
+        """Create a note record.
+
+        Args:
+            data (dict or iterable, optional): Initial metadata and text, as
+                a dictionary or (key, value) pairs.
+        """
+        self.extra = None
+        if data:
+            self.update(data)
+
+    @staticmethod
+    def fromParsed(metadata, date, title, text=None):
+        """Create a note record from the parts of a parsed note.
+
+        A faster equivalent of filling in a Note key by key.
+
+        Args:
+            metadata (dict): The note's header metadata. It becomes a part
+                of the record, so it must not be used afterwards.
+            date (str): The note's date.
+            title (str): The note's title.
+            text (str, optional): The note's text, if it is to be stored.
+
+        Returns:
+            The Note.
+
+        """
+        note = Note.__new__(Note)
+        noteId = metadata.pop("note_id", None)
+        if noteId is not None:
+            note.note_id = noteId
+        note.date = sys.intern(date)
+        note.title = title
+        if text is not None:
+            note.text = text
+        note.extra = metadata or None
+
+        return note
+
+    def __getitem__(self, key):
+        """Get a metadata item (or the text) of the note."""
+        if key in self.fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        elif self.extra is not None and key in self.extra:
+            return self.extra[key]
+
+        return self.__missing__(key)
+
+    def __missing__(self, key):
+        """Handle a key the note doesn't have, same as dict subclasses."""
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        """Set a metadata item (or the text) of the note."""
+        if key in self.fields:
+            if key == "date":
+                value = sys.intern(value)
+            setattr(self, key, value)
+        elif self.extra is None:
+            self.extra = {key: value}
+        else:
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        """Remove a metadata item (or the text) of the note."""
+        if key in self.fields:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self.extra is not None and key in self.extra:
+            del self.extra[key]
+            if not self.extra:
+                self.extra = None
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        """Check whether the note has a key, without calling __missing__."""
+        if key in self.fields:
+            return hasattr(self, key)
+        return self.extra is not None and key in self.extra
+
+    def __iter__(self):
+        """Iterate over the note's keys."""
+        for key in self.fields:
+            if hasattr(self, key):
+                yield key
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self):
+        """Get the number of the note's keys."""
+        count = sum(hasattr(self, key) for key in self.fields)
+        return count + (len(self.extra) if self.extra is not None else 0)
+
+    def __repr__(self):
+        """Show the note like a dictionary."""
+        return "{}({!r})".format(type(self).__name__, dict(self.items()))
+
+
+class LazyNote(Note):
+    """Note record which loads the note's text on demand.
+
+    Used by diaries opened in lazy mode. The "text" key is not stored in the
+    record, it is decoded from the diary file each time it is accessed.
+    """
+
+    __slots__ = ("diary",)
+
+    def __init__(self, diary, metadata):
+        """Store the diary the note comes from along with the metadata.
+
+        Args:
+            diary (Diary): The diary containing the note.
+            metadata (dict or Note): The note's metadata, without its text.
+        """
+        if isinstance(metadata, Note):
+            # Copy the slots directly, much faster than key by key
+            for key in ("note_id", "date", "title"):
+                if hasattr(metadata, key):
+                    setattr(self, key, getattr(metadata, key))
+            self.extra = metadata.extra
+        else:
+            super().__init__(metadata)
+        self.diary = diary
+
+    def __missing__(self, key):
+        """Get the note's text from the diary."""
+        if key == "text":
+            return self.diary.getNote(self["note_id"])
+        raise KeyError(key)
 
 
 class Diary():
     """Class handling all the diary and note manipulation.
 
-    The Diary is a data container and manipulation class. It can create and
-    delete notes and diaries.
-    """
+    The Diary is a data container and manipulation class. It can create and
+    delete notes and diaries.
+    """
+
+    # Number of decoded note texts kept around in lazy mode
+    lazyCacheSize = 32
+    # Size of the chunks in which diaries are checksummed
+    chunkSize = 1 << 20
+
+    def __init__(self, fname, lazy=False, cacheIndex=False, wordIndex=False,
+                 trigramIndex=False, durability=DURABILITY_DIRECTORY):
+        """Init method that reads in a diary from a file.
+
+        Args:
+            fname (str): Path to the diary to be loaded.
+            lazy (bool, optional): Memory-map the diary instead of reading
+                it in. Only the notes' metadata and offsets are kept in
+                memory, note texts are decoded when requested. In lazy mode
+                self.rawData is the mmap and all offsets are in bytes.
+                Compressed diaries (see COMPRESSIONS) and diaries with
+                Windows line endings (see decodeDiary()) can't be mapped,
+                they are always read in.
+            cacheIndex (bool, optional): Load the notes' metadata and
+                offsets from a sidecar index file, if it is up to date, and
+                write it when it isn't, see saveIndexCache().
+            wordIndex (bool, optional): Keep an inverted index of the words
+                in notes to speed up searching, see searchNotes() and
+                searchWords().
+            trigramIndex (bool, optional): Keep an inverted index of the
+                character trigrams in notes to speed up searching for
+                arbitrary substrings, see searchNotes().
+            durability (str, optional): What a save waits for, one of
+                DURABILITIES. With DURABILITY_NONE nothing is synced and
+                every save replaces the whole diary file, as partial writes
+                can't be rolled back without syncs. A power failure may
+                lose a save and, on file systems that don't order renames
+                after data (see replaceFile()), even the diary. With
+                DURABILITY_FILE the saved data is flushed to the disk, and
+                with DURABILITY_DIRECTORY the renames and deletions of the
+                diary's files are, too.
+        """
+        if durability not in DURABILITIES:
+            raise ValueError("Unknown durability " + str(durability))
+
+        self.fname = fname
+        self.durability = durability
+        self.compression = self.compressionOf(fname)
+        self.lazy = lazy and self.compression is None
+        # Whether rawData differs from the file in line endings
+        self.newlinesTranslated = False
+        self.textCache = collections.OrderedDict()
+        # Notes changed in the current batch(), None outside of batches
+        self.batchSegments = None
+        # Compressed diaries are written in the background, see flush()
+        self.writer = None
+        self.pendingWrite = None
+        # Offset, checksum and file fingerprint of the diary's head
+        # checksummed by the last partial save, see headChecksum()
+        self.lastHead = None
+
+        self.recoverJournal()
+
+        rawBytes = self.loadDiary()
+
+        # The cached offsets are those in the file, not in rawData
+        cachedIndex = None
+        if cacheIndex and not self.newlinesTranslated:
+            cachedIndex = self.loadIndexCache()
+        if cachedIndex is None:
+            # Only needed with the cached index, don't keep it while parsing
+            rawBytes = None
+            self.data, self.spans = self.parseNotes(self.rawData)
+        else:
+            self.data, self.spans = self.notesFromIndexCache(
+                cachedIndex, rawBytes)
+        self.wrapLazyNotes(self.data)
+        self.buildIndex()
+
+        self.wordIndex = None
+        self.trigramIndex = None
+        self.buildSearchIndexes(wordIndex, trigramIndex)
+        # Built on the first date range query, see notesBetween()
+        self.dateIndex = None
+
+        if cacheIndex and cachedIndex is None and not self.newlinesTranslated:
+            self.saveIndexCache()
+
+    @staticmethod
+    def compressionOf(fname):
+        """Get the codec of a compressed diary file.
+
+        Args:
+            fname (str): Path to the diary.
+
+        Returns:
+            The codec module (e.g., gzip), or None if the diary isn't
+            compressed.
+
+        """
+        return COMPRESSIONS.get(os.path.splitext(fname)[1].lower())
+
+    @staticmethod
+    def openDiaryFile(fname):
+        """Open a diary file for reading, decompressing it if needed.
+
+        Args:
+            fname (str): Path to the diary.
+
+        Returns:
+            A binary file object reading the diary's (decompressed)
+            contents.
+
+        """
+        compression = Diary.compressionOf(fname)
+        if compression is None or os.path.getsize(fname) == 0:
+            return open(fname, "rb")
+
+        return compression.open(fname, "rb")
+
+    def readDiary(self):
+        """Read the whole diary file, decompressing it if needed.
+
+        Compressed diaries are decompressed in chunks as they are read, so
+        the compressed file is never held in memory as a whole.
+
+        Returns:
+            The diary contents as bytes and the CRC32 checksum of the
+            compressed file (None for diaries that aren't compressed).
+
+        """
+        if self.compression is None:
+            with open(self.fname, "rb") as f:
+                return f.read(), None
+
+        checksums = [0]
+
+        def read(f):
+            for chunk in iter(lambda: f.read(self.chunkSize), b""):
+                checksums[0] = binascii.crc32(chunk, checksums[0])
+                yield chunk
+
+        with open(self.fname, "rb") as f:
+            rawBytes = b"".join(self.decompressChunks(read(f)))
+
+        return rawBytes, checksums[0]
+
+    def loadDiary(self):
+        """Read in (or map, in lazy mode) the diary file as self.rawData.
+
+        A lazy diary whose file has Windows line endings is read in
+        instead, and stays that way, see decodeDiary().
+
+        Returns:
+            The diary file contents as bytes, None in lazy mode.
+
+        """
+        if self.lazy:
+            self.mapDiary()
+            if self.rawData.find(b"\r") == -1:
+                self.newlinesTranslated = False
+                self.updateFingerprint()
+                return None
+
+            self.close()
+            self.lazy = False
+
+        rawBytes, checksum = self.readDiary()
+        self.rawData, self.newlinesTranslated = self.decodeDiary(rawBytes)
+        if self.newlinesTranslated and checksum is None:
+            # Can't be computed from self.rawData later
+            checksum = binascii.crc32(rawBytes)
+        self.updateFingerprint(checksum)
+        return rawBytes
+
+    @staticmethod
+    def decodeDiary(rawBytes):
+        """Decode the diary file contents, translating line endings.
+
+        Windows (and old Mac) line endings are translated to "\n", as in
+        files opened in text mode. The offsets in a translated diary don't
+        match the file, so it is rewritten as a whole (with Unix line
+        endings) on the next save, see writeDiary().
+
+        Args:
+            rawBytes (bytes): The diary file contents.
+
+        Returns:
+            The diary as a string and whether any line endings were
+            translated.
+
+        """
+        rawData = str(rawBytes, encoding="UTF-8")
+        if "\r" not in rawData:
+            return rawData, False
+
+        return rawData.replace("\r\n", "\n").replace("\r", "\n"), True
+
+    def decompressChunks(self, chunks):
+        """Decompress consecutive chunks of a compressed diary file.
+
+        Args:
+            chunks (iterable): Consecutive parts of the compressed file.
+
+        Yields:
+            Consecutive parts of the decompressed diary.
+
+        """
+        if self.compression is gzip:
+            # Like gzip.decompress(), but incremental
+            newDecompressor = functools.partial(zlib.decompressobj,
+                                                16 + zlib.MAX_WBITS)
+        elif self.compression is lzma:
+            newDecompressor = lzma.LZMADecompressor
+        else:
+            newDecompressor = bz2.BZ2Decompressor
+
+        decompressor = newDecompressor()
+        complete = True
+        for chunk in chunks:
+            while chunk:
+                complete = False
+                yield decompressor.decompress(chunk)
+                chunk = b""
+                # A file can consist of several compressed streams
+                if decompressor.eof:
+                    complete = True
+                    chunk = decompressor.unused_data
+                    decompressor = newDecompressor()
+
+        if not complete:
+            raise EOFError("Compressed diary " + self.fname +
+                           " ended before the end-of-stream marker")
+
+    def compress(self, data):
+        """Compress the whole diary for writing.
+
+        Args:
+            data (bytes): The diary contents.
+
+        Returns:
+            bytes: The compressed diary.
+
+        """
+        if self.compression is gzip:
+            # No timestamp, the same diary always compresses the same.
+            # gzip.compress() only takes mtime since Python 3.8
+            buffer = io.BytesIO()
+            with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=6,
+                               mtime=0) as f:
+                f.write(data)
+            return buffer.getvalue()
+
+        return self.compression.compress(data)
+
+    def flush(self):
+        """Wait until a compressed diary being written in the background is
+        written.
+
+        Returns:
+            bool: False if the background write failed, True otherwise.
+
+        """
+        if self.pendingWrite is None:
+            return True
+
+        pendingWrite = self.pendingWrite
+        self.pendingWrite = None
+        try:
+            pendingWrite.result()
+        except OSError as error:
+            print("ERROR: Couldn't save diary " + self.fname + ": " +
+                  str(error))
+            return False
+
+        return True
+
+    def writeCompressed(self, newBytes):
+        """Compress the whole diary and write it in the background.
+
+        The compression (which releases the GIL) and the write are done by
+        a separate thread, so saving doesn't block the caller. Any method
+        checking the diary file waits for the write to finish, see flush().
+
+        Args:
+            newBytes (bytes): The new diary contents.
+        """
+        def write():
+            compressed = self.compress(newBytes)
+            self.replaceFile(self.fname, compressed, self.durability)
+            self.updateFingerprint(binascii.crc32(compressed))
+
+        if self.writer is None:
+            import concurrent.futures
+            self.writer = concurrent.futures.ThreadPoolExecutor(1)
+        self.flush()
+        self.pendingWrite = self.writer.submit(write)
+
+    def mapDiary(self):
+        """Memory-map the diary file as self.rawData (lazy mode only)."""
+        self.close()
+        with open(self.fname, "rb") as f:
+            # Empty files can't be mapped
+            if os.fstat(f.fileno()).st_size == 0:
+                self.rawData = b""
+            else:
+                self.rawData = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        """Finish writing the diary and release the memory-mapped file."""
+        self.flush()
+        if isinstance(getattr(self, "rawData", None), mmap.mmap):
+            self.rawData.close()
+
+    def fileNames(self):
+        """Get the paths of all the files the diary consists of."""
+        return [self.fname]
+
+    def journalName(self):
+        """Get the path of the diary's rollback journal."""
+        return os.path.join(os.path.dirname(self.fname),
+                            "." + os.path.basename(self.fname) + ".journal")
+
+    def recoverJournal(self):
+        """Roll back an interrupted partial save, if there was one.
+
+        The journal starts with a line holding the offset from which the
+        diary was being rewritten, the original diary size, the CRC32 of
+        the original data after the offset, the new diary size and the
+        CRC32 of the data before the offset, followed by the original data
+        after the offset.
+
+        The diary is only rolled back if it is still in a state the save
+        could have left it in. If it was changed since (e.g., by a syncing
+        tool), the journal is moved aside to .<diary>.journal.stale.
+        """
+        journalName = self.journalName()
+        if not os.path.isfile(journalName):
+            return
+
+        with open(journalName, "rb") as journal:
+            header = journal.readline().split()
+            oldTail = journal.read()
+
+        try:
+            offset, size, checksum, newSize, headChecksum = (
+                int(val) for val in header)
+        except ValueError:
+            offset = size = checksum = newSize = headChecksum = None
+        if (offset is None or len(oldTail) != size - offset or
+                binascii.crc32(oldTail) != checksum):
+            print("ERROR: Corrupted diary journal " + journalName + "!")
+            return
+
+        # The save only ever made the diary grow or shrink to its new size
+        currentSize = os.path.getsize(self.fname)
+        if (not min(size, newSize) <= currentSize <= max(size, newSize) or
+                currentSize < offset or
+                self.headChecksum(offset) != headChecksum):
+            os.replace(journalName, journalName + ".stale")
+            print("ERROR: Diary " + self.fname + " changed after an "
+                  "interrupted save, not rolling it back! The journal was "
+                  "moved to " + journalName + ".stale")
+            return
+
+        with open(self.fname, "r+b") as f:
+            f.seek(offset)
+            f.write(oldTail)
+            f.truncate()
+            # The journal mustn't be gone before the diary is rolled back
+            self.syncFile(f, DURABILITY_FILE)
+        os.remove(journalName)
+        self.syncDirectory(journalName, self.durability)
+
+    def indexCacheName(self):
+        """Get the path of the diary's sidecar index cache."""
+        return os.path.join(os.path.dirname(self.fname),
+                            "." + os.path.basename(self.fname) + ".index")
+
+    def saveIndexCache(self):
+        """Write the notes' metadata and offsets to a sidecar index file.
+
+        The index is stored along with the diary file's size, modification
+        time and checksum, so a later Diary can tell whether it is still up
+        to date. The cache isn't updated on saves, so this should be called
+        after a batch of changes (e.g., when closing the diary).
+
+        Returns:
+            bool: True if the index was written, False if the diary file
+                doesn't correspond to the diary data (or its line endings
+                were translated, see decodeDiary()).
+
+        """
+        if (self.batchSegments is not None or self.newlinesTranslated or
+                self.isChangedOnDisk()):
+            return False
+
+        chunks = [indexHeader.pack(
+            INDEX_MAGIC, INDEX_VERSION, self.fingerprint[0],
+            self.fingerprint[1], self.contentChecksum(), len(self.data))]
+
+        for datum, (noteStart, bodyStart, _, byteStart) in zip(
+                self.data, self.spans):
+            if self.lazy:
+                byteBodyStart = bodyStart
+            else:
+                byteBodyStart = byteStart + self.encodedLength(
+                    self.rawData[noteStart:bodyStart])
+
+            items = [(key, val) for key, val in datum.items()
+                     if key != "text"]
+            chunks.append(indexNote.pack(
+                byteStart, byteBodyStart, len(items)))
+            for item in items:
+                for string in item:
+                    string = bytes(string, encoding="UTF-8")
+                    chunks.append(indexString.pack(len(string)))
+                    chunks.append(string)
+
+        # The index can always be rebuilt, no need to sync it
+        self.replaceFile(self.indexCacheName(), b"".join(chunks))
+
+        return True
+
+    def loadIndexCache(self):
+        """Read the sidecar index file if it describes the diary file.
+
+        The index is used if the diary's size and modification time match,
+        or if only the modification time differs, but the checksum of the
+        file matches.
+
+        Returns:
+            A list of (metadata Note, byte offset, body byte offset)
+            tuples, one for each note, or None if there is no usable index.
+
+        """
+        try:
+            with open(self.indexCacheName(), "rb") as f:
+                cache = f.read()
+        except OSError:
+            return None
+
+        try:
+            (magic, version, size, mtime, checksum,
+             noteCount) = indexHeader.unpack_from(cache)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                return None
+
+            if size != self.fingerprint[0]:
+                return None
+
+            if mtime != self.fingerprint[1]:
+                if checksum != self.fileChecksum():
+                    return None
+                self.checksum = checksum
+
+            notes = []
+            pos = indexHeader.size
+            for _ in range(noteCount):
+                byteStart, byteBodyStart, itemCount = indexNote.unpack_from(
+                    cache, pos)
+                pos += indexNote.size
+
+                strings = []
+                for _ in range(2 * itemCount):
+                    length, = indexString.unpack_from(cache, pos)
+                    pos += indexString.size
+                    strings.append(str(cache[pos:pos + length],
+                                       encoding="UTF-8"))
+                    pos += length
+
+                metadata = Note(zip(strings[::2], strings[1::2]))
+                notes.append((metadata, byteStart, byteBodyStart))
+        except (struct.error, UnicodeDecodeError):
+            print("ERROR: Corrupted diary index " + self.indexCacheName())
+            return None
+
+        return notes
+
+    def notesFromIndexCache(self, cachedIndex, rawBytes=None):
+        """Build note data and offset spans from a cached index.
+
+        Args:
+            cachedIndex (list): Index as returned by loadIndexCache().
+            rawBytes (bytes, optional): The diary file contents, needed to
+                convert byte offsets to character offsets in non-lazy mode.
+
+        Returns:
+            A list of data dictionaries and a list of offset spans, same as
+            parseNotes().
+
+        """
+        isAscii = self.lazy or isAsciiText(self.rawData)
+        size = len(self.rawData) if isAscii else len(rawBytes)
+
+        data = []
+        spans = []
+        noteEnd = 0
+        if cachedIndex and not isAscii:
+            noteEnd = len(str(rawBytes[:cachedIndex[0][1]], encoding="UTF-8"))
+
+        for i, (metadata, byteStart, byteBodyStart) in enumerate(
+                cachedIndex):
+            if i == len(cachedIndex) - 1:
+                byteEnd = size
+            else:
+                byteEnd = cachedIndex[i + 1][1]
+
+            if isAscii:
+                noteStart = byteStart
+                bodyStart = byteBodyStart
+                noteEnd = byteEnd
+            else:
+                # Notes are contiguous, so only their lengths are needed
+                noteStart = noteEnd
+                bodyStart = noteStart + len(str(
+                    rawBytes[byteStart:byteBodyStart], encoding="UTF-8"))
+                noteEnd = bodyStart + len(str(
+                    rawBytes[byteBodyStart:byteEnd], encoding="UTF-8"))
+
+            if not self.lazy:
+                textStart = self.skipLines(self.rawData, bodyStart, noteEnd, 3)
+                metadata["text"] = self.rawData[textStart:noteEnd]
+
+            data.append(metadata)
+            spans.append((noteStart, bodyStart, noteEnd, byteStart))
+
+        return data, spans
+
+    def wrapLazyNotes(self, data):
+        """Turn freshly parsed metadata into LazyNotes in lazy mode.
+
+        Args:
+            data (list): Note records to be converted in place.
+        """
+        if self.lazy:
+            data[:] = [LazyNote(self, datum) for datum in data]
+
+    def buildIndex(self, first=0):
+        """Rebuild the note_id -> position index of self.data.
+
+        The index has to be rebuilt whenever self.data is changed, so all
+        note lookups can be done in constant time. If several notes share
+        a note_id (e.g., a note pasted twice), the first one is indexed.
+
+        Args:
+            first (int, optional): Position of the first note whose index
+                entry is out of date. Entries of notes before it are kept.
+        """
+        if first == 0:
+            self.index = {}
+        indexed = set()
+        for i in range(first, len(self.data)):
+            noteId = self.data[i]["note_id"]
+            # Entries before first are of earlier copies, the rest outdated
+            if noteId not in indexed and self.index.get(noteId, i) >= first:
+                self.index[noteId] = i
+                indexed.add(noteId)
+
+    def buildSearchIndexes(self, wordIndex=True, trigramIndex=False):
+        """Build the requested search indexes, unless they already exist.
+
+        Once built, the indexes are kept up to date as notes are saved.
+
+        Args:
+            wordIndex (bool, optional): Build the word index.
+            trigramIndex (bool, optional): Build the trigram index, which
+                takes a lot of memory and time to build for big diaries.
+        """
+        if wordIndex and self.wordIndex is None:
+            self.wordIndex = WordIndex(self.iterNoteTexts())
+        if trigramIndex and self.trigramIndex is None:
+            self.trigramIndex = TrigramIndex(self.iterNoteTexts())
+
+    def searchIndexes(self):
+        """Get a list of the search indexes kept by the diary."""
+        return [searchIndex for searchIndex in (
+            self.wordIndex, self.trigramIndex) if searchIndex is not None]
+
+    def hasNote(self, noteId):
+        """Check whether a note with the given UUID exists in the diary."""
+        return noteId in self.index
+
+    def updateDiaryOnDisk(self, newData):
+        """Save all changes to the diary to disk.
+
+        If the diary file changed in the meantime, abort the save.
+
+        Args:
+            newData (str): The whole diary as a string to be saved to disk.
+        """
+        if self.batchSegments is not None:
+            print("ERROR: Can't rewrite the whole diary inside a batch!")
+            return
+
+        if self.writeDiary(newData):
+            self.reparseDiary()
+
+    def reparseDiary(self):
+        """Parse the whole diary again, rebuilding all the indexes."""
+        data, spans = self.parseNotes(self.rawData)
+        self.checkNoteIds(data)
+        self.textCache.clear()
+        self.data, self.spans = data, spans
+        self.wrapLazyNotes(self.data)
+        self.buildIndex()
+        if self.wordIndex is not None:
+            self.wordIndex = WordIndex(self.iterNoteTexts())
+        if self.trigramIndex is not None:
+            self.trigramIndex = TrigramIndex(self.iterNoteTexts())
+        self.dateIndex = None
+
+    def reloadFromDisk(self):
+        """Bring the diary up to date with external changes of its file.
+
+        The new file contents are compared to the old ones and only the
+        notes touching the part between their common prefix and suffix are
+        parsed again, so e.g. a note appended by a syncing tool costs just
+        the comparison. A lazy diary whose file was modified in place has
+        nothing to compare to, it is parsed again as a whole.
+
+        If the file can't be read or parsed (e.g., it was deleted, or a
+        syncing tool is in the middle of writing it), the diary is left as
+        it was and still considered changed on disk, so it is reloaded on
+        the next attempt.
+
+        Returns:
+            bool: True if the diary was changed, False otherwise.
+
+        """
+        if self.batchSegments is not None or not self.isChangedOnDisk():
+            return False
+
+        oldData = self.rawData
+        oldFingerprint = self.fingerprint
+        oldChecksum = self.checksum
+        oldLazy = self.lazy
+        oldTranslated = self.newlinesTranslated
+        try:
+            self.reloadChanges(oldData)
+        except (OSError, ValueError, KeyError, EOFError) as error:
+            print("ERROR: Couldn't reload diary " + self.fname + ": " +
+                  str(error))
+            if self.rawData is not oldData and isinstance(
+                    self.rawData, mmap.mmap):
+                self.rawData.close()
+            self.rawData = oldData
+            self.fingerprint = oldFingerprint
+            self.checksum = oldChecksum
+            self.lazy = oldLazy
+            self.newlinesTranslated = oldTranslated
+            return False
+
+        if isinstance(oldData, mmap.mmap) and oldData is not self.rawData:
+            oldData.close()
+        return True
+
+    def reloadChanges(self, oldData):
+        """Read the changed diary file and parse the changed notes again.
+
+        Raises before changing the notes if the file can't be read or
+        parsed, see reloadFromDisk().
+
+        Args:
+            oldData (str or mmap): The diary contents before the change.
+        """
+        wasLazy = self.lazy
+        if wasLazy:
+            sameInode = os.stat(self.fname).st_ino == self.fingerprint[2]
+            # Keep the old mapping open for the comparison
+            self.rawData = None
+        self.loadDiary()
+        # Nothing to compare to, or the diary isn't mapped anymore
+        if wasLazy and (sameInode or not self.lazy):
+            self.reparseDiary()
+            return
+        newData = self.rawData
+
+        start = self.commonPrefixLength(oldData, newData)
+        suffix = self.commonSuffixLength(
+            oldData, newData, min(len(oldData), len(newData)) - start)
+        end = len(oldData) - suffix
+        delta = len(newData) - len(oldData)
+        if self.lazy:
+            byteDelta = delta
+        else:
+            byteDelta = (self.encodedLength(newData[start:end + delta]) -
+                         self.encodedLength(oldData[start:end]))
+
+        # The byte offsets of the notes before the change are still valid
+        starts = [span[0] for span in self.spans]
+        self.reparseRegion(start, end, delta, byteDelta, starts)
+
+    @staticmethod
+    def commonPrefixLength(a, b, blockSize=1 << 16):
+        """Get the length of the common prefix of two strings (or bytes).
+
+        The strings are compared block by block and the first differing
+        block is bisected, so all the comparisons are done in C.
+
+        Args:
+            a (str or bytes-like): The first string.
+            b (str or bytes-like): The second string.
+            blockSize (int, optional): Length of the compared blocks.
+
+        Returns:
+            int: The length of the common prefix.
+
+        """
+        length = min(len(a), len(b))
+        pos = 0
+        while pos < length:
+            step = min(blockSize, length - pos)
+            if a[pos:pos + step] == b[pos:pos + step]:
+                pos += step
+                continue
+
+            # a[:low] == b[:low], a[:high] != b[:high]
+            low, high = pos, pos + step
+            while high - low > 1:
+                middle = (low + high) // 2
+                if a[low:middle] == b[low:middle]:
+                    low = middle
+                else:
+                    high = middle
+            return low
+
+        return length
+
+    @staticmethod
+    def commonSuffixLength(a, b, limit, blockSize=1 << 16):
+        """Get the length of the common suffix of two strings (or bytes).
+
+        Args:
+            a (str or bytes-like): The first string.
+            b (str or bytes-like): The second string.
+            limit (int): The maximal length of the suffix.
+            blockSize (int, optional): Length of the compared blocks.
+
+        Returns:
+            int: The length of the common suffix.
+
+        """
+        lengthA = len(a)
+        lengthB = len(b)
+        length = 0
+        while length < limit:
+            step = min(blockSize, limit - length)
+            if (a[lengthA - length - step:lengthA - length] ==
+                    b[lengthB - length - step:lengthB - length]):
+                length += step
+                continue
+
+            low, high = length, length + step
+            while high - low > 1:
+                middle = (low + high) // 2
+                if (a[lengthA - middle:lengthA - low] ==
+                        b[lengthB - middle:lengthB - low]):
+                    low = middle
+                else:
+                    high = middle
+            return low
+
+        return limit
+
+    def isChangedOnDisk(self):
+        """Check whether the diary file was changed by someone else.
+
+        The file's size, modification time and inode are compared to the
+        ones recorded when the diary was last loaded or saved. Only when
+        they are inconclusive (same size, but a different modification time
+        or inode) is the file's checksum computed and compared to the
+        checksum of the diary contents. This makes the check cheap enough
+        to be polled.
+
+        Returns:
+            bool: True if the diary file was changed, False otherwise.
+
+        """
+        self.flush()
+        try:
+            stat = os.stat(self.fname)
+        except FileNotFoundError:
+            return True
+
+        fingerprint = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        if fingerprint == self.fingerprint:
+            return False
+
+        if stat.st_size != self.fingerprint[0]:
+            return True
+
+        checksum = self.contentChecksum(sameInode=(
+            stat.st_ino == self.fingerprint[2]))
+        if checksum is None or checksum != self.fileChecksum():
+            return True
+
+        # Same contents, just touched, no need to hash it again next time
+        self.fingerprint = fingerprint
+        return False
+
+    def updateFingerprint(self, checksum=None):
+        """Record the diary file's size, modification time and inode.
+
+        Should be called whenever the diary is loaded or written. The
+        checksum of the contents is only computed once it is needed.
+
+        Args:
+            checksum (int, optional): CRC32 checksum of the file, if it is
+                already known. Always given for compressed diaries, whose
+                file can't be checksummed from self.rawData.
+        """
+        stat = os.stat(self.fname)
+        self.fingerprint = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        self.checksum = checksum
+
+    def contentChecksum(self, sameInode=False):
+        """Get the CRC32 checksum of the diary contents as they were saved.
+
+        Args:
+            sameInode (bool, optional): Whether the diary file still has the
+                inode it had when the diary was last loaded or saved.
+
+        Returns:
+            The checksum, or None if it can't be determined. That happens in
+            lazy mode when the mapped file might have been modified in place
+            before the checksum was computed.
+
+        """
+        if self.checksum is None:
+            if (self.lazy and sameInode) or self.compression is not None:
+                return None
+
+            checksum = 0
+            for i in range(0, len(self.rawData), self.chunkSize):
+                chunk = self.rawData[i:i + self.chunkSize]
+                if not self.lazy:
+                    chunk = bytes(chunk, encoding="UTF-8")
+                checksum = binascii.crc32(chunk, checksum)
+            self.checksum = checksum
+
+        return self.checksum
+
+    def fileChecksum(self):
+        """Compute the CRC32 checksum of the diary file in chunks."""
+        checksum = 0
+        with open(self.fname, "rb") as f:
+            for chunk in iter(lambda: f.read(self.chunkSize), b""):
+                checksum = binascii.crc32(chunk, checksum)
+
+        return checksum
+
+    @staticmethod
+    def syncFile(f, durability):
+        """Flush a file being written to the disk, if durability requires.
+
+        Args:
+            f (file): The file, open for writing.
+            durability (str): One of DURABILITIES.
+        """
+        f.flush()
+        if durability != DURABILITY_NONE:
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def syncDirectory(fname, durability):
+        """Flush the directory entry of a file to the disk, if durability
+        requires.
+
+        Needed after the file was created, renamed or deleted.
+
+        Args:
+            fname (str): Path to the file.
+            durability (str): One of DURABILITIES.
+        """
+        # Directories can't be opened (and synced) on Windows
+        if durability != DURABILITY_DIRECTORY or os.name == "nt":
+            return
+
+        directory = os.open(os.path.dirname(os.path.abspath(fname)),
+                            os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    @staticmethod
+    def replaceFile(fname, data, durability=DURABILITY_NONE):
+        """Atomically replace the contents of a file.
+
+        The data is written to a temporary file next to the file, which
+        then replaces it, so the file is never seen half-written. Unless
+        the temporary file is synced, a power failure may still leave the
+        file empty on file systems that can store the rename before the
+        data (e.g., ext4 and btrfs make such renames wait for the data).
+
+        Args:
+            fname (str): Path to the file.
+            data (bytes): The new contents of the file.
+            durability (str, optional): One of DURABILITIES.
+        """
+        with tempfile.NamedTemporaryFile(
+                mode="wb", prefix=".diary_", suffix=".tmp",
+                dir=os.path.dirname(fname), delete=False) as tmpf:
+            tmpf.write(data)
+            Diary.syncFile(tmpf, durability)
+        os.replace(tmpf.name, fname)
+        Diary.syncDirectory(fname, durability)
+
+    def writeDiary(self, newData):
+        """Write the whole diary to disk, unless it was changed externally.
+
+        Only self.rawData and the file's fingerprint are updated, it is up
+        to the caller to bring the note data up to date. Translated line
+        endings (see decodeDiary()) are written as they are in self.rawData,
+        so afterwards the file matches it byte for byte again.
+
+        Args:
+            newData (str or bytes): The whole diary to be saved to disk.
+                Lazy diaries may be handed UTF-8 encoded bytes.
+
+        Returns:
+            bool: True if the diary was saved, False otherwise.
+
+        """
+        if self.isChangedOnDisk():
+            print("ERROR: Diary file was changed! Abort save.")
+            return False
+
+        newBytes = newData
+        if isinstance(newData, str):
+            newBytes = bytes(newData, encoding="UTF-8")
+
+        self.newlinesTranslated = False
+        if self.compression is not None:
+            self.rawData = str(newBytes, encoding="UTF-8")
+            self.writeCompressed(newBytes)
+            return True
+
+        self.replaceFile(self.fname, newBytes, self.durability)
+
+        if self.lazy:
+            self.mapDiary()
+        elif isinstance(newData, str):
+            self.rawData = newData
+        else:
+            self.rawData = str(newData, encoding="UTF-8")
+        self.updateFingerprint()
+        return True
+
+    def writeDiaryTail(self, offset, tail):
+        """Rewrite the diary file from offset on, unless changed externally.
+
+        Only the data from offset to the end of the file is written, so
+        appending a note costs only the size of the note. The original data
+        after offset is saved to a journal first, which recoverJournal()
+        uses to roll back the save if it gets interrupted. Compressed
+        diaries are compressed and replaced as a whole, see
+        writeCompressed(), and so are diaries with DURABILITY_NONE, see
+        replaceFile().
+
+        Only the file's fingerprint and the mmap in self.rawData (in lazy
+        mode) are refreshed, it is up to the caller to bring the rest up to
+        date.
+
+        Args:
+            offset (int): Byte offset where the new tail starts.
+            tail (bytes): The new diary contents from offset on.
+
+        Returns:
+            bool: True if the diary was saved, False otherwise.
+
+        """
+        if self.isChangedOnDisk():
+            print("ERROR: Diary file was changed! Abort save.")
+            return False
+
+        if self.compression is not None:
+            # self.rawData isn't updated yet, it still holds the old diary
+            self.writeCompressed(
+                bytes(self.rawData, encoding="UTF-8")[:offset] + tail)
+            return True
 
-    def __init__(self, fname):
-        """Init method that reads in a diary from a file.
+        if self.durability == DURABILITY_NONE:
+            # Without syncs, a partial write could outlive its journal
+            with open(self.fname, "rb") as f:
+                head = f.read(offset)
+            self.replaceFile(self.fname, head + tail)
+            if self.lazy:
+                self.mapDiary()
+            self.updateFingerprint()
+            return True
+
+        with open(self.fname, "rb") as f:
+            f.seek(offset)
+            oldTail = f.read()
+        headChecksum = self.headChecksum(offset)
+
+        # The journal has to be on the disk before the diary is modified,
+        # whatever the durability, or a power failure could leave the diary
+        # half-written with nothing to roll it back
+        journalName = self.journalName()
+        self.replaceFile(journalName, b"%d %d %d %d %d\n%s" % (
+            offset, offset + len(oldTail), binascii.crc32(oldTail),
+            offset + len(tail), headChecksum, oldTail), DURABILITY_DIRECTORY)
+
+        # Shrinking a file that is still mapped isn't safe
+        self.close()
+        try:
+            with open(self.fname, "r+b") as f:
+                f.seek(offset)
+                f.write(tail)
+                f.truncate()
+                # Likewise, the diary has to be before the journal is gone
+                self.syncFile(f, DURABILITY_FILE)
+        finally:
+            if self.lazy:
+                self.mapDiary()
+
+        # Until the journal is gone, the save would be rolled back
+        os.remove(journalName)
+        self.syncDirectory(journalName, self.durability)
+        self.updateFingerprint()
+        self.lastHead = (offset, headChecksum, self.fingerprint)
+        return True
+
+    def headChecksum(self, offset):
+        """Compute the CRC32 checksum of the diary file up to offset.
+
+        Saves mostly go further into the diary than the previous one (e.g.,
+        appended notes), so the checksum of the head saved last time is
+        continued, if the file wasn't changed since.
 
         Args:
-            fname (str): Path to the diary to be loaded.
+            offset (int): Byte offset where the head ends.
+
+        Returns:
+            int: The checksum of the first offset bytes of the file.
+
         """
-        self.fname = fname
-        with open(fname) as f:
-            self.rawData = f.read()
-        self.checksum = binascii.crc32(bytes(self.rawData, encoding="UTF-8"))
-        self.data = self.extractData(self.rawData)
+        start = 0
+        checksum = 0
+        if (self.lastHead is not None and self.lastHead[0] <= offset and
+                self.lastHead[2] == self.fingerprint):
+            start, checksum = self.lastHead[:2]
 
-    def updateDiaryOnDisk(self, newData):
-        """Save all changes to the diary to disk.
+        with open(self.fname, "rb") as f:
+            f.seek(start)
+            while start < offset:
+                chunk = f.read(min(self.chunkSize, offset - start))
+                if not chunk:
+                    break
+                checksum = binascii.crc32(chunk, checksum)
+                start += len(chunk)
+
+        return checksum
 
-        If the diary's checksum changed in the meantime, abort the save.
+    def writeChanges(self, start, byteStart, tail, tailBytes):
+        """Write the diary from a changed part on, see writeDiaryTail().
+
+        A diary whose line endings were translated (see decodeDiary())
+        doesn't match its file byte for byte, so it is written as a whole
+        instead, see writeDiary().
 
         Args:
-            newData (str): The whole diary as a string to be saved to disk.
+            start (int): Offset in self.rawData where the new tail starts.
+            byteStart (int): The corresponding byte offset in the file.
+            tail (str or bytes): The new diary contents from start on.
+            tailBytes (bytes): The same, UTF-8 encoded.
+
+        Returns:
+            bool: True if the diary was saved, False otherwise.
+
         """
-        with open(self.fname) as f:
-            rawData = f.read()
-        checksum = binascii.crc32(bytes(rawData, encoding="UTF-8"))
+        if self.newlinesTranslated:
+            return self.writeDiary(self.rawData[:start] + tail)
 
-        if checksum == self.checksum:
-            newChecksum = binascii.crc32(bytes(newData, encoding="UTF-8"))
+        return self.writeDiaryTail(byteStart, tailBytes)
 
-            with tempfile.NamedTemporaryFile(
-                    mode="w", prefix=".diary_", suffix=".tmp",
-                    dir=os.path.dirname(self.fname), delete=False) as tmpf:
-                tmpf.write(newData)
-            os.replace(tmpf.name, self.fname)
+    def byteOffset(self, pos, starts):
+        """Convert an offset in self.rawData to an offset in the file.
 
-            self.rawData = newData
-            self.checksum = newChecksum
-            self.data = self.extractData(self.rawData)
+        Args:
+            pos (int): Offset in self.rawData.
+            starts (list): Start offsets of all notes, used to find the
+                nearest note with a known byte offset.
+
+        Returns:
+            int: The corresponding byte offset.
+
+        """
+        if self.lazy:
+            return pos
+
+        i = bisect.bisect_right(starts, pos) - 1
+        if i < 0:
+            return self.encodedLength(self.rawData[:pos])
+
+        return self.spans[i][3] + self.encodedLength(
+            self.rawData[self.spans[i][0]:pos])
+
+    @staticmethod
+    def skipLines(rawData, pos, endpos, count):
+        """Get the offset after count newlines, starting from pos.
+
+        Args:
+            rawData (str or bytes-like): The whole diary.
+            pos (int): Offset to start from.
+            endpos (int): Offset returned if there are not enough newlines.
+            count (int): Number of newlines to skip.
+
+        Returns:
+            int: Offset of the first character after the last skipped
+                newline.
+
+        """
+        newline = "\n" if isinstance(rawData, str) else b"\n"
+        for _ in range(count):
+            pos = rawData.find(newline, pos, endpos) + 1
+            if pos == 0:
+                return endpos
+
+        return pos
+
+    @staticmethod
+    def encodedLength(text):
+        """Get the length of a string in UTF-8 encoded bytes."""
+        if isAsciiText(text):
+            return len(text)
+
+        return len(bytes(text, encoding="UTF-8"))
+
+    def spliceDiary(self, start, end, replacement):
+        """Replace a part of the diary and save it to disk.
 
+        Only the file contents from the start of the replaced part on are
+        written. Instead of re-parsing the whole diary after the save, only
+        the notes touching the replaced part are parsed again and the
+        offsets of all the following notes are shifted.
+
+        Args:
+            start (int): Offset of the first replaced character (byte in
+                lazy mode).
+            end (int): Offset one past the last replaced character.
+            replacement (str): The new text to be put in place of
+                rawData[start:end].
+        """
+        if self.lazy:
+            replacement = bytes(replacement, encoding="UTF-8")
+
+        starts = [span[0] for span in self.spans]
+        byteStart = self.byteOffset(start, starts)
+        delta = len(replacement) - (end - start)
+
+        tail = replacement + self.rawData[end:]
+        if self.lazy:
+            tailBytes = tail
+            byteDelta = delta
         else:
-            print("ERROR: Diary file was changed! Abort save.")
+            tailBytes = bytes(tail, encoding="UTF-8")
+            byteDelta = (self.encodedLength(replacement) -
+                         self.encodedLength(self.rawData[start:end]))
+
+        if not self.writeChanges(start, byteStart, tail, tailBytes):
+            return
+
+        if not self.lazy:
+            self.rawData = self.rawData[:start] + tail
+
+        self.reparseRegion(start, end, delta, byteDelta, starts)
+
+    def reparseRegion(self, start, end, delta, byteDelta, starts):
+        """Bring the notes up to date after a part of rawData was replaced.
+
+        Only the notes touching the replaced part are parsed again, the
+        offsets of all the following notes are shifted.
+
+        Args:
+            start (int): Offset of the first replaced character (byte in
+                lazy mode).
+            end (int): Offset one past the last replaced character, in the
+                old rawData.
+            delta (int): Change of the length of rawData.
+            byteDelta (int): Change of the size of the diary file.
+            starts (list): Start offsets of all notes before the change.
+        """
+        # Notes containing, or directly adjacent to, the replaced part. The
+        # note preceding the change has to be parsed again as well, as its
+        # text runs up to the next header, which may have been changed.
+        first = max(0, bisect.bisect_right(starts, start) - 2)
+        last = bisect.bisect_right(starts, end) - 1
+
+        while True:
+            regionStart = start
+            regionEnd = end
+            if last >= first:
+                regionStart = min(start, self.spans[first][0])
+                regionEnd = max(end, self.spans[last][2])
+
+            data, spans = self.parseNotes(
+                self.rawData, regionStart, regionEnd + delta,
+                self.byteOffset(regionStart, starts))
+            if last + 1 >= len(self.spans):
+                break
+
+            # A header left without its end (e.g., by an external edit)
+            # runs into the next note, which has to be parsed as well
+            searchFrom = spans[-1][1] if spans else regionStart
+            if (self.pendingHeaderStart(self.rawData, searchFrom) >=
+                    regionEnd + delta):
+                break
+            last += 1
+        self.checkNoteIds(data)
+        self.wrapLazyNotes(data)
+
+        self.spans[last + 1:] = [
+            (noteStart + delta, bodyStart + delta, noteEnd + delta,
+             byteStart + byteDelta)
+            for noteStart, bodyStart, noteEnd, byteStart
+            in self.spans[last + 1:]]
+        self.replaceNotes(first, last, data, spans)
+
+    @staticmethod
+    def checkNoteIds(data):
+        """Raise KeyError if a parsed note has no ID.
+
+        Notes are checked before they replace any of the diary's notes, so
+        a header left without an ID by an external edit changes nothing.
+
+        Args:
+            data (list): Metadata of the parsed notes.
+        """
+        for datum in data:
+            if "note_id" not in datum:
+                raise KeyError("note_id")
+
+    def replaceNotes(self, first, last, data, spans):
+        """Replace re-parsed notes, keeping all the indexes up to date.
+
+        Args:
+            first (int): Position of the first replaced note.
+            last (int): Position of the last replaced note, first - 1 if
+                the new notes are only inserted.
+            data (list): Note records replacing self.data[first:last + 1].
+            spans (list): Offset spans replacing self.spans[first:last + 1].
+        """
+        removedIds = [datum["note_id"] for datum in self.data[first:last + 1]]
+        for noteId in removedIds:
+            # Another copy of a duplicate note_id may be indexed, see
+            # buildIndex()
+            if first <= self.index.get(noteId, -1) <= last:
+                del self.index[noteId]
+            self.textCache.pop(noteId, None)
+            for searchIndex in self.searchIndexes():
+                searchIndex.removeNote(noteId)
+            if self.dateIndex is not None:
+                self.dateIndex.removeNote(noteId)
+
+        self.data[first:last + 1] = data
+        self.spans[first:last + 1] = spans
+
+        if len(data) == last + 1 - first:
+            for i, datum in enumerate(data, first):
+                if self.index.get(datum["note_id"], i) >= i:
+                    self.index[datum["note_id"]] = i
+            # A later copy of a removed note_id has to be found
+            if not all(noteId in self.index for noteId in removedIds):
+                self.buildIndex(first)
+        else:
+            self.buildIndex(first)
+
+        # The notes whose first copy was replaced, or is one of the new ones
+        noteIds = set(removedIds)
+        noteIds.update(datum["note_id"] for datum in data)
+        positions = sorted(self.index[noteId] for noteId in noteIds
+                           if noteId in self.index)
+        for searchIndex in self.searchIndexes():
+            for i in positions:
+                searchIndex.removeNote(self.data[i]["note_id"])
+                searchIndex.addNote(self.data[i]["note_id"], self.noteText(i))
+        if self.dateIndex is not None:
+            for i in positions:
+                self.dateIndex.removeNote(self.data[i]["note_id"])
+                self.dateIndex.addNote(self.data[i]["note_id"],
+                                       self.data[i].get("date") or "")
+
+    def noteLength(self, position):
+        """Get the length of a note, from its header up to the next one.
+
+        Args:
+            position (int): Position of the note in self.data, -1 for the
+                text preceding the first note (the whole diary if there are
+                no notes).
+
+        Returns:
+            int: The length in characters (bytes in lazy mode).
+
+        """
+        if position >= 0:
+            noteStart, _, noteEnd, _ = self.spans[position]
+            return noteEnd - noteStart
+        if self.batchSegments is not None:
+            return len(self.batchPreamble)
+        return self.spans[0][0] if self.spans else len(self.rawData)
+
+    def noteSegment(self, position):
+        """Get the raw text of a note, from its header up to the next one.
+
+        Args:
+            position (int): Position of the note in self.data, -1 for the
+                text preceding the first note.
+
+        Returns:
+            The note's part of the diary (bytes in lazy mode), including any
+            changes made in the current batch().
+
+        """
+        if position < 0:
+            if self.batchSegments is not None:
+                return self.batchPreamble
+            return self.rawData[:self.noteLength(-1)]
+
+        if (self.batchSegments is not None and
+                self.batchSegments[position] is not None):
+            return self.batchSegments[position]
+
+        noteStart, _, noteEnd, _ = self.spans[position]
+        return self.rawData[noteStart:noteEnd]
+
+    def spliceNote(self, position, start, end, replacement):
+        """Replace a part of a note and save it, see spliceDiary().
+
+        Inside a batch() the change is only made in memory.
+
+        Args:
+            position (int): Position of the note in self.data, -1 for the
+                text preceding the first note (the whole diary if there are
+                no notes).
+            start (int): Offset of the first replaced character, relative to
+                the start of the note.
+            end (int): Offset one past the last replaced character.
+            replacement (str): The new text of the replaced part.
+        """
+        if self.batchSegments is not None:
+            self.spliceBatch(position, start, end, replacement)
+            return
+
+        noteStart = self.spans[position][0] if position >= 0 else 0
+        self.spliceDiary(noteStart + start, noteStart + end, replacement)
+
+    def spliceBatch(self, position, start, end, replacement):
+        """Replace a part of a note in memory, as a part of a batch().
+
+        The diary is kept as separate notes for the duration of a batch, so
+        only the changed note and its neighbours are joined, changed and
+        parsed again, no matter how big the diary is. The spans of the
+        changed notes are relative to their own start.
+
+        Args:
+            position (int): Position of the note, see spliceNote().
+            start (int): Offset of the first replaced character, relative to
+                the start of the note.
+            end (int): Offset one past the last replaced character.
+            replacement (str): The new text of the replaced part.
+        """
+        if self.lazy:
+            replacement = bytes(replacement, encoding="UTF-8")
+
+        # The same neighbours spliceDiary() would parse again
+        first = position - 1 if start == 0 and position >= 0 else position
+        last = position
+        if (end == self.noteLength(position) and
+                position + 1 < len(self.data)):
+            last = position + 1
+
+        if self.batchFirst is None or first < self.batchFirst:
+            # Everything before an untouched note is untouched as well, so
+            # its offsets tell where the changed part of the file starts
+            self.batchFirst = first
+            if first < 0:
+                self.batchOffsets = (0, 0)
+            else:
+                self.batchOffsets = (self.spans[first][0],
+                                     self.spans[first][3])
+
+        segments = [self.noteSegment(i) for i in range(first, last + 1)]
+        offset = sum(len(segment) for segment in segments[:position - first])
+        region = segments[0][:0].join(segments)
+        region = (region[:offset + start] + replacement +
+                  region[offset + end:])
+
+        data, spans = self.parseNotes(region)
+        self.wrapLazyNotes(data)
+
+        if first < 0:
+            self.batchPreamble = region[:spans[0][0] if spans else None]
+            first = 0
+        self.batchSegments[first:last + 1] = [
+            region[noteStart:noteEnd]
+            for noteStart, _, noteEnd, _ in spans]
+        self.replaceNotes(first, last, data, [
+            (0, bodyStart - noteStart, noteEnd - noteStart, None)
+            for noteStart, bodyStart, noteEnd, _ in spans])
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Make several changes to the diary with a single save.
+
+        All notes saved, updated or deleted inside the with block are only
+        changed in memory and the diary file is written once, when the
+        block ends. The check for external changes of the file is done just
+        once as well. If the block raises an exception, or the file was
+        changed externally, all of the changes are rolled back. Batches can
+        be nested, only the outermost one saves the diary.
+
+        Example:
+            with diary.batch():
+                for noteId in noteIds:
+                    diary.changeNoteDate(noteId, "2017-01-01")
+
+        Yields:
+            The diary itself.
+
+        """
+        if self.batchSegments is not None:
+            yield self
+            return
+
+        backup = (list(self.data), list(self.spans), dict(self.index))
+        self.batchPreamble = self.noteSegment(-1)
+        self.batchSegments = [None] * len(self.data)
+        self.batchFirst = None
+        self.batchOffsets = None
+        try:
+            yield self
+            committed = self.commitBatch()
+        except BaseException:
+            self.rollbackBatch(backup)
+            raise
+
+        if not committed:
+            self.rollbackBatch(backup)
+
+    def commitBatch(self):
+        """Save the changes made in a batch() to disk.
+
+        Returns:
+            bool: True if the diary was saved, False otherwise.
+
+        """
+        first = self.batchFirst
+        if first is None:
+            self.batchSegments = None
+            return True
+
+        offset, byteOffset = self.batchOffsets
+        segments = [self.noteSegment(i)
+                    for i in range(first, len(self.data))]
+        tail = self.batchPreamble[:0].join(segments)
+        self.batchSegments = None
+
+        tailBytes = tail if self.lazy else bytes(tail, encoding="UTF-8")
+        if not self.writeChanges(offset, byteOffset, tail, tailBytes):
+            return False
+
+        if not self.lazy:
+            self.rawData = self.rawData[:offset] + tail
+
+        # The notes are the same as in the batch, just with proper offsets
+        first = max(first, 0)
+        data, spans = self.parseNotes(self.rawData, offset, len(self.rawData),
+                                      byteOffset)
+        self.wrapLazyNotes(data)
+        self.data[first:] = data
+        self.spans[first:] = spans
+        self.buildIndex(first)
+        self.textCache.clear()
+        return True
+
+    def rollbackBatch(self, backup):
+        """Undo all the changes made in a batch().
+
+        Args:
+            backup (tuple): Copies of self.data, self.spans and self.index
+                made when the batch started.
+        """
+        self.batchSegments = None
+        self.data, self.spans, self.index = backup
+        self.textCache.clear()
+
+        # The search indexes were changed in place, build them anew
+        wordIndex = self.wordIndex is not None
+        trigramIndex = self.trigramIndex is not None
+        self.wordIndex = None
+        self.trigramIndex = None
+        self.buildSearchIndexes(wordIndex, trigramIndex)
+        self.dateIndex = None
 
     def saveNote(self, note, noteId, noteDate):
         """Save a new note to diary or update an existing one.
@@ -61,13 +1739,13 @@ class Diary():
             noteId (str): UUID of the note.
             noteDate (str): Note creation date.
         """
-        if any(noteId in metaDict["note_id"] for metaDict in self.data):
+        if self.hasNote(noteId):
             self.updateNote(note, noteId, noteDate)
         else:
-            newData = self.rawData
-            newData += self.createNoteHeader(noteId, noteDate)
-            newData += note
-            self.updateDiaryOnDisk(newData)
+            position = len(self.data) - 1
+            end = self.noteLength(position)
+            self.spliceNote(position, end, end,
+                            self.createNoteHeader(noteId, noteDate) + note)
 
     @staticmethod
     def createNoteHeader(noteId, noteDate):
@@ -99,36 +1777,20 @@ class Diary():
             noteId (str): UUID of the note.
             noteDate (str): Note creation date.
         """
-        reHeader = re.compile(
-            r"""^<!---
-                (?:\n|\r\n)
-                markdown-diary\ note\ metadata
-                (?:\n|\r\n)
-                note_id\ =\                     # Hashtag for PEP8 compiance
-                """ + noteId +
-            r"""(.*?)
-                --->
-                """, re.MULTILINE | re.VERBOSE | re.DOTALL)
-
-        reHeaderNext = re.compile(
-            r'^<!---(?:\n|\r\n)markdown-diary note metadata(?:\n|\r\n)',
-            re.MULTILINE)
-
-        header = reHeader.search(self.rawData)
-        nextHeader = reHeaderNext.search(self.rawData, header.end())
-
-        newData = self.rawData[:header.end()]
-        newData += "\n"
-        newData += noteDate
-        newData += "\n\n"
-        newData += note
-        if nextHeader is not None:
+        position = self.index[noteId]
+        noteStart, bodyStart, noteEnd, _ = self.spans[position]
+
+        newText = "\n"
+        newText += noteDate
+        newText += "\n\n"
+        newText += note
+        if position < len(self.spans) - 1:
             # We need a newline separating note text from next header
-            if newData[-1] is not '\n':
-                newData += "\n"
-            newData += self.rawData[nextHeader.start():]
+            if newText[-1] != '\n':
+                newText += "\n"
 
-        self.updateDiaryOnDisk(newData)
+        self.spliceNote(position, bodyStart - noteStart, noteEnd - noteStart,
+                        newText)
 
     def deleteNote(self, noteId):
         """Delete a note from a diary.
@@ -136,30 +1798,13 @@ class Diary():
         Args:
             noteId (str): UUID of the note to be deleted.
         """
-        reHeader = re.compile(
-            r"""^<!---
-                (?:\n|\r\n)
-                markdown-diary\ note\ metadata
-                (?:\n|\r\n)
-                note_id\ =\                     # Hashtag for PEP8 compiance
-                """ + noteId +
-            r"""(.*?)
-                --->
-                """, re.MULTILINE | re.VERBOSE | re.DOTALL)
-
-        reHeaderNext = re.compile(
-            r'^<!---(?:\n|\r\n)markdown-diary note metadata(?:\n|\r\n)',
-            re.MULTILINE)
+        position = self.index[noteId]
+        end = self.noteLength(position)
 
-        header = reHeader.search(self.rawData)
-        nextHeader = reHeaderNext.search(self.rawData, header.end())
-
-        newData = self.rawData[:header.start()]
-        if nextHeader is not None:
-            newData += "\n"
-            newData += self.rawData[nextHeader.start():]
-
-        self.updateDiaryOnDisk(newData)
+        if position < len(self.spans) - 1:
+            self.spliceNote(position, 0, end, "\n")
+        else:
+            self.spliceNote(position, 0, end, "")
 
     @staticmethod
     def extractData(rawData):
@@ -169,43 +1814,262 @@ class Diary():
             diaryData (str): The whole diary as a string.
 
         Returns:
-            A list of data dictionaries.
+            A list of Note records, which behave like data dictionaries.
+
+        """
+        return list(Diary.iterNotes([rawData]))
+
+    @staticmethod
+    def streamNotes(fname, chunkSize=None):
+        """Read notes from a diary file one at a time.
+
+        The file is read (and decompressed) in chunks, so only the note
+        being parsed has to fit in memory, no matter how big the diary is.
+
+        Args:
+            fname (str): Path to the diary.
+            chunkSize (int, optional): Number of bytes read at once.
+                Diary.chunkSize by default.
+
+        Yields:
+            A data dictionary for each note, same as extractData().
 
         """
-        reHeader = re.compile(
-            r"""^<!---                         # Beggining of Markdown comment
-                (?:\n|\r\n)                    # Unix|Windows non-capturing \n
-                markdown-diary\ note\ metadata # Mandatory first line
-                (.*?)                          # Any characters including \n
-                --->                           # End of Markdown comment
-                """, re.MULTILINE | re.VERBOSE | re.DOTALL)
+        chunkSize = chunkSize or Diary.chunkSize
+        with Diary.openDiaryFile(fname) as f:
+            yield from Diary.iterNotes(iter(lambda: f.read(chunkSize), b""))
+
+    @staticmethod
+    def iterNotes(chunks):
+        """Parse notes from consecutive chunks of a diary.
 
-        matches = list(reHeader.finditer(rawData))
+        A note is yielded as soon as the header of the next one (or the end
+        of the diary) is found, and the parsed part of the diary is dropped.
+        Headers split between chunks are handled.
 
-        data = []
-        for i, match in enumerate(matches):
-            dataDict = {}
-            for line in rawData[
-                    match.start():match.end()].splitlines()[2:-1]:
-                key, val = line.partition("=")[::2]
-                dataDict[key.strip()] = val.strip()
-
-            date = rawData[match.end():].splitlines()[1]
-            title = rawData[match.end():].splitlines()[3].strip("# ")
-
-            text = ""
-            if i == len(matches) - 1:
-                text = rawData[matches[i].end():].split("\n", maxsplit=3)[3]
+        Args:
+            chunks (iterable): Parts of the diary, either all str or all
+                bytes-like.
+
+        Yields:
+            A data dictionary for each note, same as extractData().
+
+        """
+        buffer = None
+        noteMatch = None
+        searchFrom = 0
+        for chunk in chunks:
+            if buffer is None:
+                buffer = chunk
+                header = reHeader if isinstance(chunk, str) else reHeaderBytes
             else:
-                text = rawData[matches[i].end(): matches[i + 1].start()].split("\n", maxsplit=3)[3]
+                buffer += chunk
+
+            match = header.search(buffer, searchFrom)
+            while match is not None:
+                if noteMatch is not None:
+                    yield Diary.noteFromMatch(buffer, noteMatch,
+                                              match.start())
+                noteMatch = match
+                searchFrom = match.end()
+                match = header.search(buffer, searchFrom)
+
+            # Skip the part of the buffer where no header can start anymore
+            # and drop everything before the note that is still incomplete.
+            # The incomplete note's header is matched again afterwards.
+            searchFrom = Diary.pendingHeaderStart(buffer, searchFrom)
+            keepFrom = searchFrom if noteMatch is None else noteMatch.start()
+            if keepFrom:
+                buffer = buffer[keepFrom:]
+                searchFrom -= keepFrom
+                if noteMatch is not None:
+                    noteMatch = header.match(buffer)
+
+        if noteMatch is not None:
+            yield Diary.noteFromMatch(buffer, noteMatch, len(buffer))
+
+    @staticmethod
+    def pendingHeaderStart(buffer, pos):
+        """Find where a header may start once more of a diary is read.
+
+        Args:
+            buffer (str or bytes-like): The diary read so far, beginning at
+                the start of a line.
+            pos (int): Offset from which no complete header was found.
+
+        Returns:
+            int: Offset of the first line from pos on that is the beginning
+                of a header, or len(buffer) if there's no such line.
+
+        """
+        if isinstance(buffer, str):
+            prefixes = HEADER_PREFIXES
+            newline = "\n"
+        else:
+            prefixes = [prefix.encode() for prefix in HEADER_PREFIXES]
+            newline = b"\n"
+        opening = prefixes[0][:5]
+
+        candidate = buffer.find(opening, pos)
+        while candidate != -1:
+            if candidate == 0 or buffer[candidate - 1:candidate] == newline:
+                # The header's first lines may be still incomplete, or its
+                # end may be missing
+                head = buffer[candidate:candidate + len(prefixes[1])]
+                for prefix in prefixes:
+                    if prefix.startswith(head) or head.startswith(prefix):
+                        return candidate
+            candidate = buffer.find(opening, candidate + 1)
+
+        # The last line may be a part of the header's opening
+        lastLine = buffer.rfind(newline) + 1
+        if lastLine >= pos and opening.startswith(buffer[lastLine:]):
+            return lastLine
+
+        return len(buffer)
+
+    @staticmethod
+    def noteFromMatch(buffer, match, end):
+        """Get a note's data dictionary from a part of a diary.
+
+        Args:
+            buffer (str or bytes-like): (A part of) the diary.
+            match (re.Match): The note's header match in buffer.
+            end (int): Offset of the note's end.
+
+        Returns:
+            A data dictionary, same as those returned by extractData().
+
+        """
+        record = Diary.recordFromMatch(buffer, match, end)
+        text = buffer[record.textStart:record.end]
+        if not isinstance(text, str):
+            text, _ = Diary.decodeDiary(text)
+
+        return Note.fromParsed(record.metadata, record.date, record.title,
+                               text)
+
+    @staticmethod
+    def scanNotes(rawData, pos=0, endpos=None):
+        """Find notes in (a part of) a diary in a single pass.
+
+        Args:
+            rawData (str or bytes-like): The whole diary.
+            pos (int, optional): Offset where to start looking for notes.
+            endpos (int, optional): Offset where the last note ends. The end
+                of rawData by default.
+
+        Yields:
+            A NoteRecord for each note, in order. Its offsets are indices to
+            rawData. Metadata, date and title are always strings.
+
+        """
+        if endpos is None:
+            endpos = len(rawData)
+
+        if isinstance(rawData, str):
+            matches = reHeader.finditer(rawData, pos, endpos)
+        else:
+            matches = reHeaderBytes.finditer(rawData, pos, endpos)
+
+        match = next(matches, None)
+        while match is not None:
+            nextMatch = next(matches, None)
+            noteEnd = endpos if nextMatch is None else nextMatch.start()
+            yield Diary.recordFromMatch(rawData, match, noteEnd)
+            match = nextMatch
 
-            dataDict["date"] = date
-            dataDict["title"] = title
-            dataDict["text"] = text
+    @staticmethod
+    def recordFromMatch(rawData, match, noteEnd):
+        """Parse a note whose header was matched by reHeader(Bytes).
+
+        Args:
+            rawData (str or bytes-like): The diary (or a part of it).
+            match (re.Match): The note's header match in rawData.
+            noteEnd (int): Offset of the note's end.
+
+        Returns:
+            The note's NoteRecord.
+
+        """
+        newline = "\n" if isinstance(rawData, str) else b"\n"
+
+        # The header is followed by a newline, the date line, an empty line
+        # and the title line, which is the first line of the text
+        lineStarts = [match.end()]
+        for _ in range(4):
+            lineEnd = rawData.find(newline, lineStarts[-1], noteEnd) + 1
+            lineStarts.append(lineEnd if lineEnd else noteEnd)
+
+        header = rawData[match.start():match.end()]
+        date = rawData[lineStarts[1]:lineStarts[2]]
+        title = rawData[lineStarts[3]:lineStarts[4]]
+        if not isinstance(rawData, str):
+            header = str(header, encoding="UTF-8")
+            date = str(date, encoding="UTF-8")
+            title = str(title, encoding="UTF-8")
+
+        metadata = {}
+        for line in header.splitlines()[2:-1]:
+            key, val = line.partition("=")[::2]
+            metadata[key.strip()] = val.strip()
+
+        return NoteRecord(match.start(), metadata, date.rstrip("\r\n"),
+                          title.rstrip("\r\n").strip("# "), match.end(),
+                          lineStarts[3], noteEnd)
+
+    @staticmethod
+    def parseNotes(rawData, pos=0, endpos=None, bytePos=0):
+        """Get notes' metadata, text and location from (a part of) a diary.
+
+        When rawData is a bytes-like object (e.g., a memory-mapped diary),
+        the offsets are in bytes and the note texts are not extracted.
+
+        Args:
+            rawData (str or bytes-like): The whole diary.
+            pos (int, optional): Offset where to start looking for notes.
+            endpos (int, optional): Offset where the last note ends. The end
+                of rawData by default.
+            bytePos (int, optional): Byte offset in the file corresponding to
+                pos. Only needed for str rawData.
+
+        Returns:
+            A list of Note records and a list of (note start, body
+            start, note end, note start in bytes) offset tuples, one for
+            each note.
+
+        """
+        if endpos is None:
+            endpos = len(rawData)
+
+        # Avoid measuring encoded lengths of each note in ASCII diaries
+        isStr = isinstance(rawData, str)
+        isAscii = (isStr and pos == 0 and endpos == len(rawData) and
+                   isAsciiText(rawData))
+        byteStart = bytePos
+        previousStart = pos
+
+        data = []
+        spans = []
+        for record in Diary.scanNotes(rawData, pos, endpos):
+            dataDict = Note.fromParsed(
+                record.metadata, record.date, record.title,
+                rawData[record.textStart:record.end] if isStr else None)
+
+            if not isStr:
+                byteStart = record.start
+            elif isAscii:
+                byteStart = bytePos + record.start
+            else:
+                byteStart += Diary.encodedLength(
+                    rawData[previousStart:record.start])
+                previousStart = record.start
 
             data.append(dataDict)
+            spans.append((record.start, record.bodyStart, record.end,
+                          byteStart))
 
-        return data
+        return data, spans
 
     def getNote(self, noteId):
         """Extract note text from diary.
@@ -217,11 +2081,52 @@ class Diary():
             A single note's text.
 
         """
-        for datum in self.data:
-            if datum["note_id"] == noteId:
-                return datum["text"]
+        datum = self.getNoteMetadata(noteId)
+        if datum is None:
+            return None
+
+        if not self.lazy:
+            return datum["text"]
+
+        if noteId in self.textCache:
+            self.textCache.move_to_end(noteId)
+            return self.textCache[noteId]
+
+        text = self.noteText(self.index[noteId])
+
+        self.textCache[noteId] = text
+        if len(self.textCache) > self.lazyCacheSize:
+            self.textCache.popitem(last=False)
+
+        return text
+
+    def noteText(self, position):
+        """Get the text of the note at a position, bypassing the cache.
+
+        Args:
+            position (int): Position of the note in self.data.
+
+        Returns:
+            The note's text.
+
+        """
+        if not self.lazy:
+            return self.data[position]["text"]
+
+        rawData = self.rawData
+        if (self.batchSegments is not None and
+                self.batchSegments[position] is not None):
+            # Changed in the current batch, the span is relative to it
+            rawData = self.batchSegments[position]
 
-        return None
+        _, bodyStart, noteEnd, _ = self.spans[position]
+        textStart = self.skipLines(rawData, bodyStart, noteEnd, 3)
+        return str(rawData[textStart:noteEnd], encoding="UTF-8")
+
+    def iterNoteTexts(self):
+        """Iterate over (noteId, text) pairs of all notes in the diary."""
+        for i, datum in enumerate(self.data):
+            yield datum["note_id"], self.noteText(i)
 
     def getNoteMetadata(self, noteId):
         """Get metadata of a single note.
@@ -233,11 +2138,35 @@ class Diary():
             A metadata dictionary. Returns None if noteId not found.
 
         """
-        for datum in self.data:
-            if noteId == datum["note_id"]:
-                return datum
+        if noteId not in self.index:
+            return None
+
+        return self.data[self.index[noteId]]
+
+    def notesBetween(self, start=None, end=None):
+        """Get all notes dated within a range.
+
+        The bounds are inclusive and may be just a year or a month, e.g.,
+        notesBetween("2017", "2017") gets all notes from 2017. The notes are
+        looked up in a sorted date index, built on the first call and kept
+        up to date as notes are saved, so other notes aren't touched. Notes
+        whose date isn't in the YYYY-MM-DD format are never returned.
+
+        Args:
+            start (str, optional): The earliest date, unbounded if None.
+            end (str, optional): The latest date, unbounded if None.
+
+        Returns:
+            A list of metadata of the matching notes, sorted by date.
+
+        """
+        if self.dateIndex is None:
+            self.dateIndex = DateIndex(
+                (datum["note_id"], datum.get("date") or "")
+                for datum in self.data)
 
-        return None
+        return [self.data[self.index[noteId]]
+                for noteId in self.dateIndex.between(start, end)]
 
     def searchNotes(self, pattern):
         """Search for all notes containing 'pattern'.
@@ -249,10 +2178,65 @@ class Diary():
             A list of metadata of all matching notes.
 
         """
+        # Each index gives a superset of the matching notes (or exactly the
+        # matching notes), so their intersection can be used
+        noteIds = None
+        exact = False
+        for searchIndex in self.searchIndexes():
+            candidates = searchIndex.candidates(pattern)
+            if candidates is not None:
+                if noteIds is None:
+                    noteIds = candidates[0]
+                else:
+                    noteIds = noteIds & candidates[0]
+                exact = exact or candidates[1]
+
+        if noteIds is None:
+            positions = range(len(self.data))
+        else:
+            positions = sorted(self.index[noteId] for noteId in noteIds)
+            if exact:
+                return [self.data[i] for i in positions]
+
+        matching = []
+        for i in positions:
+            if pattern.lower() in self.noteText(i).lower():
+                matching.append(self.data[i])
+
+        return matching
+
+    def searchWords(self, query, prefix=True):
+        """Search for all notes containing all the words of a query.
+
+        Unlike searchNotes(), this matches whole words (or their beginnings),
+        which is answered directly by the word index, if there is one.
+
+        Args:
+            query (str): Words to look for.
+            prefix (bool, optional): Also match words beginning with the
+                query's words.
+
+        Returns:
+            A list of metadata of all matching notes.
+
+        """
+        if self.wordIndex is not None:
+            noteIds = self.wordIndex.findWords(query, prefix)
+            return [self.data[i]
+                    for i in sorted(self.index[noteId] for noteId in noteIds)]
+
+        queryWords = WordIndex.extractWords(query)
         matching = []
-        for datum in self.data:
-            if pattern.lower() in datum["text"].lower():
-                matching.append(datum)
+        for i, (_, text) in enumerate(self.iterNoteTexts()):
+            words = WordIndex.extractWords(text)
+            if not queryWords:
+                break
+            if prefix and all(any(word.startswith(queryWord)
+                                  for word in words)
+                              for queryWord in queryWords):
+                matching.append(self.data[i])
+            elif not prefix and queryWords <= words:
+                matching.append(self.data[i])
 
         return matching
 
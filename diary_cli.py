@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""Command line interface to markdown-diary diaries.
+
+Lists, searches, shows, adds and exports notes without the GUI. No Qt is
+imported, and the Markdown renderer only by the export command, so the
+commands start fast enough for cron jobs and shell pipelines. Notes are
+listed one per line as tab-separated date, UUID and title. A note can be
+referred to by any unique prefix of its UUID.
+
+Usage:
+    python3 diary_cli.py diary.md list --from 2017-01 --to 2017-06
+    python3 diary_cli.py diary.md search "lorem ipsum"
+    python3 diary_cli.py diary.md show a3ea0c44
+    echo "# Title" | python3 diary_cli.py diary.md add --date 2017-01-01
+    python3 diary_cli.py diary.md export a3ea0c44 --output note.html
+    python3 diary_cli.py diary.md stats
+"""
+import os
+import sys
+import argparse
+import datetime
+import collections
+
+import segmented_diary
+
+
+def printNotes(data, output=None):
+    """Print notes one per line as tab-separated date, UUID and title.
+
+    Args:
+        data (iterable): Metadata of the notes.
+        output (file, optional): Where to print, sys.stdout by default.
+    """
+    output = output or sys.stdout
+    for datum in data:
+        output.write("{}\t{}\t{}\n".format(
+            datum.get("date", ""), datum["note_id"], datum.get("title", "")))
+
+
+def findNote(diary, noteId):
+    """Find a note by its UUID or a unique prefix of it.
+
+    Args:
+        diary (Diary or SegmentedDiary): The diary to look in.
+        noteId (str): UUID of the note or its prefix.
+
+    Returns:
+        str: The note's UUID, or None if there is no such note.
+
+    """
+    if diary.hasNote(noteId):
+        return noteId
+
+    matching = [datum["note_id"] for datum in diary.data
+                if datum["note_id"].startswith(noteId)]
+    if len(matching) > 1:
+        print("ERROR: Note ID " + noteId + " is ambiguous!", file=sys.stderr)
+        return None
+    if not matching:
+        print("ERROR: No note with ID " + noteId + "!", file=sys.stderr)
+        return None
+
+    return matching[0]
+
+
+def listNotes(diary, args):
+    """List all notes, or the notes dated within a range."""
+    if args.start is None and args.end is None:
+        printNotes(diary.data)
+    else:
+        printNotes(diary.notesBetween(args.start, args.end))
+    return 0
+
+
+def searchNotes(diary, args):
+    """List the notes containing a text."""
+    printNotes(diary.searchNotes(args.pattern))
+    return 0
+
+
+def showNote(diary, args):
+    """Print a note's Markdown text."""
+    noteId = findNote(diary, args.note_id)
+    if noteId is None:
+        return 1
+
+    sys.stdout.write(diary.getNote(noteId))
+    return 0
+
+
+def addNote(diary, args):
+    """Add a note read from a file or the standard input."""
+    if not diary.isValidDate(args.date):
+        print("ERROR: Invalid date " + args.date + "!", file=sys.stderr)
+        return 1
+    if args.note_id is not None and diary.hasNote(args.note_id):
+        print("ERROR: Note " + args.note_id + " already exists!",
+              file=sys.stderr)
+        return 1
+
+    if args.file == "-":
+        note = sys.stdin.read()
+    else:
+        with open(args.file, encoding="UTF-8") as f:
+            note = f.read()
+
+    # Imported here, as importing uuid takes longer than the other commands
+    import uuid
+
+    noteId = args.note_id or str(uuid.uuid1())
+    diary.saveNote(note, noteId, args.date)
+    if not diary.hasNote(noteId):
+        return 1
+
+    # Keep the next start fast
+    diary.saveIndexCache()
+    print(noteId)
+    return 0
+
+
+def exportNote(diary, args):
+    """Export a note to a standalone HTML page."""
+    # Imported here, so the other commands don't pay for mistune and
+    # Pygments
+    import markdown_math
+
+    noteId = findNote(diary, args.note_id)
+    if noteId is None:
+        return 1
+
+    renderer = markdown_math.HighlightRenderer()
+    toMarkdown = markdown_math.MarkdownWithMath(renderer=renderer)
+    html = markdown_math.exportHTML(markdown_math.createHTML(
+        diary.getNote(noteId), toMarkdown,
+        args.mathjax or markdown_math.MATHJAX_URL))
+
+    if args.output is None:
+        sys.stdout.write(html)
+    else:
+        with open(args.output, "w", encoding="UTF-8") as f:
+            f.write(html)
+    return 0
+
+
+def showStats(diary, args):  # pylint: disable=unused-argument
+    """Print the number of notes, their dates and the diary's size."""
+    dates = sorted(datum.get("date") or "" for datum in diary.data)
+    validDates = [date for date in dates if diary.isValidDate(date)]
+    fileNames = diary.fileNames()
+
+    print("Notes:\t{}".format(len(dates)))
+    if validDates:
+        print("First:\t{}".format(validDates[0]))
+        print("Last:\t{}".format(validDates[-1]))
+    print("Files:\t{}".format(len(fileNames)))
+    print("Bytes:\t{}".format(sum(os.path.getsize(fname)
+                                  for fname in fileNames)))
+
+    years = collections.Counter(date[:4] for date in validDates)
+    for year in sorted(years):
+        print("{}:\t{}".format(year, years[year]))
+    return 0
+
+
+COMMANDS = collections.OrderedDict([
+    ("list", listNotes),
+    ("search", searchNotes),
+    ("show", showNote),
+    ("add", addNote),
+    ("export", exportNote),
+    ("stats", showStats),
+])
+
+
+def parseArguments(argv=None):
+    """Parse command line arguments.
+
+    Args:
+        argv (list, optional): The arguments, sys.argv[1:] by default.
+
+    Returns:
+        argparse.Namespace: The parsed arguments.
+
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("diary",
+                        help="path to a diary or a segmented diary manifest")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    listParser = subparsers.add_parser(
+        "list", help="list notes, optionally only those within a date range")
+    listParser.add_argument("--from", dest="start", metavar="DATE",
+                            help="earliest date, may be just a year or month")
+    listParser.add_argument("--to", dest="end", metavar="DATE",
+                            help="latest date, may be just a year or month")
+
+    search = subparsers.add_parser(
+        "search", help="list notes containing a text (case insensitive)")
+    search.add_argument("pattern", help="text to look for")
+
+    show = subparsers.add_parser("show", help="print a note's Markdown text")
+    show.add_argument("note_id", help="UUID of the note or its prefix")
+
+    add = subparsers.add_parser(
+        "add", help="add a note and print its UUID")
+    add.add_argument("file", nargs="?", default="-",
+                     help="file with the note's Markdown text "
+                     "(default: standard input)")
+    add.add_argument("--date", default=datetime.date.today().isoformat(),
+                     help="date of the note (default: today)")
+    add.add_argument("--id", dest="note_id",
+                     help="UUID of the note (default: a new one)")
+
+    export = subparsers.add_parser(
+        "export", help="export a note to a standalone HTML page")
+    export.add_argument("note_id", help="UUID of the note or its prefix")
+    export.add_argument("--output", "-o",
+                        help="file to write (default: standard output)")
+    export.add_argument("--mathjax", default=None,
+                        help="location of MathJax (default: a CDN)")
+
+    subparsers.add_parser(
+        "stats", help="print the number of notes and the diary's size")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run a command according to command line arguments.
+
+    Args:
+        argv (list, optional): The arguments, sys.argv[1:] by default.
+
+    Returns:
+        int: The exit status.
+
+    """
+    args = parseArguments(argv)
+    if not os.path.isfile(args.diary):
+        print("ERROR: No diary " + args.diary + "!", file=sys.stderr)
+        return 1
+
+    # Share the GUI's sidecar index, so big diaries don't need parsing
+    diary = segmented_diary.openDiary(args.diary, lazy=True, cacheIndex=True)
+    try:
+        return COMMANDS[args.command](diary, args)
+    except BrokenPipeError:
+        # The output was cut short (e.g., by `head`), silence the error
+        # Python would print when flushing it at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    finally:
+        diary.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
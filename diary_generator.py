@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""Generator of synthetic diaries for benchmarking and testing.
+
+The generated diaries have the same format as the ones written by
+markdown-diary. Note contents are random, but reproducible for a given seed,
+and can contain code blocks and math, so all of the rendering paths get
+exercised.
+
+Usage:
+    python3 diary_generator.py diary.md --notes 10000 --note-size 2000
+"""
+import argparse
+import datetime
+import random
+import uuid
+
+import diary
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua enim "
+         "ad minim veniam quis nostrud exercitation ullamco laboris nisi "
+         "aliquip ex ea commodo consequat duis aute irure in reprehenderit "
+         "voluptate velit esse cillum fugiat nulla pariatur").split()
+
+CODE_BLOCKS = (
+    ("python",
+     "def fibonacci(n):\n"
+     "    a, b = 0, 1\n"
+     "    for _ in range(n):\n"
+     "        a, b = b, a + b\n"
+     "    return a\n"),
+    ("c++",
+     "#include <vector>\n"
+     "int sum(const std::vector<int>& v) {\n"
+     "    int s = 0;\n"
+     "    for (int x : v) s += x;\n"
+     "    return s;\n"
+     "}\n"),
+    ("bash",
+     "for f in *.md; do\n"
+     "    wc -l \"$f\"\n"
+     "done\n"),
+)
+
+MATH_INLINE = ("$e^{i\\pi} + 1 = 0$", "$\\sqrt{a^2 + b^2}$",
+               "$\\alpha \\beta \\gamma$")
+
+MATH_BLOCKS = ("$$\n\\int_0^\\infty e^{-x^2} dx = "
+               "\\frac{\\sqrt{\\pi}}{2}\n$$\n",
+               "$$\n\\sum_{n=1}^\\infty \\frac{1}{n^2} = \\frac{\\pi^2}{6}\n"
+               "$$\n")
+
+
+def generateNote(rng, number, noteSize=1000, codeFraction=0.1,
+                 mathFraction=0.1):
+    """Generate the text of a single note.
+
+    Args:
+        rng (random.Random): Source of randomness.
+        number (int): Number of the note, used in its title.
+        noteSize (int, optional): Approximate length of the note in
+            characters.
+        codeFraction (float, optional): Probability of the note containing a
+            code block.
+        mathFraction (float, optional): Probability of the note containing
+            math.
+
+    Returns:
+        The note's Markdown text, ending with a newline.
+
+    """
+    parts = ["# Note {} {}\n\n".format(number, rng.choice(WORDS).title())]
+
+    if rng.random() < codeFraction:
+        language, code = rng.choice(CODE_BLOCKS)
+        parts.append("```{}\n{}```\n\n".format(language, code))
+
+    if rng.random() < mathFraction:
+        parts.append("Inline {} math.\n\n".format(rng.choice(MATH_INLINE)))
+        parts.append(rng.choice(MATH_BLOCKS) + "\n")
+
+    size = sum(len(part) for part in parts)
+    while size < noteSize:
+        paragraph = " ".join(rng.choice(WORDS) for _ in range(
+            rng.randint(20, 80))).capitalize() + ".\n\n"
+        parts.append(paragraph)
+        size += len(paragraph)
+
+    return "".join(parts).rstrip("\n") + "\n"
+
+
+def generateDiary(fname, notes=1000, noteSize=1000, codeFraction=0.1,
+                  mathFraction=0.1, seed=0):
+    """Write a synthetic diary to a file.
+
+    The notes are written one at a time, so even diaries with millions of
+    notes can be generated without keeping them in memory.
+
+    Args:
+        fname (str): Path to the diary to be written.
+        notes (int, optional): Number of notes.
+        noteSize (int, optional): Approximate length of each note in
+            characters.
+        codeFraction (float, optional): Fraction of notes containing a code
+            block.
+        mathFraction (float, optional): Fraction of notes containing math.
+        seed (int, optional): Seed of the random number generator.
+
+    Returns:
+        A list of the generated notes' UUIDs, in the order they appear in
+        the diary.
+
+    """
+    rng = random.Random(seed)
+    firstDate = datetime.date(2000, 1, 1)
+    noteIds = []
+
+    with open(fname, "w", encoding="UTF-8", newline="") as f:
+        for i in range(notes):
+            noteId = str(uuid.UUID(int=rng.getrandbits(128), version=1))
+            noteDate = (firstDate + datetime.timedelta(
+                days=i * 3650 // max(notes, 1))).isoformat()
+            f.write(diary.Diary.createNoteHeader(noteId, noteDate))
+            f.write(generateNote(rng, i, noteSize, codeFraction,
+                                 mathFraction))
+            noteIds.append(noteId)
+
+    return noteIds
+
+
+def main():
+    """Generate a diary according to command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("fname", help="path to the diary to be written")
+    parser.add_argument("--notes", type=int, default=1000,
+                        help="number of notes (default: %(default)s)")
+    parser.add_argument("--note-size", type=int, default=1000,
+                        help="approximate note length in characters "
+                        "(default: %(default)s)")
+    parser.add_argument("--code", type=float, default=0.1,
+                        help="fraction of notes with a code block "
+                        "(default: %(default)s)")
+    parser.add_argument("--math", type=float, default=0.1,
+                        help="fraction of notes with math "
+                        "(default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed (default: %(default)s)")
+    args = parser.parse_args()
+
+    generateDiary(args.fname, args.notes, args.note_size, args.code,
+                  args.math, args.seed)
+
+
+if __name__ == "__main__":
+    main()
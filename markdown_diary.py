@@ -9,8 +9,9 @@ syntax highlighting.
 import os
 import sys
 import uuid
-import re
 import datetime
+import threading
+import concurrent.futures
 
 from PyQt5 import QtGui, QtCore
 from PyQt5 import QtWidgets
@@ -20,8 +21,8 @@ from PyQt5.QtWebEngineWidgets import QWebEngineSettings
 
 from markdownhighlighter import MarkdownHighlighter
 import markdown_math
-import style
-import diary
+import segmented_diary
+from render_cache import RenderCache
 
 
 class DummyItemDelegate(QtWidgets.QItemDelegate):  # pylint: disable=too-few-public-methods
@@ -111,7 +112,7 @@ class MyWebEnginePage(QWebEnginePage):
         For some reason all links that don't have 'http://' or similar
         prepended, have 'file://' and the diary dir automatically prepended.
         I believe the reason is the following line in
-        displayHTMLRenderedMarkdown():
+        displayHTML():
 
         self.web.setHtml(html, baseUrl=QtCore.QUrl.fromLocalFile(mainPath))
 
@@ -136,6 +137,149 @@ class MyWebEnginePage(QWebEnginePage):
                 return False
 
 
+class DiaryWatcher(QtCore.QObject):
+    """Watches the files of a diary and reloads changes made by others.
+
+    Syncing tools often change a file in several steps, so the diary is
+    reloaded only once the changes settle for a while. The diary's own
+    saves are recognized by Diary.reloadFromDisk() and cost nothing.
+    """
+
+    diaryChanged = QtCore.pyqtSignal()
+
+    # Time the changes have to settle for before reloading, in ms
+    delay = 200
+
+    def __init__(self, diary, parent=None):
+        """Start watching the files of a diary.
+
+        Args:
+            diary (Diary or SegmentedDiary): The diary to be watched.
+            parent (QObject, optional): Parent of the watcher.
+        """
+        super().__init__(parent)
+        self.diary = diary
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(self.delay)
+        self.timer.timeout.connect(self.reload)
+
+        self.watcher = QtCore.QFileSystemWatcher(self)
+        # Not a lambda, which would keep the watcher alive in a reference
+        # cycle, to be freed by the garbage collector while handling a signal
+        self.watcher.fileChanged.connect(self.fileChanged)
+        self.watchFiles()
+
+    def watchFiles(self):
+        """Watch all the diary's files that aren't watched yet.
+
+        Files replaced by renaming another file over them (as syncing tools
+        and our own saves do) are dropped from the watcher, so they have to
+        be added again.
+        """
+        watched = set(self.watcher.files())
+        paths = [path for path in self.diary.fileNames()
+                 if path not in watched and os.path.exists(path)]
+        if paths:
+            self.watcher.addPaths(paths)
+
+    def fileChanged(self, path):  # pylint: disable=unused-argument
+        """Reload the diary once the changes of a file settle."""
+        self.timer.start()
+
+    def reload(self):
+        """Reload the changes of the diary and announce them, if any."""
+        self.watchFiles()
+        if self.diary.reloadFromDisk():
+            self.diaryChanged.emit()
+
+    def stop(self):
+        """Stop watching the diary."""
+        self.timer.stop()
+        if self.watcher.files():
+            self.watcher.removePaths(self.watcher.files())
+
+
+class RenderWorker(QtCore.QObject):
+    """Renders notes to HTML in a background thread.
+
+    Rendering big notes takes long enough to freeze the UI, so it is done by
+    a single worker thread. Requests coalesce: a request supersedes the one
+    still waiting to be rendered, and the results of superseded requests
+    are dropped, so only the latest requested note gets displayed.
+    """
+
+    rendered = QtCore.pyqtSignal(str)
+
+    # Emitted by the worker thread, delivered in the worker's (GUI) thread
+    renderFinished = QtCore.pyqtSignal(int, str)
+
+    def __init__(self, render, parent=None):
+        """Start a worker without any requests.
+
+        Args:
+            render (function): Creates an HTML page from Markdown text.
+            parent (QObject, optional): Parent of the worker.
+        """
+        super().__init__(parent)
+        self.render = render
+        self.lock = threading.Lock()
+        self.request = 0
+        self.pending = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.renderFinished.connect(self.deliver)
+
+    def requestRender(self, markdownText):
+        """Render Markdown text, emitting rendered once it's done.
+
+        Args:
+            markdownText (str): Markdown source to convert to HTML.
+        """
+        with self.lock:
+            self.request += 1
+            scheduled = self.pending is not None
+            self.pending = (self.request, markdownText)
+
+        if not scheduled:
+            self.executor.submit(self.renderPending)
+
+    def renderPending(self):
+        """Render the latest request (in the worker thread)."""
+        with self.lock:
+            if self.pending is None:
+                return
+            request, markdownText = self.pending
+            self.pending = None
+
+        try:
+            html = self.render(markdownText)
+        except Exception as error:  # pylint: disable=broad-except
+            print("ERROR: Couldn't render the note: " + str(error))
+            return
+
+        with self.lock:
+            if request != self.request:
+                return
+        self.renderFinished.emit(request, html)
+
+    def deliver(self, request, html):
+        """Emit rendered, unless a newer note was requested meanwhile."""
+        if request == self.request:
+            self.rendered.emit(html)
+
+    def cancel(self):
+        """Drop the pending request and the one being rendered."""
+        with self.lock:
+            self.request += 1
+            self.pending = None
+
+    def stop(self):
+        """Drop all requests and let the worker thread finish."""
+        self.cancel()
+        self.executor.shutdown(wait=False)
+
+
 class DiaryApp(QtWidgets.QMainWindow):  # pylint: disable=too-many-public-methods,too-many-instance-attributes
     """Diary application class inheriting from QMainWindow."""
 
@@ -165,11 +309,27 @@ class DiaryApp(QtWidgets.QMainWindow):  # pylint: disable=too-many-public-method
         self.recentDiaries = None
         self.recentNotes = None
         self.diary = None
+        self.diaryWatcher = None
+        # Base URL the preview's page shell was loaded with
+        self.shellUrl = None
+        # Script displaying a note once the page shell is loaded
+        self.shellScript = None
+        # Notes being displayed in the page shell, see webNoteDisplayed()
+        self.pendingDisplays = 0
+        # Arguments of printToPdf() waiting for the note to be displayed
+        self.pendingPdf = None
 
         QtWidgets.QMainWindow.__init__(self, parent)
 
         renderer = markdown_math.HighlightRenderer()
         self.toMarkdown = markdown_math.MarkdownWithMath(renderer=renderer)
+        self.renderCache = RenderCache()
+        self.renderConfiguration = markdown_math.renderConfiguration()
+        # Notes are rendered by renderWorker's thread, but exported by this
+        # one
+        self.renderLock = threading.Lock()
+        self.renderWorker = RenderWorker(self.createHTML, self)
+        self.renderWorker.rendered.connect(self.displayHTML)
 
         self.tempFiles = []
 
@@ -210,6 +370,10 @@ class DiaryApp(QtWidgets.QMainWindow):  # pylint: disable=too-many-public-method
             elif reply == QtWidgets.QMessageBox.Save:
                 self.saveNote()
 
+        self.renderWorker.stop()
+        if self.diary is not None:
+            self.diary.saveIndexCache()
+
         self.writeSettings()
 
     def initUI(self):
@@ -419,8 +583,17 @@ class DiaryApp(QtWidgets.QMainWindow):  # pylint: disable=too-many-public-method
         self.addToolBar(QtCore.Qt.ToolBarArea(toolBarArea), self.toolbar)
 
         self.mathjax = self.settings.value(
-            "mathjax/location",
-            "https://cdnjs.cloudflare.com/ajax/libs/mathjax/2.7.1/MathJax.js")
+            "mathjax/location", markdown_math.MATHJAX_URL)
+        self.renderConfiguration = markdown_math.renderConfiguration(
+            self.mathjax)
+
+        # Rendered notes are only stored on disk if asked for, as the cache
+        # holds the notes' contents unencrypted
+        if self.settings.value("render/disk_cache", False, type=bool):
+            cacheDir = QtCore.QStandardPaths.writableLocation(
+                QtCore.QStandardPaths.CacheLocation)
+            self.renderCache = RenderCache(
+                directory=os.path.join(cacheDir, "rendered"))
 
     def writeSettings(self):
         """Save settings via self.settings QSettings object."""
@@ -448,6 +621,10 @@ class DiaryApp(QtWidgets.QMainWindow):  # pylint: disable=too-many-public-method
     def createHTML(self, markdownText):
         """Create full, valid HTML from Markdown source.
 
+        Recently rendered notes are taken from self.renderCache, so
+        switching between notes doesn't render them again. Safe to call
+        from any thread.
+
         Args:
             markdownText (str): Markdown source to convert to HTML.
 
@@ -455,37 +632,60 @@ class DiaryApp(QtWidgets.QMainWindow):  # pylint: disable=too-many-public-method
             Full HTML page text.
 
         """
-        html = style.header
-
-        # We load MathJax only when there is a good chance there is
-        # math in the note. We first perform inline math search as
-        # as that should be faster then the re.DOTALL multiline
-        # block math search, which gets executed only if we don't
-        # find inline math.
-        mathInline = re.compile(r"\$(.+?)\$")
-        mathBlock = re.compile(r"^\$\$(.+?)^\$\$",
-                               re.DOTALL | re.MULTILINE)
-
-        if mathInline.search(markdownText) or mathBlock.search(markdownText):
-
-            html += style.mathjax
-            mathjaxScript = (
-                '<script type="text/javascript" src="{}?config='
-                'TeX-AMS-MML_HTMLorMML"></script>\n').format(self.mathjax)
-            html += mathjaxScript
-
-        html += self.toMarkdown(markdownText)  # pylint: disable=not-callable
-        html += style.footer
+        with self.renderLock:
+            key = self.renderCache.key(markdownText, self.renderConfiguration)
+            html = self.renderCache.get(key)
+            if html is None:
+                html = markdown_math.createHTML(
+                    markdownText, self.toMarkdown, self.mathjax)
+                self.renderCache.put(key, html)
+
         return html
 
-    def displayHTMLRenderedMarkdown(self, markdownText):
-        """Display HTML rendered Markdown."""
-        html = self.createHTML(markdownText)
+    def displayHTMLRenderedMarkdown(self, markdownText, wait=False):
+        """Display HTML rendered Markdown.
+
+        The Markdown is rendered in the background, see RenderWorker, and
+        the HTML displayed once it's ready.
 
+        Args:
+            markdownText (str): Markdown source to display.
+            wait (bool, optional): Render in this thread, passing the HTML
+                to the preview right away. The preview shows it once
+                webNoteDisplayed() is called.
+        """
+        if wait:
+            self.renderWorker.cancel()
+            self.displayHTML(self.createHTML(markdownText))
+        else:
+            self.renderWorker.requestRender(markdownText)
+
+    def displayHTML(self, html):
+        """Display an HTML page created by createHTML().
+
+        Instead of loading the page, just its body is swapped into a page
+        shell loaded once per diary (see markdown_math.createShell()), so
+        the stylesheets and MathJax aren't loaded again for each note.
+        """
         # QWebEngineView resolves relative links (like images and stylesheets)
         # with respect to the baseUrl
         mainPath = self.diary.fname
-        self.web.setHtml(html, baseUrl=QtCore.QUrl.fromLocalFile(mainPath))
+        baseUrl = QtCore.QUrl.fromLocalFile(mainPath)
+
+        body, math = markdown_math.splitHTML(html, self.mathjax)
+        script = markdown_math.showNoteScript(body, math, self.mathjax)
+        if self.shellUrl != baseUrl:
+            self.shellUrl = baseUrl
+            self.shellScript = script
+            # Scripts still running in the old shell don't matter anymore
+            self.pendingDisplays = 0
+            self.web.setHtml(markdown_math.createShell(), baseUrl=baseUrl)
+        elif self.shellScript is not None:
+            # The shell is still loading
+            self.shellScript = script
+        else:
+            self.pendingDisplays += 1
+            self.web.page().runJavaScript(script, self.webNoteDisplayed)
 
     def newNote(self):
         """Create an empty note and add it to the QTreeWidget.
@@ -520,6 +720,12 @@ class DiaryApp(QtWidgets.QMainWindow):  # pylint: disable=too-many-public-method
                 self, 'Message', "You can't save an empty note!")
             return
 
+        if self.diary.isChangedOnDisk():
+            QtWidgets.QMessageBox.warning(
+                self, 'Message', "The diary was changed by another program, "
+                "the note can't be saved!")
+            return
+
         # Notes should begin with a title, so strip any whitespace,
         # including newlines from the beggining
         self.diary.saveNote(
@@ -596,7 +802,8 @@ class DiaryApp(QtWidgets.QMainWindow):  # pylint: disable=too-many-public-method
 
         fname = QtWidgets.QFileDialog.getSaveFileName(
             caption="Create a New Diary",
-            filter="Markdown Files (*.md);;All Files (*)")[0]
+            filter="Markdown Files (*.md);;"
+            "Compressed Diaries (*.md.gz *.md.xz *.md.bz2);;All Files (*)")[0]
 
         if fname:
             with open(fname, 'w'):
@@ -625,7 +832,9 @@ class DiaryApp(QtWidgets.QMainWindow):  # pylint: disable=too-many-public-method
 
         fname = QtWidgets.QFileDialog.getOpenFileName(
             caption="Open Diary",
-            filter="Markdown Files (*.md);;All Files (*)")[0]
+            filter="Markdown Files (*.md);;"
+            "Compressed Diaries (*.md.gz *.md.xz *.md.bz2);;"
+            "Segmented Diaries (*.json);;All Files (*)")[0]
 
         if fname:
             if self.isValidDiary(fname):
@@ -677,7 +886,16 @@ class DiaryApp(QtWidgets.QMainWindow):  # pylint: disable=too-many-public-method
                 self.saveNote()
 
         self.updateRecentDiaries(fname)
-        self.diary = diary.Diary(fname)
+        # Keep the sidecar index of the previous diary up to date, so it
+        # opens quickly next time
+        if self.diary is not None:
+            self.diary.saveIndexCache()
+        self.diary = segmented_diary.openDiary(fname, cacheIndex=True)
+
+        if self.diaryWatcher is not None:
+            self.diaryWatcher.stop()
+        self.diaryWatcher = DiaryWatcher(self.diary, self)
+        self.diaryWatcher.diaryChanged.connect(self.diaryChangedOnDisk)
 
         # Save the diary path to QWebEnginePage, so we can fix external links,
         # which (for some reason) look like file://DIARY_PATH/EXTERNAL_LINK
@@ -695,7 +913,7 @@ class DiaryApp(QtWidgets.QMainWindow):  # pylint: disable=too-many-public-method
         # did, otherwise open the newest note
         lastNoteId = ""
         for recentNote in self.recentNotes:
-            if recentNote in (metaDict["note_id"] for metaDict in self.diary.data):
+            if self.diary.hasNote(recentNote):
                 lastNoteId = recentNote
                 break
 
@@ -822,7 +1040,7 @@ class DiaryApp(QtWidgets.QMainWindow):  # pylint: disable=too-many-public-method
 
         if self.searchLine.text() != "":
             # Search in the editor (searching in WebView happens
-            # asynchronously, once the page is loaded)
+            # asynchronously, once the note is displayed)
             self.text.highlightSearch(self.searchLine.text())
 
     def displayNote(self, noteId):
@@ -834,6 +1052,27 @@ class DiaryApp(QtWidgets.QMainWindow):  # pylint: disable=too-many-public-method
         self.noteDate = self.diary.getNoteMetadata(noteId)["date"]
         self.displayHTMLRenderedMarkdown(self.text.toPlainText())
 
+    def diaryChangedOnDisk(self):
+        """Refresh the tree and the displayed note after an external change.
+
+        A note being edited is left alone, saving it overwrites the external
+        changes of the note.
+        """
+        if self.searchLine.text() == "":
+            self.loadTree(self.diary.data)
+        else:
+            self.loadTree(self.diary.searchNotes(self.searchLine.text()))
+
+        if self.noteId is None or not self.diary.hasNote(self.noteId):
+            return
+
+        if self.tree.findItems(self.noteId, QtCore.Qt.MatchExactly):
+            self.selectItemWithoutReload(self.noteId)
+
+        if (not self.text.document().isModified() and
+                self.diary.getNote(self.noteId) != self.text.toPlainText()):
+            self.displayNote(self.noteId)
+
     def selectSearch(self):
         """Focus the search widget and select its contents."""
         self.searchLine.setFocus()
@@ -859,7 +1098,11 @@ class DiaryApp(QtWidgets.QMainWindow):  # pylint: disable=too-many-public-method
         # Search in the WebView
         self.web.findText(self.searchLine.text())
 
-        # Search for matching notes
+        # Search for matching notes. The word index is only built once it is
+        # needed, so it doesn't slow down opening diaries. The trigram index
+        # would freeze the GUI for seconds and take gigabytes of memory on
+        # big diaries, so it isn't used.
+        self.diary.buildSearchIndexes(trigramIndex=False)
         entries = self.diary.searchNotes(self.searchLine.text())
         self.loadTree(entries)
 
@@ -929,25 +1172,7 @@ class DiaryApp(QtWidgets.QMainWindow):  # pylint: disable=too-many-public-method
     def exportToHTML(self):
         """Export the displayed note to HTML."""
         markdownText = self.diary.getNote(self.noteId)
-        html = self.createHTML(markdownText)
-
-        # To be able to load the CSS during normal operation correctly, we have
-        # to use an absolute path. This is not desirable when exporting to
-        # HTML, so we change it to a relative path.
-        newhtml = ""
-        stillInHead = True
-        for line in html.splitlines():
-            if stillInHead:
-                if "github-markdown.css" in line:
-                    newhtml += '<link rel="stylesheet" href="css/github-markdown.css">\n'
-                elif "github-pygments.css" in line:
-                    newhtml += '<link rel="stylesheet" href="css/github-pygments.css">\n'
-                else:
-                    newhtml += line + '\n'
-                    if "</head>" in line:
-                        stillInHead = False
-            else:
-                newhtml += line + '\n'
+        newhtml = markdown_math.exportHTML(self.createHTML(markdownText))
 
         fname = QtWidgets.QFileDialog.getSaveFileName(
             caption="Export Note to HTML",
@@ -967,17 +1192,43 @@ class DiaryApp(QtWidgets.QMainWindow):  # pylint: disable=too-many-public-method
         if fname:
             # Make sure we export the current version of the text
             if self.stack.currentIndex() == 0:
-                self.displayHTMLRenderedMarkdown(self.text.toPlainText())
+                self.displayHTMLRenderedMarkdown(self.text.toPlainText(),
+                                                 wait=True)
 
             pageLayout = QtGui.QPageLayout(QtGui.QPageSize(
                 QtGui.QPageSize.A4), QtGui.QPageLayout.Landscape, QtCore.QMarginsF(0, 0, 0, 0))
-            self.web.page().printToPdf(fname, pageLayout)
-
-    def webLoadFinished(self):
+            self.pendingPdf = (fname, pageLayout)
+            if self.pendingDisplays == 0 and self.shellScript is None:
+                self.printPendingPdf()
+            # Otherwise printed once the note is displayed
+
+    def printPendingPdf(self):
+        """Print the page to the PDF requested by exportToPDF()."""
+        fname, pageLayout = self.pendingPdf
+        self.pendingPdf = None
+        self.web.page().printToPdf(fname, pageLayout)
+
+    def webLoadFinished(self, ok=True):
+        if not ok:
+            # Load the shell again next time
+            self.shellUrl = None
+        elif self.shellScript is not None:
+            script = self.shellScript
+            self.shellScript = None
+            self.pendingDisplays += 1
+            self.web.page().runJavaScript(script, self.webNoteDisplayed)
+
+    def webNoteDisplayed(self, _result=None):
+        self.pendingDisplays = max(self.pendingDisplays - 1, 0)
         if self.searchLine.text() != "":
             # Search in the WebView
             self.web.findText(self.searchLine.text())
 
+        # The scripts run in order, so the last one shows the exported note
+        if (self.pendingPdf is not None and self.pendingDisplays == 0 and
+                self.shellScript is None):
+            self.printPendingPdf()
+
     def __del__(self):
         """Clean up temporary files on exit."""
         # Delete temporary files
@@ -24,26 +24,77 @@
 
 
 import re
+import json
+import threading
 import mistune
 import pygments
 from pygments.lexers import get_lexer_by_name
 from pygments.formatters import html
 
+import style
+from render_cache import RenderCache
+
+# MathJax loaded by pages with math, unless configured otherwise
+MATHJAX_URL = ("https://cdnjs.cloudflare.com/ajax/libs/mathjax/2.7.1/"
+               "MathJax.js")
+MATHJAX_CONFIG = "TeX-AMS-MML_HTMLorMML"
+
+# We load MathJax only when there is a good chance there is math in the
+# note. We first perform inline math search as that should be faster then
+# the re.DOTALL multiline block math search, which gets executed only if we
+# don't find inline math.
+reMathInline = re.compile(r"\$(.+?)\$")
+reMathBlock = re.compile(r"^\$\$(.+?)^\$\$", re.DOTALL | re.MULTILINE)
+
 
 class HighlightRenderer(mistune.Renderer):
 
+    # Shared by all renderers for the whole process: looking lexers up in
+    # Pygments' plugin registry is slow, and so is highlighting the same
+    # code blocks again each time a note is rendered
+    lexers = {}
+    formatter = html.HtmlFormatter()
+    highlightCache = RenderCache(maxSize=4 << 20)
+    # Notes may be rendered by several threads
+    lock = threading.Lock()
+
     def block_code(self, code, lang):
         if not lang:
             return '\n<pre><code>%s</code></pre>\n' % \
                 mistune.escape(code)
-        try:
-            lexer = get_lexer_by_name(lang, stripall=True)
-        except pygments.util.ClassNotFound:
+        lexer = self.getLexer(lang)
+        if lexer is None:
             return '\n<pre><code>%s</code></pre>\n' % \
                 mistune.escape(code)
 
-        formatter = html.HtmlFormatter()
-        return pygments.highlight(code, lexer, formatter)
+        key = RenderCache.key(code, lang)
+        with self.lock:
+            highlighted = self.highlightCache.get(key)
+        if highlighted is None:
+            highlighted = pygments.highlight(code, lexer, self.formatter)
+            with self.lock:
+                self.highlightCache.put(key, highlighted)
+
+        return highlighted
+
+    @classmethod
+    def getLexer(cls, lang):
+        """Get the shared lexer of a language.
+
+        Args:
+            lang (str): Name or alias of the language.
+
+        Returns:
+            The Pygments lexer, or None if the language isn't known.
+
+        """
+        if lang not in cls.lexers:
+            try:
+                cls.lexers[lang] = get_lexer_by_name(lang, stripall=True)
+            except pygments.util.ClassNotFound:
+                cls.lexers[lang] = None
+
+        return cls.lexers[lang]
 
     # Pass math through unaltered - mathjax does the rendering in the browser
     def block_math(self, text):
@@ -85,6 +136,25 @@ class MathBlockLexer(mistune.BlockLexer):
             'text': m.group(2)
         })
 
+    def parseBlock(self, text):
+        """Parse the first top-level block of text.
+
+        Args:
+            text (str): Preprocessed Markdown text.
+
+        Returns:
+            tuple: The block's source and its tokens.
+
+        """
+        self.tokens = []
+        for rule in self.default_rules:
+            m = getattr(self.rules, rule).match(text)
+            if m:
+                getattr(self, 'parse_%s' % rule)(m)
+                return m.group(0), self.tokens
+
+        raise RuntimeError('Infinite loop at: %s' % text)
+
 
 class MathInlineGrammar(mistune.InlineGrammar):
     math = re.compile(r"^\$(.+?)\$", re.DOTALL)
@@ -108,12 +178,121 @@ class MathInlineLexer(mistune.InlineLexer):
 
 
 class MarkdownWithMath(mistune.Markdown):
+    """Markdown parser with math, rendering notes incrementally.
+
+    Notes are split into top-level blocks, whose HTML is cached by their
+    source, so after an edit only the changed blocks are rendered again.
+    The blocks after the edit aren't even lexed again, see splitBlocks().
+    The output is identical to rendering the whole note.
+    """
+
     def __init__(self, renderer, **kwargs):
         if 'inline' not in kwargs:
             kwargs['inline'] = MathInlineLexer
         if 'block' not in kwargs:
             kwargs['block'] = MathBlockLexer
         super(MarkdownWithMath, self).__init__(renderer, **kwargs)
+        self.blockCache = RenderCache(maxSize=8 << 20)
+        self.lastText = ""
+        self.lastBlocks = []
+
+    def parse(self, text):
+        """Render Markdown text to HTML, reusing unchanged blocks.
+
+        Reference links and footnotes are defined for the whole note, so
+        notes defining them are rendered in full.
+
+        Args:
+            text (str): Markdown source.
+
+        Returns:
+            str: The HTML.
+
+        """
+        text = mistune.preprocessing(text).rstrip('\n')
+        blocks = self.splitBlocks(text)
+
+        if self.block.def_links or self.block.def_footnotes:
+            self.block.def_links = {}
+            self.block.def_footnotes = {}
+            self.block.tokens = []
+            self.lastText = ""
+            self.lastBlocks = []
+            return super(MarkdownWithMath, self).parse(text)
+
+        self.inline.setup(None, None)
+        for index, (source, tokens) in enumerate(blocks):
+            if isinstance(tokens, str):
+                continue
+            key = RenderCache.key(source)
+            blockHtml = self.blockCache.get(key)
+            if blockHtml is None:
+                blockHtml = self.renderTokens(tokens)
+                self.blockCache.put(key, blockHtml)
+            blocks[index] = (source, blockHtml)
+
+        self.lastText = text
+        self.lastBlocks = blocks
+        return "".join(blockHtml for _, blockHtml in blocks)
+
+    def splitBlocks(self, text):
+        """Split Markdown text into top-level blocks.
+
+        Lexing from the start of a block depends only on the text after it.
+        So once the lexer gets to where a block of the last text started,
+        followed by the same text as then, the last text's remaining blocks
+        are reused, already rendered. So are the blocks before that with
+        the same source as the last text's blocks at the same places.
+
+        Args:
+            text (str): Preprocessed Markdown text.
+
+        Returns:
+            list: Source of each block, with its HTML if it's reused, or
+            its tokens otherwise.
+
+        """
+        suffix = commonSuffixLength(text, self.lastText)
+        shift = len(text) - len(self.lastText)
+        reusable = {}
+        start = len(self.lastText)
+        for index in range(len(self.lastBlocks) - 1, -1, -1):
+            start -= len(self.lastBlocks[index][0])
+            if start < len(self.lastText) - suffix:
+                break
+            reusable[start + shift] = index
+
+        blocks = []
+        position = 0
+        while position < len(text):
+            if position in reusable:
+                blocks.extend(self.lastBlocks[reusable[position]:])
+                break
+            source, tokens = self.block.parseBlock(text[position:])
+            if not tokens:
+                tokens = ""
+            elif len(blocks) < len(self.lastBlocks):
+                lastSource, lastHtml = self.lastBlocks[len(blocks)]
+                if lastSource == source:
+                    tokens = lastHtml
+            blocks.append((source, tokens))
+            position += len(source)
+
+        return blocks
+
+    def renderTokens(self, tokens):
+        """Render the tokens of a block to HTML."""
+        self.tokens = list(reversed(tokens))
+        html = self.renderer.placeholder()
+        while self.pop():
+            html += self.tok()
+        return html
+
+    def clearCache(self):
+        """Forget all rendered blocks, rendering the next note in full."""
+        self.blockCache.clear()
+        self.lastText = ""
+        self.lastBlocks = []
 
     def output_block_math(self):
         return self.renderer.block_math(self.token['text'])
@@ -121,3 +300,159 @@ class MarkdownWithMath(mistune.Markdown):
     def output_latex_environment(self):
         return self.renderer.latex_environment(self.token['name'],
                                                self.token['text'])
+
+
+def commonSuffixLength(first, second):
+    """Get the length of the longest common suffix of two strings."""
+    low, high = 0, min(len(first), len(second))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if first.endswith(second[len(second) - middle:]):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def createHTML(markdownText, toMarkdown, mathjax=MATHJAX_URL):
+    """Create full, valid HTML from Markdown source.
+
+    Args:
+        markdownText (str): Markdown source to convert to HTML.
+        toMarkdown (MarkdownWithMath): Markdown renderer to use.
+        mathjax (str, optional): Location of MathJax, loaded by notes
+            containing math.
+
+    Returns:
+        Full HTML page text.
+
+    """
+    html = style.header
+
+    if reMathInline.search(markdownText) or reMathBlock.search(markdownText):
+        html += mathjaxHeader(mathjax)
+
+    html += toMarkdown(markdownText)
+    html += style.footer
+    return html
+
+
+def mathjaxHeader(mathjax=MATHJAX_URL):
+    """Get the HTML loading MathJax in pages with math.
+
+    Args:
+        mathjax (str, optional): Location of MathJax.
+
+    Returns:
+        str: The HTML, put at the beginning of the page's body.
+
+    """
+    return style.mathjax + (
+        '<script type="text/javascript" src="{}?config={}"></script>\n'
+        ).format(mathjax, MATHJAX_CONFIG)
+
+
+def splitHTML(html, mathjax=MATHJAX_URL):
+    """Split an HTML page created by createHTML() into its body and whether
+    it has math.
+
+    Args:
+        html (str): The HTML page.
+        mathjax (str, optional): Location of MathJax, as passed to
+            createHTML().
+
+    Returns:
+        tuple: The body, without the HTML loading MathJax, and True if the
+        page has math.
+
+    """
+    body = html[len(style.header):len(html) - len(style.footer)]
+    header = mathjaxHeader(mathjax)
+    if body.startswith(header):
+        return body[len(header):], True
+
+    return body, False
+
+
+def createShell():
+    """Create the page shell notes are displayed in by showNoteScript().
+
+    The shell is a createHTML() page with an empty body, so the stylesheets
+    are loaded just once, and not again for each displayed note. MathJax
+    gets loaded by the first note with math, and then stays loaded.
+
+    Returns:
+        str: The HTML page.
+
+    """
+    return style.header.replace(
+        "</head>", style.mathjax + style.preview + "</head>") + style.footer
+
+
+def showNoteScript(body, math, mathjax=MATHJAX_URL):
+    """Create JavaScript displaying a note in the page from createShell().
+
+    Args:
+        body (str): The note's HTML, see splitHTML().
+        math (bool): Whether the note has math to be typeset by MathJax.
+        mathjax (str, optional): Location of MathJax.
+
+    Returns:
+        str: The script.
+
+    """
+    return "showNote({}, {}, {});".format(
+        json.dumps(body), json.dumps(math),
+        json.dumps("{}?config={}".format(mathjax, MATHJAX_CONFIG)))
+
+
+def renderConfiguration(mathjax=MATHJAX_URL):
+    """Describe everything besides the Markdown source createHTML() output
+    depends on.
+
+    Used to key cached pages, see render_cache.RenderCache.
+
+    Args:
+        mathjax (str, optional): Location of MathJax, as passed to
+            createHTML().
+
+    Returns:
+        str: The description.
+
+    """
+    return "\0".join((mistune.__version__, pygments.__version__, mathjax,
+                      style.header, style.mathjax, style.footer))
+
+
+def exportHTML(html):
+    """Prepare an HTML page created by createHTML() to be exported.
+
+    To be able to load the CSS during normal operation correctly, the page
+    uses absolute paths. This is not desirable when exporting to HTML, so
+    they are changed to relative paths.
+
+    Args:
+        html (str): The HTML page.
+
+    Returns:
+        The HTML page with relative stylesheet links.
+
+    """
+    newhtml = ""
+    stillInHead = True
+    for line in html.splitlines():
+        if stillInHead:
+            if "github-markdown.css" in line:
+                newhtml += ('<link rel="stylesheet" '
+                            'href="css/github-markdown.css">\n')
+            elif "github-pygments.css" in line:
+                newhtml += ('<link rel="stylesheet" '
+                            'href="css/github-pygments.css">\n')
+            else:
+                newhtml += line + '\n'
+                if "</head>" in line:
+                    stillInHead = False
+        else:
+            newhtml += line + '\n'
+
+    return newhtml
@@ -0,0 +1,166 @@
+"""Module containing the cache of notes rendered to HTML."""
+import os
+import hashlib
+import tempfile
+import collections
+
+
+class RenderCache():
+    """Size-bounded LRU cache of rendered HTML pages.
+
+    Pages are keyed by a hash of their Markdown source and of everything
+    else the rendering depends on (see key()), so an entry never has to be
+    invalidated, it just stops being used. The least recently used pages
+    are evicted once the cached pages exceed maxSize characters.
+
+    Optionally, pages are also stored as files in a directory, so they
+    survive restarts. The files are evicted the same way, by their
+    modification time, which is updated whenever a file is used.
+    """
+
+    def __init__(self, maxSize=16 << 20, directory=None,
+                 maxDiskSize=64 << 20):
+        """Create an empty cache.
+
+        Args:
+            maxSize (int, optional): Maximal total length of the pages kept
+                in memory, in characters.
+            directory (str, optional): Directory for the on-disk tier,
+                created if needed. Pages are only kept in memory if None.
+            maxDiskSize (int, optional): Maximal total size of the files in
+                directory, in bytes.
+        """
+        self.maxSize = maxSize
+        self.maxDiskSize = maxDiskSize
+        self.directory = directory
+        self.pages = collections.OrderedDict()
+        self.size = 0
+        self.diskSize = 0
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.diskSize = sum(size for _, _, size in self.diskEntries())
+
+    @staticmethod
+    def key(markdownText, configuration=""):
+        """Get the cache key of a page.
+
+        Args:
+            markdownText (str): Markdown source of the page.
+            configuration (str, optional): Everything besides the source
+                the page depends on, e.g., the renderer's version and
+                settings.
+
+        Returns:
+            str: Hexadecimal hash of the source and configuration.
+
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(configuration.encode("UTF-8"))
+        digest.update(b"\0")
+        digest.update(markdownText.encode("UTF-8"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Get a cached page, marking it as recently used.
+
+        Args:
+            key (str): Key of the page, see key().
+
+        Returns:
+            str: The page, or None if it isn't cached.
+
+        """
+        html = self.pages.get(key)
+        if html is not None:
+            self.pages.move_to_end(key)
+            return html
+
+        if self.directory is None:
+            return None
+
+        fname = self.fileName(key)
+        try:
+            with open(fname, encoding="UTF-8", newline="") as f:
+                html = f.read()
+            os.utime(fname)
+        except OSError:
+            return None
+
+        self.remember(key, html)
+        return html
+
+    def put(self, key, html):
+        """Add a page to the cache, evicting least recently used pages.
+
+        Args:
+            key (str): Key of the page, see key().
+            html (str): The page.
+        """
+        self.remember(key, html)
+
+        if self.directory is None:
+            return
+
+        data = html.encode("UTF-8")
+        try:
+            with tempfile.NamedTemporaryFile(
+                    mode="wb", prefix=".render_", suffix=".tmp",
+                    dir=self.directory, delete=False) as tmpf:
+                tmpf.write(data)
+            os.replace(tmpf.name, self.fileName(key))
+        except OSError as error:
+            print("ERROR: Couldn't cache the rendered note: " + str(error))
+            return
+
+        self.diskSize += len(data)
+        if self.diskSize > self.maxDiskSize:
+            self.pruneDisk()
+
+    def remember(self, key, html):
+        """Keep a page in memory, evicting least recently used pages."""
+        if key in self.pages:
+            self.size -= len(self.pages.pop(key))
+        self.pages[key] = html
+        self.size += len(html)
+
+        while self.size > self.maxSize and len(self.pages) > 1:
+            _, evicted = self.pages.popitem(last=False)
+            self.size -= len(evicted)
+
+    def clear(self):
+        """Forget all pages kept in memory, the files are kept."""
+        self.pages.clear()
+        self.size = 0
+
+    def fileName(self, key):
+        """Get the path of the file storing a page."""
+        return os.path.join(self.directory, key + ".html")
+
+    def diskEntries(self):
+        """Get (modification time, path, size) of all the cached files."""
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith(".html"):
+                    stat = entry.stat()
+                    entries.append(
+                        (stat.st_mtime_ns, entry.path, stat.st_size))
+        return entries
+
+    def pruneDisk(self):
+        """Delete least recently used files until there's room for more.
+
+        Files are deleted until they take up at most three quarters of
+        maxDiskSize, so that the directory isn't scanned on every put().
+        """
+        entries = sorted(self.diskEntries())
+        self.diskSize = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if self.diskSize <= self.maxDiskSize * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.diskSize -= size
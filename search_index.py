@@ -0,0 +1,344 @@
+"""Module containing in-memory search indexes of diary notes."""
+import re
+import bisect
+
+reWord = re.compile(r"\w+")
+reDate = re.compile(r"\d{4}-\d{2}-\d{2}\Z")
+
+
+class WordIndex():
+    """Inverted index mapping words to the notes containing them.
+
+    Words are runs of word characters of the lowercased note text, so the
+    index can answer the same case insensitive queries as
+    Diary.searchNotes(). A sorted list of all the words is kept alongside
+    the posting lists to answer prefix queries by bisection.
+    """
+
+    # Number of substring scans of the vocabulary kept, see wordsContaining()
+    maxScans = 16
+
+    def __init__(self, notes=()):
+        """Build the index from an iterable of notes.
+
+        Args:
+            notes (iterable, optional): (noteId, text) pairs to be indexed.
+        """
+        self.postings = {}
+        self.noteWords = {}
+        # Words containing recently searched for parts, see wordsContaining()
+        self.scans = {}
+
+        for noteId, text in notes:
+            words = self.extractWords(text)
+            self.noteWords[noteId] = words
+            for word in words:
+                self.postings.setdefault(word, set()).add(noteId)
+
+        self.words = sorted(self.postings)
+
+    @staticmethod
+    def extractWords(text):
+        """Get the set of lowercased words in a text."""
+        return set(reWord.findall(text.lower()))
+
+    def addNote(self, noteId, text):
+        """Add a note to the index.
+
+        Args:
+            noteId (str): UUID of the note.
+            text (str): The note's text.
+        """
+        words = self.extractWords(text)
+        self.noteWords[noteId] = words
+        for word in words:
+            if word in self.postings:
+                self.postings[word].add(noteId)
+            else:
+                self.postings[word] = {noteId}
+                bisect.insort(self.words, word)
+                self.scans.clear()
+
+    def removeNote(self, noteId):
+        """Remove a note from the index, if it is indexed.
+
+        Args:
+            noteId (str): UUID of the note.
+        """
+        for word in self.noteWords.pop(noteId, ()):
+            notes = self.postings[word]
+            notes.discard(noteId)
+            if not notes:
+                del self.postings[word]
+                del self.words[bisect.bisect_left(self.words, word)]
+                self.scans.clear()
+
+    def wordsWithPrefix(self, prefix):
+        """Get all indexed words starting with prefix."""
+        first = bisect.bisect_left(self.words, prefix)
+        last = first
+        while last < len(self.words) and self.words[last].startswith(prefix):
+            last += 1
+
+        return self.words[first:last]
+
+    def findWords(self, query, prefix=True):
+        """Find notes containing all the words of a query.
+
+        Args:
+            query (str): Words to look for.
+            prefix (bool, optional): Match words starting with the query's
+                words, not just the exact words.
+
+        Returns:
+            A set of ids of the matching notes.
+
+        """
+        found = None
+        for queryWord in self.extractWords(query):
+            if prefix:
+                words = self.wordsWithPrefix(queryWord)
+            else:
+                words = [queryWord] if queryWord in self.postings else []
+
+            notes = set()
+            for word in words:
+                notes.update(self.postings[word])
+
+            found = notes if found is None else found & notes
+            if not found:
+                break
+
+        return found or set()
+
+    def wordsContaining(self, part):
+        """Get all indexed words containing part.
+
+        This has to scan the whole vocabulary, so the results of recent scans
+        are kept. While a search is being typed, each pattern usually
+        extends the previous one and only the words found for it are
+        scanned again.
+        """
+        words = self.scans.get(part)
+        if words is not None:
+            return words
+
+        # Words containing part contain any part of it as well
+        scanned = [previousWords for previous, previousWords
+                   in self.scans.items() if previous in part]
+        words = min(scanned, key=len) if scanned else self.words
+        words = [word for word in words if part in word]
+
+        if len(self.scans) >= self.maxScans:
+            self.scans.clear()
+        self.scans[part] = words
+        return words
+
+    def candidates(self, pattern):
+        """Find notes that may contain a pattern (case insensitive).
+
+        A pattern consisting only of word characters can only occur inside a
+        single word, so the notes containing a word containing the pattern
+        are exactly the matching notes. Otherwise each of the pattern's
+        words has to occur inside some word of a matching note, which only
+        narrows down the candidates. A pattern's word preceded by a non-word
+        character has to start a word and one followed by a non-word
+        character has to end it.
+
+        Args:
+            pattern (str): Text to look for.
+
+        Returns:
+            A (set of note ids, bool) tuple, the bool being True if all the
+            notes are known to match. None if the index can't narrow down
+            the candidates (e.g., the pattern has no word characters).
+
+        """
+        pattern = pattern.lower()
+        patternWords = set()
+        for match in reWord.finditer(pattern):
+            isStart = match.start() > 0
+            isEnd = match.end() < len(pattern)
+            patternWords.add((match.group(), isStart, isEnd))
+        if not patternWords:
+            return None
+
+        found = None
+        for patternWord, isStart, isEnd in patternWords:
+            if isStart and isEnd:
+                words = [patternWord] if patternWord in self.postings else []
+            elif isStart:
+                words = self.wordsWithPrefix(patternWord)
+            elif isEnd:
+                words = [word for word in self.wordsContaining(patternWord)
+                         if word.endswith(patternWord)]
+            else:
+                words = self.wordsContaining(patternWord)
+
+            notes = set()
+            for word in words:
+                notes.update(self.postings[word])
+
+            found = notes if found is None else found & notes
+            if not found:
+                break
+
+        exact = patternWords == {(pattern, False, False)}
+        return found, exact
+
+
+class TrigramIndex():
+    """Inverted index mapping character trigrams to notes containing them.
+
+    Trigrams are taken from the lowercased note text. Any text containing a
+    pattern contains all of the pattern's trigrams, so the index narrows
+    down the notes which may contain an arbitrary substring (part of a
+    word, code, a URL, etc.) of at least three characters.
+
+    The index takes several times the memory of the notes and long to
+    build, so it is only built on request. Each note's trigrams, needed to
+    remove it, are kept concatenated in a single string, as separate
+    strings would take much more memory than the postings themselves.
+    """
+
+    def __init__(self, notes=()):
+        """Build the index from an iterable of notes.
+
+        Args:
+            notes (iterable, optional): (noteId, text) pairs to be indexed.
+        """
+        self.postings = {}
+        self.noteTrigrams = {}
+
+        for noteId, text in notes:
+            self.addNote(noteId, text)
+
+    @staticmethod
+    def extractTrigrams(text):
+        """Get the set of trigrams of a lowercased text."""
+        text = text.lower()
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def addNote(self, noteId, text):
+        """Add a note to the index.
+
+        Args:
+            noteId (str): UUID of the note.
+            text (str): The note's text.
+        """
+        trigrams = self.extractTrigrams(text)
+        self.noteTrigrams[noteId] = "".join(trigrams)
+        for trigram in trigrams:
+            notes = self.postings.get(trigram)
+            if notes is None:
+                self.postings[trigram] = {noteId}
+            else:
+                notes.add(noteId)
+
+    def removeNote(self, noteId):
+        """Remove a note from the index, if it is indexed.
+
+        Args:
+            noteId (str): UUID of the note.
+        """
+        trigrams = self.noteTrigrams.pop(noteId, "")
+        for i in range(0, len(trigrams), 3):
+            trigram = trigrams[i:i + 3]
+            notes = self.postings[trigram]
+            notes.discard(noteId)
+            if not notes:
+                del self.postings[trigram]
+
+    def candidates(self, pattern):
+        """Find notes that may contain a pattern (case insensitive).
+
+        Args:
+            pattern (str): Text to look for.
+
+        Returns:
+            A (set of note ids, False) tuple, the candidates always have to
+            be verified. None if the pattern is shorter than a trigram.
+
+        """
+        trigrams = self.extractTrigrams(pattern)
+        if not trigrams:
+            return None
+
+        # Start with the rarest trigram to keep the intersections small
+        found = None
+        for trigram in sorted(trigrams,
+                              key=lambda t: len(self.postings.get(t, ()))):
+            notes = self.postings.get(trigram)
+            if not notes:
+                return set(), False
+
+            found = set(notes) if found is None else found & notes
+            if not found:
+                break
+
+        return found, False
+
+
+class DateIndex():
+    """Sorted index of notes' dates answering date range queries.
+
+    ISO dates sort like strings, so the index is a sorted list of
+    (date, noteId) pairs searched by bisection. Notes whose date isn't in
+    the YYYY-MM-DD format aren't indexed.
+    """
+
+    def __init__(self, notes=()):
+        """Build the index from an iterable of notes.
+
+        Args:
+            notes (iterable, optional): (noteId, date) pairs to be indexed.
+        """
+        self.noteDates = {noteId: date for noteId, date in notes
+                          if reDate.match(date)}
+        self.entries = sorted(
+            (date, noteId) for noteId, date in self.noteDates.items())
+
+    def addNote(self, noteId, date):
+        """Add a note to the index.
+
+        Args:
+            noteId (str): UUID of the note.
+            date (str): The note's date.
+        """
+        if reDate.match(date):
+            self.noteDates[noteId] = date
+            bisect.insort(self.entries, (date, noteId))
+
+    def removeNote(self, noteId):
+        """Remove a note from the index, if it is indexed.
+
+        Args:
+            noteId (str): UUID of the note.
+        """
+        date = self.noteDates.pop(noteId, None)
+        if date is not None:
+            del self.entries[bisect.bisect_left(self.entries, (date, noteId))]
+
+    def between(self, start=None, end=None):
+        """Find notes dated within a range.
+
+        Both bounds are inclusive and may be just a year or a month, e.g.,
+        between("2017-03", "2017-03") finds all notes from March 2017.
+
+        Args:
+            start (str, optional): The earliest date, unbounded if None.
+            end (str, optional): The latest date, unbounded if None.
+
+        Returns:
+            A list of ids of the matching notes, sorted by date.
+
+        """
+        first = 0
+        if start is not None:
+            first = bisect.bisect_left(self.entries, (start,))
+        last = len(self.entries)
+        if end is not None:
+            # Any date starting with end sorts before end + "\uffff"
+            last = bisect.bisect_left(self.entries, (end + "\uffff",))
+
+        return [noteId for _, noteId in self.entries[first:last]]
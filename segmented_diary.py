@@ -0,0 +1,660 @@
+#!/usr/bin/env python3
+"""Diaries split into per-period segment files.
+
+A segmented diary stores its notes in several ordinary diary files, one per
+year or month of the notes' dates, and a small JSON manifest listing them.
+Saving a note rewrites only the segment it belongs to, so the cost of a save
+doesn't grow with years of history. Each segment is a valid diary on its
+own.
+
+Usage:
+    python3 segmented_diary.py split diary.md diary.json --period month
+    python3 segmented_diary.py join diary.json diary.md
+"""
+import os
+import sys
+import json
+import errno
+import argparse
+import tempfile
+import contextlib
+import collections
+
+import diary
+
+MANIFEST_FORMAT = "markdown-diary segments"
+MANIFEST_VERSION = 1
+
+# Length of the date prefix identifying a note's segment
+PERIODS = {"year": 4, "month": 7}
+# Segment of notes without a valid date
+UNDATED = "undated"
+
+
+def isManifest(fname):
+    """Check whether a file is a segmented diary manifest.
+
+    Args:
+        fname (str): Path to the file.
+
+    Returns:
+        bool: True if the file is a manifest, False otherwise.
+
+    """
+    try:
+        with open(fname, "rb") as f:
+            if f.read(1) != b"{":
+                return False
+            f.seek(0)
+            manifest = json.loads(f.read().decode("UTF-8"))
+    except (OSError, ValueError):
+        return False
+
+    return (isinstance(manifest, dict) and
+            manifest.get("format") == MANIFEST_FORMAT)
+
+
+def openDiary(fname, **kwargs):
+    """Open a diary, whether it is a single file or a segmented one.
+
+    Args:
+        fname (str): Path to a diary file or a segmented diary manifest.
+        **kwargs: Options passed on to the Diary (or SegmentedDiary).
+
+    Returns:
+        A Diary or a SegmentedDiary.
+
+    """
+    if isManifest(fname):
+        return SegmentedDiary(fname, **kwargs)
+
+    return diary.Diary(fname, **kwargs)
+
+
+def segmentKey(noteDate, period):
+    """Get the key of the segment a note with the given date belongs to.
+
+    Args:
+        noteDate (str): Date of the note.
+        period (str): Period covered by a segment, "year" or "month".
+
+    Returns:
+        str: The key, e.g., "2017" or "2017-03".
+
+    """
+    if not diary.Diary.isValidDate(noteDate):
+        return UNDATED
+
+    return noteDate[:PERIODS[period]]
+
+
+def segmentName(manifestName, key):
+    """Get the path of a segment file, relative to the manifest.
+
+    Args:
+        manifestName (str): Path to the manifest.
+        key (str): Key of the segment.
+
+    Returns:
+        str: The segment's file name, e.g., "diary-2017.md".
+
+    """
+    stem = os.path.splitext(os.path.basename(manifestName))[0]
+    return stem + "-" + key + ".md"
+
+
+def writeManifest(manifestName, period, segments,
+                  durability=diary.DURABILITY_DIRECTORY):
+    """Atomically write a segmented diary manifest.
+
+    Args:
+        manifestName (str): Path to the manifest.
+        period (str): Period covered by a segment, "year" or "month".
+        segments (dict): Segment keys mapped to the segments' file names,
+            relative to the manifest.
+        durability (str, optional): One of diary.DURABILITIES.
+    """
+    manifest = collections.OrderedDict([
+        ("format", MANIFEST_FORMAT),
+        ("version", MANIFEST_VERSION),
+        ("period", period),
+        ("segments", collections.OrderedDict(sorted(segments.items())))])
+
+    diary.Diary.replaceFile(manifestName, bytes(
+        json.dumps(manifest, indent=4) + "\n", encoding="UTF-8"), durability)
+
+
+def splitNotes(rawData):
+    """Split a diary into its notes' raw text.
+
+    Every note but the last ends with a newline, so that the notes can be
+    concatenated in any order.
+
+    Args:
+        rawData (str): The whole diary.
+
+    Yields:
+        (str, str) tuples of a note's date and its raw text, including the
+        header. The text preceding the first note is a part of the first
+        note's text.
+
+    """
+    start = 0
+    previous = None
+    for record in diary.Diary.scanNotes(rawData):
+        if previous is not None:
+            yield previous.date, rawData[start:record.start]
+            start = record.start
+        previous = record
+
+    if previous is not None:
+        yield previous.date, rawData[start:]
+    elif rawData:
+        yield "", rawData
+
+
+def splitDiary(fname, manifestName, period="year"):
+    """Convert a single-file diary to a segmented one.
+
+    The notes keep their relative order within each segment. The original
+    diary is left untouched, and so are any existing files, nothing is
+    written if the manifest or any of the segments already exists.
+
+    Args:
+        fname (str): Path to the diary to be converted.
+        manifestName (str): Path to the manifest to be written. The segments
+            are written next to it.
+        period (str, optional): Period covered by a segment, "year" or
+            "month".
+
+    Raises:
+        FileExistsError: If the manifest or a segment file exists.
+    """
+    with diary.Diary.openDiaryFile(fname) as f:
+        rawData = str(f.read(), encoding="UTF-8")
+
+    segments = collections.OrderedDict()
+    for noteDate, text in splitNotes(rawData):
+        key = segmentKey(noteDate, period)
+        if segments.get(key, "\n").endswith("\n"):
+            segments[key] = segments.get(key, "") + text
+        else:
+            segments[key] += "\n" + text
+
+    directory = os.path.dirname(manifestName)
+    names = {key: segmentName(manifestName, key) for key in segments}
+    for path in [manifestName] + [os.path.join(directory, name)
+                                  for name in names.values()]:
+        if os.path.exists(path):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST),
+                                  path)
+
+    for key, text in segments.items():
+        with open(os.path.join(directory, names[key]), "xb") as f:
+            f.write(bytes(text, encoding="UTF-8"))
+
+    writeManifest(manifestName, period, names)
+
+
+def joinDiary(manifestName, fname):
+    """Convert a segmented diary to a single-file one.
+
+    The segments are concatenated in the order of their periods, notes
+    without a valid date come last. The segmented diary is left untouched.
+
+    Args:
+        manifestName (str): Path to the manifest of the diary.
+        fname (str): Path to the diary file to be written. It is compressed
+            if it has a compression extension, see diary.COMPRESSIONS.
+    """
+    segmentedDiary = SegmentedDiary(manifestName, lazy=True)
+    compression = diary.Diary.compressionOf(fname)
+    with tempfile.NamedTemporaryFile(
+            mode="wb", prefix=".diary_", suffix=".tmp",
+            dir=os.path.dirname(fname), delete=False) as tmpf:
+        f = tmpf if compression is None else compression.open(tmpf, "wb")
+        with f:
+            endsWithNewline = True
+            for segment in segmentedDiary.segments.values():
+                rawData = segment.rawData[:]
+                # Compressed segments aren't mapped, but read in
+                if isinstance(rawData, str):
+                    rawData = bytes(rawData, encoding="UTF-8")
+                if not endsWithNewline and rawData:
+                    f.write(b"\n")
+                f.write(rawData)
+                if rawData:
+                    endsWithNewline = rawData.endswith(b"\n")
+    segmentedDiary.close()
+    os.replace(tmpf.name, fname)
+
+
+class DiaryChangedError(Exception):
+    """Raised to roll back a batch of a diary changed externally."""
+
+
+class SegmentedDiary():
+    """Diary stored in per-period segment files listed in a manifest.
+
+    Provides the same note manipulation and search methods as Diary, each
+    segment being a Diary of its own. Notes are kept in the order of their
+    segments' periods. Saving a note with a date from another period moves
+    the note to the corresponding segment, creating the segment if needed.
+    """
+
+    def __init__(self, fname, **kwargs):
+        """Init method that loads all segments listed in a manifest.
+
+        Args:
+            fname (str): Path to the manifest.
+            **kwargs: Options passed on to the segments' Diary objects, see
+                Diary.__init__().
+        """
+        self.fname = fname
+        self.options = kwargs
+        self.lazy = kwargs.get("lazy", False)
+        self.durability = kwargs.get("durability",
+                                     diary.DURABILITY_DIRECTORY)
+        # Notes moved to another segment in the current batch(), mapped to
+        # the key of the segment they are still to be deleted from. None
+        # outside of batches
+        self.batchMoves = None
+
+        self.segments = collections.OrderedDict()
+        self.loadManifest()
+        self.buildIndex()
+        self.buildData()
+
+    def loadManifest(self):
+        """Read the manifest and load the segments that aren't loaded yet.
+
+        Segments no longer listed in the manifest are dropped.
+        """
+        with open(self.fname, encoding="UTF-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") != MANIFEST_VERSION:
+            raise ValueError("Unsupported diary manifest version " +
+                             str(manifest.get("version")))
+        self.period = manifest["period"]
+        self.segmentNames = manifest["segments"]
+        self.updateFingerprint()
+
+        directory = os.path.dirname(self.fname)
+        segments = collections.OrderedDict()
+        for key, name in sorted(self.segmentNames.items()):
+            path = os.path.join(directory, name)
+            segment = self.segments.pop(key, None)
+            if segment is None or segment.fname != path:
+                segment = diary.Diary(path, **self.options)
+            segments[key] = segment
+
+        for segment in self.segments.values():
+            segment.close()
+        self.segments = segments
+
+    def fileNames(self):
+        """Get the paths of all the files the diary consists of."""
+        return [self.fname] + [segment.fname
+                               for segment in self.segments.values()]
+
+    def buildIndex(self):
+        """Rebuild the note_id -> segment key index."""
+        self.index = {}
+        for key, segment in self.segments.items():
+            for datum in segment.data:
+                self.index[datum["note_id"]] = key
+
+    def buildData(self):
+        """Rebuild self.data, the list of all notes' metadata."""
+        moves = self.batchMoves or {}
+        self.data = [datum for key, segment in self.segments.items()
+                     for datum in segment.data
+                     if moves.get(datum["note_id"]) != key]
+
+    def updateFingerprint(self):
+        """Remember the manifest's size, modification time and inode."""
+        stat = os.stat(self.fname)
+        self.fingerprint = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def isChangedOnDisk(self):
+        """Check whether the manifest or any segment was changed externally.
+
+        Returns:
+            bool: True if the diary was changed, False otherwise.
+
+        """
+        return self.isManifestChanged() or any(
+            segment.isChangedOnDisk() for segment in self.segments.values())
+
+    def isManifestChanged(self):
+        """Check whether the manifest was changed externally."""
+        try:
+            stat = os.stat(self.fname)
+        except FileNotFoundError:
+            return True
+
+        return (stat.st_size, stat.st_mtime_ns,
+                stat.st_ino) != self.fingerprint
+
+    def reloadFromDisk(self):
+        """Bring the diary up to date with external changes of its files.
+
+        Added and removed segments are loaded and dropped, the segments that
+        changed are brought up to date, see Diary.reloadFromDisk().
+
+        Returns:
+            bool: True if the diary was changed, False otherwise.
+
+        """
+        changed = False
+        if self.isManifestChanged():
+            try:
+                self.loadManifest()
+            except (OSError, ValueError, KeyError):
+                print("ERROR: Can't read diary manifest " + self.fname + "!")
+                return False
+            changed = True
+
+        # Every segment has to be reloaded, no short-circuiting
+        if any([segment.reloadFromDisk()
+                for segment in self.segments.values()]):
+            changed = True
+
+        if changed:
+            self.buildIndex()
+            self.buildData()
+        return changed
+
+    def close(self):
+        """Release the memory-mapped segment files, if there are any."""
+        for segment in self.segments.values():
+            segment.close()
+
+    def saveIndexCache(self):
+        """Write the sidecar index files of all segments.
+
+        Returns:
+            bool: True if all the indexes were written, False otherwise.
+
+        """
+        return all([segment.saveIndexCache()
+                    for segment in self.segments.values()])
+
+    def buildSearchIndexes(self, wordIndex=True, trigramIndex=False):
+        """Build the requested search indexes of all segments.
+
+        Args:
+            wordIndex (bool, optional): Build the word index.
+            trigramIndex (bool, optional): Build the trigram index, which
+                takes a lot of memory and time to build for big diaries.
+        """
+        for segment in self.segments.values():
+            segment.buildSearchIndexes(wordIndex, trigramIndex)
+
+    def segment(self, key):
+        """Get the segment with the given key, creating it if needed.
+
+        Args:
+            key (str): Key of the segment.
+
+        Returns:
+            Diary: The segment, or None if it couldn't be created.
+
+        """
+        if key in self.segments:
+            return self.segments[key]
+
+        if self.isChangedOnDisk():
+            print("ERROR: Diary file was changed! Abort save.")
+            return None
+
+        name = segmentName(self.fname, key)
+        path = os.path.join(os.path.dirname(self.fname), name)
+        if os.path.exists(path):
+            print("ERROR: Diary segment " + path + " already exists!")
+            return None
+
+        with open(path, "w"):
+            os.utime(path)
+        self.segmentNames[key] = name
+        writeManifest(self.fname, self.period, self.segmentNames,
+                      self.durability)
+        self.updateFingerprint()
+
+        self.segments[key] = diary.Diary(path, **self.options)
+        self.segments = collections.OrderedDict(
+            sorted(self.segments.items()))
+        return self.segments[key]
+
+    def hasNote(self, noteId):
+        """Check whether a note with the given UUID exists in the diary."""
+        return noteId in self.index
+
+    def saveNote(self, note, noteId, noteDate):
+        """Save a note to the segment corresponding to its date.
+
+        Args:
+            note (str): Text of the note.
+            noteId (str): UUID of the note.
+            noteDate (str): Date of the note.
+        """
+        key = segmentKey(noteDate, self.period)
+        oldKey = self.index.get(noteId)
+        segment = self.segment(key)
+        if segment is None:
+            return
+
+        segment.saveNote(note, noteId, noteDate)
+        if not segment.hasNote(noteId):
+            return
+
+        # Saved to the new segment first, so the note can't get lost
+        if oldKey is not None and oldKey != key:
+            if self.batchMoves is None:
+                self.segments[oldKey].deleteNote(noteId)
+            else:
+                # Deleted only once the new segment is saved, see batch(),
+                # unless oldKey holds just a copy made in this batch
+                origin = self.batchMoves.pop(noteId, None)
+                if origin is None:
+                    origin = oldKey
+                else:
+                    self.segments[oldKey].deleteNote(noteId)
+                if origin != key:
+                    self.batchMoves[noteId] = origin
+        self.index[noteId] = key
+        self.buildData()
+
+    def updateNote(self, note, noteId, noteDate):
+        """Replace a note's content and date, see saveNote()."""
+        self.saveNote(note, noteId, noteDate)
+
+    def deleteNote(self, noteId):
+        """Delete a note from a diary.
+
+        Args:
+            noteId (str): UUID of the note to be deleted.
+        """
+        segment = self.segments[self.index[noteId]]
+        segment.deleteNote(noteId)
+        if not segment.hasNote(noteId):
+            del self.index[noteId]
+            if self.batchMoves is not None and noteId in self.batchMoves:
+                self.segments[self.batchMoves.pop(noteId)].deleteNote(noteId)
+        self.buildData()
+
+    def changeNoteDate(self, noteId, newDate):
+        """Change date of a note."""
+        self.saveNote(self.getNote(noteId), noteId, newDate)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Make several changes with a single save of each segment.
+
+        See Diary.batch(). If the manifest or any segment was changed
+        externally, all of the segments are rolled back. Otherwise each
+        segment is saved on its own, and a segment failing to save is
+        rolled back alone. Notes moved to another segment are deleted from
+        their old segment only after the new one is saved, in a second save
+        of the old segment, so they can't get lost. Segments created inside
+        the batch are written immediately.
+
+        Yields:
+            The diary itself.
+
+        """
+        if self.batchMoves is not None:
+            yield self
+            return
+
+        self.batchMoves = {}
+        try:
+            with contextlib.ExitStack() as stack:
+                for segment in list(self.segments.values()):
+                    stack.enter_context(segment.batch())
+                yield self
+                if self.isChangedOnDisk():
+                    # Roll back all the segments
+                    raise DiaryChangedError(self.fname)
+        except DiaryChangedError:
+            print("ERROR: Diary file was changed! Abort save.")
+            self.batchMoves = {}
+        finally:
+            moves = [(noteId, origin, self.index[noteId])
+                     for noteId, origin in self.batchMoves.items()]
+            self.batchMoves = None
+            # Some of the segments may have been rolled back
+            self.buildIndex()
+            self.buildData()
+
+        origins = collections.defaultdict(list)
+        for noteId, origin, key in moves:
+            if self.segments[key].hasNote(noteId):
+                origins[origin].append(noteId)
+        for origin, noteIds in origins.items():
+            segment = self.segments[origin]
+            with segment.batch():
+                for noteId in noteIds:
+                    segment.deleteNote(noteId)
+
+        self.buildIndex()
+        self.buildData()
+
+    def getNote(self, noteId):
+        """Extract note text from diary.
+
+        Args:
+            noteId (str): UUID of the requested note.
+
+        Returns:
+            A single note's text. Returns None if noteId not found.
+
+        """
+        if noteId not in self.index:
+            return None
+
+        return self.segments[self.index[noteId]].getNote(noteId)
+
+    def getNoteMetadata(self, noteId):
+        """Get metadata of a single note.
+
+        Args:
+            noteId (str): UUID of the requested note.
+
+        Returns:
+            A metadata dictionary. Returns None if noteId not found.
+
+        """
+        if noteId not in self.index:
+            return None
+
+        return self.segments[self.index[noteId]].getNoteMetadata(noteId)
+
+    def notesBetween(self, start=None, end=None):
+        """Get all notes dated within a range, see Diary.notesBetween().
+
+        Only the segments whose periods overlap the range are searched.
+
+        Args:
+            start (str, optional): The earliest date, unbounded if None.
+            end (str, optional): The latest date, unbounded if None.
+
+        Returns:
+            A list of metadata of the matching notes, sorted by date.
+
+        """
+        notes = []
+        for key, segment in self.segments.items():
+            if key != UNDATED and (
+                    (start is not None and key + "\uffff" < start) or
+                    (end is not None and key > end + "\uffff")):
+                continue
+            notes.extend(segment.notesBetween(start, end))
+
+        return notes
+
+    def searchNotes(self, pattern):
+        """Search for all notes containing 'pattern', see Diary.searchNotes().
+
+        Args:
+            pattern (string): Text to look for.
+
+        Returns:
+            A list of metadata of all matching notes.
+
+        """
+        return [datum for segment in self.segments.values()
+                for datum in segment.searchNotes(pattern)]
+
+    def searchWords(self, query, prefix=True):
+        """Find notes containing all words of a query, see Diary.searchWords().
+
+        Args:
+            query (str): Words to look for.
+            prefix (bool, optional): Match words starting with the query's
+                words, not just the exact words.
+
+        Returns:
+            A list of metadata of all matching notes.
+
+        """
+        return [datum for segment in self.segments.values()
+                for datum in segment.searchWords(query, prefix)]
+
+    isValidDate = staticmethod(diary.Diary.isValidDate)
+    createNoteHeader = staticmethod(diary.Diary.createNoteHeader)
+
+
+def main():
+    """Convert a diary according to command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    split = subparsers.add_parser(
+        "split", help="convert a single-file diary to a segmented one")
+    split.add_argument("fname", help="path to the diary to be converted")
+    split.add_argument("manifest", help="path to the manifest to be written")
+    split.add_argument("--period", choices=sorted(PERIODS), default="year",
+                       help="period covered by a segment "
+                       "(default: %(default)s)")
+
+    join = subparsers.add_parser(
+        "join", help="convert a segmented diary to a single-file one")
+    join.add_argument("manifest", help="path to the diary's manifest")
+    join.add_argument("fname", help="path to the diary to be written")
+
+    args = parser.parse_args()
+    if args.command == "split":
+        try:
+            splitDiary(args.fname, args.manifest, args.period)
+        except FileExistsError as error:
+            print("ERROR: " + error.filename + " already exists!",
+                  file=sys.stderr)
+            sys.exit(1)
+    else:
+        joinDiary(args.manifest, args.fname)
+
+
+if __name__ == "__main__":
+    main()
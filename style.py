@@ -40,3 +40,26 @@ mathjax = ('<style type="text/css">\n'
            '       tex2jax: {inlineMath: [["$","$"]]}\n'
            '   });\n'
            '</script>\n')
+
+# Defines showNote(), which replaces the note displayed in the preview
+# without reloading the page, see markdown_math.createShell()
+preview = ('<script type="text/javascript">\n'
+           '    function showNote(body, math, mathjax) {\n'
+           '        document.body.innerHTML = body;\n'
+           '        window.scrollTo(0, 0);\n'
+           '        if (!math) {\n'
+           '            return;\n'
+           '        }\n'
+           '        if (window.MathJax && MathJax.Hub) {\n'
+           '            // Typeset just the new note\n'
+           '            MathJax.Hub.Queue(["Typeset", MathJax.Hub,'
+           ' document.body]);\n'
+           '        } else if (!document.getElementById("mathjax")) {\n'
+           '            // Typesets the page once loaded\n'
+           '            var script = document.createElement("script");\n'
+           '            script.id = "mathjax";\n'
+           '            script.src = mathjax;\n'
+           '            document.head.appendChild(script);\n'
+           '        }\n'
+           '    }\n'
+           '</script>\n')
@@ -2,18 +2,31 @@
 
 import sys
 import unittest
-from shutil import copyfile
+from unittest import mock
+from shutil import copyfile, rmtree
+import io
 import os
+import stat
+import tempfile
+import threading
+import subprocess
 
 from PyQt5 import QtCore
 from PyQt5 import QtWidgets
 
 import markdown_diary
 import diary as d
+import diary_generator
+import segmented_diary
+import diary_cli
+import markdown_math
+from render_cache import RenderCache
+from search_index import WordIndex
 
 app = QtWidgets.QApplication(sys.argv)
 
 tempDiaryFileName = 'tests/diary_temp.md'
+tempIndexFileName = 'tests/.diary_temp.md.index'
 diaryFileName = 'tests/diary.md'
 noteFileName = 'tests/note.md'
 HTMLNoteFileName = 'tests/note.html'
@@ -23,6 +36,10 @@ def deleteTextFromData(data):
     for datum in data:
         del datum["text"]
 
+def waitForRendering(worker):
+    # The executor's single thread runs the requests in order
+    worker.executor.submit(lambda: None).result()
+
 class DiaryTest(unittest.TestCase):
 
     def setUp(self):
@@ -36,6 +53,8 @@ class DiaryTest(unittest.TestCase):
 
         # Delete the temporary diary
         os.remove(tempDiaryFileName)
+        if os.path.exists(tempIndexFileName):
+            os.remove(tempIndexFileName)
 
     def testSavingOfDiary(self):
 
@@ -69,6 +88,514 @@ class DiaryTest(unittest.TestCase):
         self.assertEqual(note, testNote2)
         self.assertEqual(date, testNoteDate2)
 
+    def testSaveNoteWithSubstringId(self):
+
+        # An id that is only a substring of an existing one is a new note
+        self.diary.saveNote("Substring", "a3ea0c44", "2015-03-15")
+
+        self.assertEqual(len(self.diary.data), 4)
+        self.assertEqual(self.diary.getNote("a3ea0c44"), "Substring")
+        self.assertEqual(
+            self.diary.getNote('a3ea0c44-ed00-11e6-a9cf-c48508000000'),
+            "# Short note\n\nTest\n\n")
+
+    def testNoteIndex(self):
+
+        self.assertTrue(self.diary.hasNote(
+            'a3ea0c44-ed00-11e6-a9cf-c48508000001'))
+        self.assertFalse(self.diary.hasNote('a3ea0c44'))
+
+        self.diary.deleteNote('a3ea0c44-ed00-11e6-a9cf-c48508000000')
+        self.assertFalse(self.diary.hasNote(
+            'a3ea0c44-ed00-11e6-a9cf-c48508000000'))
+
+        for i, datum in enumerate(self.diary.data):
+            self.assertEqual(self.diary.index[datum["note_id"]], i)
+
+    def assertDataMatchesDisk(self):
+
+        with open(tempDiaryFileName) as f:
+            diaryData = f.read()
+
+        refData, refSpans = self.diary.parseNotes(diaryData)
+        self.assertEqual(self.diary.rawData, diaryData)
+        self.assertListEqual(self.diary.data, refData)
+        self.assertListEqual(self.diary.spans, refSpans)
+        index = {}
+        for i, datum in enumerate(refData):
+            index.setdefault(datum["note_id"], i)
+        self.assertEqual(self.diary.index, index)
+
+    def writeDuplicateNote(self):
+        # A copy of the first note, with another text, at the end
+        firstId = 'a3ea0c44-ed00-11e6-a9cf-c48508000000'
+        with open(tempDiaryFileName, "a") as f:
+            f.write(self.diary.createNoteHeader(firstId, "2017-01-01") +
+                    "# Xyzzy\n")
+        self.diary = d.Diary(tempDiaryFileName)
+        return firstId
+
+    def testDuplicateNoteIds(self):
+
+        firstId = self.writeDuplicateNote()
+        # The first copy is used, as by a linear search
+        self.assertEqual(self.diary.index[firstId], 0)
+        self.assertEqual(self.diary.getNote(firstId),
+                         "# Short note\n\nTest\n\n")
+        self.diary.updateNote("# Updated", firstId, "2015-05-05")
+        self.assertEqual(self.diary.getNote(firstId), "# Updated\n")
+        self.assertEqual(self.diary.data[-1]["title"], "Xyzzy")
+        self.assertDataMatchesDisk()
+
+    def testDeletingDuplicateNote(self):
+
+        firstId = self.writeDuplicateNote()
+        self.diary.buildSearchIndexes(wordIndex=True, trigramIndex=True)
+        self.diary.notesBetween()
+
+        # The other copy takes over
+        self.diary.deleteNote(firstId)
+        self.assertTrue(self.diary.hasNote(firstId))
+        self.assertEqual(self.diary.getNote(firstId), "# Xyzzy\n")
+        self.assertEqual(self.diary.searchNotes("Xyzzy"),
+                         [self.diary.getNoteMetadata(firstId)])
+        self.assertEqual(self.diary.notesBetween("2017"),
+                         [self.diary.getNoteMetadata(firstId)])
+
+        # Saving its neighbour doesn't lose track of it
+        lastId = self.diary.data[-2]["note_id"]
+        self.diary.updateNote("# Neighbour", lastId, "2016-01-01")
+        self.assertEqual(self.diary.getNote(firstId), "# Xyzzy\n")
+        self.assertDataMatchesDisk()
+
+        self.diary.deleteNote(firstId)
+        self.assertFalse(self.diary.hasNote(firstId))
+        self.assertDataMatchesDisk()
+
+    def testIncrementalUpdates(self):
+
+        firstId = 'a3ea0c44-ed00-11e6-a9cf-c48508000000'
+        middleId = 'a3ea0c44-ed00-11e6-a9cf-c4850828558c'
+        lastId = 'a3ea0c44-ed00-11e6-a9cf-c48508000001'
+
+        self.diary.saveNote("# New\n\nNew note", "123", "2016-01-01")
+        self.assertDataMatchesDisk()
+        self.diary.saveNote("# Newer\n\nNewer note\n", "456", "2016-01-02")
+        self.assertDataMatchesDisk()
+
+        self.diary.updateNote("# First\n\nNo newline", firstId, "2015-01-01")
+        self.assertDataMatchesDisk()
+        self.diary.updateNote("# Middle\n\nLonger\n" * 10, middleId,
+                              "2015-01-02")
+        self.assertDataMatchesDisk()
+        self.diary.updateNote("# Last", "456", "2015-01-03")
+        self.assertDataMatchesDisk()
+        self.diary.changeNoteDate(lastId, "2000-01-01")
+        self.assertDataMatchesDisk()
+
+        self.diary.deleteNote(middleId)
+        self.assertDataMatchesDisk()
+        self.diary.deleteNote("456")
+        self.assertDataMatchesDisk()
+        self.diary.deleteNote(firstId)
+        self.assertDataMatchesDisk()
+        self.diary.deleteNote(lastId)
+        self.diary.deleteNote("123")
+        self.assertDataMatchesDisk()
+        self.assertListEqual(self.diary.data, [])
+
+    def testNoteRecord(self):
+
+        note = d.Note({"note_id": "123", "date": "2015-05-05",
+                       "title": "Title", "text": "# Title", "version": "3"})
+
+        self.assertEqual(note, {"note_id": "123", "date": "2015-05-05",
+                                "title": "Title", "text": "# Title",
+                                "version": "3"})
+        self.assertEqual(dict(note)["version"], "3")
+        self.assertEqual(len(note), 5)
+        self.assertIn("version", note)
+        self.assertNotIn("author", note)
+        self.assertIsNone(note.get("author"))
+        with self.assertRaises(KeyError):
+            note["author"]
+
+        del note["text"]
+        del note["version"]
+        self.assertEqual(set(note), {"note_id", "date", "title"})
+        self.assertIsNone(note.extra)
+        with self.assertRaises(KeyError):
+            del note["text"]
+
+        # Notes don't need a dictionary of their own
+        self.assertFalse(hasattr(note, "__dict__"))
+        for datum in self.diary.data:
+            self.assertIsInstance(datum, d.Note)
+            self.assertIs(datum["date"], sys.intern(datum["date"]))
+
+    def testLazyDiary(self):
+
+        lazyDiary = d.Diary(tempDiaryFileName, lazy=True)
+
+        self.assertEqual(len(lazyDiary.data), len(self.diary.data))
+        for lazyDatum, datum in zip(lazyDiary.data, self.diary.data):
+            self.assertNotIn("text", lazyDatum)
+            self.assertEqual(lazyDatum["text"], datum["text"])
+            self.assertEqual(lazyDiary.getNote(datum["note_id"]),
+                             datum["text"])
+
+        self.assertEqual(
+            [datum["note_id"] for datum in lazyDiary.searchNotes("2")],
+            [datum["note_id"] for datum in self.diary.searchNotes("2")])
+
+        lazyDiary.close()
+
+    def testLazyDiarySaving(self):
+
+        lazyDiary = d.Diary(tempDiaryFileName, lazy=True)
+        lazyDiary.saveNote("# Nový\n\nŽluťoučký kůň", "123",
+                           "2016-01-01")
+        lazyDiary.updateNote("# Short\n\nÚpdated",
+                             'a3ea0c44-ed00-11e6-a9cf-c48508000000',
+                             "2016-01-02")
+        lazyDiary.deleteNote('a3ea0c44-ed00-11e6-a9cf-c4850828558c')
+
+        self.assertEqual(lazyDiary.getNote("123"),
+                         "# Nový\n\nŽluťoučký kůň")
+        self.assertEqual(lazyDiary.getNoteMetadata("123")["title"], "Nový")
+
+        diary = d.Diary(tempDiaryFileName)
+        for lazyDatum, datum in zip(lazyDiary.data, diary.data):
+            self.assertEqual(dict(lazyDatum, text=lazyDatum["text"]), datum)
+
+        lazyDiary.close()
+
+    def testPartialWrites(self):
+
+        inode = os.stat(tempDiaryFileName).st_ino
+        with open(tempDiaryFileName) as f:
+            originalData = f.read()
+
+        self.diary.saveNote("# Appended", "123", "2016-01-01")
+        with open(tempDiaryFileName) as f:
+            self.assertTrue(f.read().startswith(originalData))
+
+        self.diary.updateNote(
+            "# Updated", 'a3ea0c44-ed00-11e6-a9cf-c4850828558c', "2016-01-01")
+        self.diary.deleteNote('a3ea0c44-ed00-11e6-a9cf-c48508000000')
+
+        # The diary is written in place, never replaced by a new file
+        self.assertEqual(os.stat(tempDiaryFileName).st_ino, inode)
+        self.assertFalse(os.path.exists(self.diary.journalName()))
+        self.assertDataMatchesDisk()
+
+    def testWindowsLineEndings(self):
+
+        noteId = 'a3ea0c44-ed00-11e6-a9cf-c4850828558c'
+        text = self.diary.getNote(noteId)
+        with open(tempDiaryFileName, "rb") as f:
+            diaryData = f.read()
+        with open(tempDiaryFileName, "wb") as f:
+            f.write(diaryData.replace(b"\n", b"\r\n"))
+
+        for lazy in (False, True):
+            diary = d.Diary(tempDiaryFileName, lazy=lazy, cacheIndex=True)
+            self.assertEqual(diary.getNote(noteId), text)
+            self.assertFalse(diary.isChangedOnDisk())
+            self.assertFalse(os.path.exists(tempIndexFileName))
+            diary.close()
+
+        # The first save rewrites the whole diary with Unix line endings
+        diary = d.Diary(tempDiaryFileName, lazy=True)
+        diary.saveNote("# Appended\n\nText", "123", "2016-01-01")
+        with open(tempDiaryFileName, "rb") as f:
+            self.assertNotIn(b"\r", f.read())
+        self.diary = diary
+        self.assertDataMatchesDisk()
+
+        diary.updateNote("# Updated", noteId, "2016-01-01")
+        self.assertDataMatchesDisk()
+        self.assertEqual(diary.getNote("123"), "# Appended\n\nText")
+
+    def testDurability(self):
+
+        def syncs(durability):
+            # Whether each synced file descriptor is a directory
+            diary = d.Diary(tempDiaryFileName, durability=durability)
+            isDirectory = []
+            with mock.patch("diary.os.fsync",
+                            side_effect=lambda fd: isDirectory.append(
+                                stat.S_ISDIR(os.fstat(fd).st_mode))):
+                diary.saveNote("# Appended", "123", "2016-01-01")
+                diary.updateDiaryOnDisk(diary.rawData + "\n")
+            return isDirectory
+
+        # The diary is replaced as a whole, without a journal
+        self.assertListEqual(syncs(d.DURABILITY_NONE), [])
+        self.assertEqual(d.Diary(tempDiaryFileName).getNote("123"),
+                         "# Appended\n")
+        # Partial writes always sync the journal (and the directory after
+        # it is written) and the diary, so they can be rolled back. Plus
+        # the diary's replacement
+        self.assertListEqual(syncs(d.DURABILITY_FILE),
+                             [False, True, False, False])
+        # Plus the directory after the journal is deleted and after the
+        # diary is replaced
+        self.assertListEqual(syncs(d.DURABILITY_DIRECTORY),
+                             [False, True, False, True, False, True])
+
+        with self.assertRaises(ValueError):
+            d.Diary(tempDiaryFileName, durability="always")
+
+    def applyChanges(self, diary):
+
+        firstId = 'a3ea0c44-ed00-11e6-a9cf-c48508000000'
+        middleId = 'a3ea0c44-ed00-11e6-a9cf-c4850828558c'
+        lastId = 'a3ea0c44-ed00-11e6-a9cf-c48508000001'
+
+        diary.saveNote("# Nový\n\nŽluťoučký kůň", "123", "2016-01-01")
+        diary.updateNote("# First\n\nNo newline", firstId, "2015-01-01")
+        diary.changeNoteDate(lastId, "2000-01-01")
+        diary.saveNote("# Newer\n\nNewer note\n", "456", "2016-01-02")
+        diary.deleteNote(middleId)
+        diary.updateNote("# Updated\n\nÚpdated", "123", "2016-01-03")
+        diary.deleteNote(firstId)
+
+    def testBatch(self):
+
+        copyfile(diaryFileName, 'tests/diary_temp_sequential.md')
+        self.applyChanges(d.Diary('tests/diary_temp_sequential.md'))
+        with open('tests/diary_temp_sequential.md', 'rb') as f:
+            refData = f.read()
+        os.remove('tests/diary_temp_sequential.md')
+
+        for lazy in (False, True):
+            copyfile(diaryFileName, tempDiaryFileName)
+            diary = d.Diary(tempDiaryFileName, lazy=lazy, wordIndex=True)
+
+            with mock.patch.object(diary, 'writeDiaryTail',
+                                   wraps=diary.writeDiaryTail) as write:
+                with diary.batch():
+                    self.applyChanges(diary)
+
+                    # Nothing is written until the batch ends
+                    self.assertEqual(write.call_count, 0)
+                    self.assertEqual(diary.getNote("123"),
+                                     "# Updated\n\nÚpdated\n")
+                    self.assertEqual(diary.getNoteMetadata("456")["date"],
+                                     "2016-01-02")
+                    self.assertEqual(diary.searchNotes("žluťoučký"), [])
+
+                self.assertEqual(write.call_count, 1)
+
+            with open(tempDiaryFileName, 'rb') as f:
+                self.assertEqual(f.read(), refData)
+
+            refDiary = d.Diary(tempDiaryFileName, lazy=lazy)
+            self.assertEqual(diary.spans, refDiary.spans)
+            self.assertEqual(diary.index, refDiary.index)
+            for datum, refDatum in zip(diary.data, refDiary.data):
+                self.assertEqual(dict(datum, text=datum["text"]),
+                                 dict(refDatum, text=refDatum["text"]))
+            self.assertEqual(
+                [datum["note_id"] for datum in diary.searchNotes("updated")],
+                ["123"])
+            diary.close()
+            refDiary.close()
+
+    def testBatchRollback(self):
+
+        with open(tempDiaryFileName, 'rb') as f:
+            originalData = f.read()
+        originalNotes = [dict(datum) for datum in self.diary.data]
+        self.diary.buildSearchIndexes()
+
+        with self.assertRaises(RuntimeError):
+            with self.diary.batch():
+                self.diary.saveNote("# Xyzzy", "123", "2016-01-01")
+                with self.diary.batch():
+                    self.diary.deleteNote(
+                        'a3ea0c44-ed00-11e6-a9cf-c48508000000')
+                raise RuntimeError
+
+        with open(tempDiaryFileName, 'rb') as f:
+            self.assertEqual(f.read(), originalData)
+        self.assertEqual(self.diary.data, originalNotes)
+        self.assertFalse(self.diary.hasNote("123"))
+        self.assertEqual(self.diary.searchNotes("xyzzy"), [])
+
+        # An external change aborts the whole batch
+        with self.diary.batch():
+            self.diary.saveNote("# New", "123", "2016-01-01")
+            with open(tempDiaryFileName, 'a') as f:
+                f.write("An externally added line")
+
+        self.assertFalse(self.diary.hasNote("123"))
+        self.assertEqual(self.diary.data, originalNotes)
+
+    def testRecoveringInterruptedSave(self):
+
+        with open(tempDiaryFileName) as f:
+            originalData = f.read()
+
+        # Simulate a crash right before the journal gets removed
+        with mock.patch("diary.os.remove", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.diary.updateNote(
+                    "# Interrupted", 'a3ea0c44-ed00-11e6-a9cf-c48508000000',
+                    "2016-01-01")
+
+        self.assertTrue(os.path.exists(self.diary.journalName()))
+
+        diary = d.Diary(tempDiaryFileName)
+        self.assertEqual(diary.rawData, originalData)
+        self.assertFalse(os.path.exists(diary.journalName()))
+
+        # A diary changed after the crash isn't rolled back
+        with mock.patch("diary.os.remove", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                diary.saveNote("# Interrupted", "123", "2016-01-01")
+        changedData = "Changed\n" + diary.rawData
+        with open(tempDiaryFileName, "w") as f:
+            f.write(changedData)
+
+        journalName = diary.journalName()
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            diary = d.Diary(tempDiaryFileName)
+        self.assertIn("not rolling it back", stdout.getvalue())
+        self.assertEqual(diary.rawData, changedData)
+        self.assertFalse(os.path.exists(journalName))
+        os.remove(journalName + ".stale")
+
+    def testIndexCache(self):
+
+        self.diary.saveNote("# Nový\n\nŽluťoučký kůň", "123", "2016-01-01")
+
+        for lazy in (False, True):
+            diary = d.Diary(tempDiaryFileName, lazy=lazy, cacheIndex=True)
+            self.assertTrue(os.path.exists(tempIndexFileName))
+
+            # An up to date index is loaded without parsing the diary
+            with mock.patch.object(d.Diary, "parseNotes",
+                                   side_effect=AssertionError):
+                cachedDiary = d.Diary(tempDiaryFileName, lazy=lazy,
+                                      cacheIndex=True)
+
+            self.assertListEqual(cachedDiary.spans, diary.spans)
+            self.assertListEqual(cachedDiary.data, diary.data)
+            self.assertEqual(cachedDiary.getNote("123"),
+                             "# Nový\n\nŽluťoučký kůň")
+
+            diary.close()
+            cachedDiary.close()
+            os.remove(tempIndexFileName)
+
+    def testIndexCacheInvalidation(self):
+
+        d.Diary(tempDiaryFileName, cacheIndex=True)
+
+        # Touching the diary keeps the index valid
+        stat = os.stat(tempDiaryFileName)
+        os.utime(tempDiaryFileName,
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        with mock.patch.object(d.Diary, "parseNotes",
+                               side_effect=AssertionError):
+            d.Diary(tempDiaryFileName, cacheIndex=True)
+
+        # Changing it doesn't
+        self.diary.saveNote("Test", "123", "2015-03-15")
+        diary = d.Diary(tempDiaryFileName, cacheIndex=True)
+        self.assertEqual(diary.getNote("123"), "Test")
+
+        # Until the index is saved again
+        with mock.patch.object(d.Diary, "parseNotes",
+                               side_effect=AssertionError):
+            diary = d.Diary(tempDiaryFileName, cacheIndex=True)
+        self.assertEqual(diary.getNote("123"), "Test")
+
+    def testReloadFromDisk(self):
+
+        lastId = 'a3ea0c44-ed00-11e6-a9cf-c48508000001'
+
+        for lazy in (False, True):
+            copyfile(diaryFileName, tempDiaryFileName)
+            diary = d.Diary(tempDiaryFileName, lazy=lazy, wordIndex=True)
+            self.assertFalse(diary.reloadFromDisk())
+
+            with open(tempDiaryFileName, encoding='UTF-8') as f:
+                rawData = f.read()
+            rawData = rawData.replace("# Short note 2", "# Changed note")
+            rawData += "\n" + diary.createNoteHeader("123", "2016-01-01")
+            rawData += "# Ňew"
+
+            # Syncing tools write a new file and rename it over the diary
+            with open('tests/diary_temp_new.md', 'w', encoding='UTF-8') as f:
+                f.write(rawData)
+            os.replace('tests/diary_temp_new.md', tempDiaryFileName)
+
+            with mock.patch.object(d.Diary, "parseNotes",
+                                   wraps=d.Diary.parseNotes) as parseNotes:
+                self.assertTrue(diary.reloadFromDisk())
+            # Only the changed notes (and the one before them) were parsed
+            self.assertEqual([call[0][1] for call in
+                              parseNotes.call_args_list],
+                             [diary.spans[1][0]])
+
+            refDiary = d.Diary(tempDiaryFileName, lazy=lazy)
+            self.assertEqual(diary.spans, refDiary.spans)
+            self.assertEqual(diary.index, refDiary.index)
+            self.assertEqual(diary.getNote("123"), "# Ňew")
+            self.assertEqual(diary.getNoteMetadata(lastId)["title"],
+                             "Changed note")
+            self.assertEqual(
+                [datum["note_id"] for datum in diary.searchNotes("changed")],
+                [lastId])
+            self.assertFalse(diary.isChangedOnDisk())
+            diary.close()
+            refDiary.close()
+
+    def testReloadFromDiskFailures(self):
+
+        with open(diaryFileName, 'rb') as f:
+            rawData = f.read()
+        brokenFiles = [
+            # Written in place mid-UTF-8 sequence
+            rawData + "\n# Ň".encode("UTF-8")[:-1],
+            # A header without its note_id
+            rawData.replace(b"note_id = a3ea0c44-ed00-11e6-a9cf-c48508000001",
+                            b"note_idd = 1"),
+            # Deleted
+            None]
+
+        for lazy in (False, True):
+            for brokenFile in brokenFiles:
+                copyfile(diaryFileName, tempDiaryFileName)
+                diary = d.Diary(tempDiaryFileName, lazy=lazy, wordIndex=True)
+                notes = [dict(datum) for datum in diary.data]
+
+                if brokenFile is None:
+                    os.remove(tempDiaryFileName)
+                else:
+                    with open(tempDiaryFileName, 'r+b') as f:
+                        f.write(brokenFile)
+                        f.truncate()
+
+                with mock.patch('sys.stdout', new_callable=io.StringIO):
+                    self.assertFalse(diary.reloadFromDisk())
+                self.assertEqual([dict(datum) for datum in diary.data],
+                                 notes)
+                self.assertEqual(diary.getNote(notes[0]["note_id"]),
+                                 "# Short note\n\nTest\n\n")
+                # Retried on the next change
+                self.assertTrue(diary.isChangedOnDisk())
+
+                copyfile(diaryFileName, tempDiaryFileName)
+                diary.reloadFromDisk()
+                self.assertEqual([dict(datum) for datum in diary.data],
+                                 notes)
+                self.assertFalse(diary.isChangedOnDisk())
+                diary.close()
+
     def testCreateNoteHeader(self):
 
         testHeader = ("\n"
@@ -137,6 +664,118 @@ class DiaryTest(unittest.TestCase):
 
         self.assertListEqual(metadata, refMetadata)
 
+    def testScanNotes(self):
+
+        diaryData = ("\r\n<!---\r\nmarkdown-diary note metadata\r\n"
+                     "note_id = a\r\n--->\r\n2015-05-05\r\n\r\n"
+                     "# Title\r\nText\r\n"
+                     "<!---\nmarkdown-diary note metadata\nnote_id = b\n"
+                     "--->\n2015-05-06")
+
+        records = list(self.diary.scanNotes(diaryData))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0].metadata, {"note_id": "a"})
+        self.assertEqual(records[0].date, "2015-05-05")
+        self.assertEqual(records[0].title, "Title")
+        text = diaryData[records[0].textStart:records[0].end]
+        self.assertEqual(text, "# Title\r\nText\r\n")
+        self.assertEqual(records[0].end, records[1].start)
+
+        # A truncated note doesn't prevent reading the rest of the diary
+        self.assertEqual(records[1].date, "2015-05-06")
+        self.assertEqual(records[1].title, "")
+        self.assertEqual(records[1].textStart, len(diaryData))
+
+        byteRecords = list(self.diary.scanNotes(diaryData.encode()))
+        self.assertEqual([r.metadata for r in byteRecords],
+                         [r.metadata for r in records])
+
+    def testStreamNotes(self):
+
+        with open(diaryFileName) as f:
+            diaryData = f.read()
+        refData = self.diary.extractData(diaryData)
+
+        # Chunks this small split every header between several chunks
+        for chunkSize in (1, 7, 64, 1 << 20):
+            self.assertListEqual(
+                list(self.diary.streamNotes(diaryFileName, chunkSize)),
+                refData)
+
+        chunks = [diaryData[i:i + 5] for i in range(0, len(diaryData), 5)]
+        self.assertListEqual(list(self.diary.iterNotes(chunks)), refData)
+        self.assertListEqual(list(self.diary.iterNotes([])), [])
+
+    def testCompressedDiaries(self):
+
+        with open(diaryFileName, "rb") as f:
+            diaryData = f.read()
+        refData = self.diary.extractData(str(diaryData, encoding="UTF-8"))
+
+        for extension, codec in d.COMPRESSIONS.items():
+            fname = tempDiaryFileName + extension
+            self.addCleanup(os.remove, fname)
+            # Two streams, like a file appended to by a compressing tool
+            with open(fname, "wb") as f:
+                f.write(codec.compress(diaryData[:100]))
+                f.write(codec.compress(diaryData[100:]))
+
+            compressedDiary = d.Diary(fname, lazy=True)
+            self.assertFalse(compressedDiary.lazy)
+            self.assertListEqual(compressedDiary.data, refData)
+            self.assertListEqual(
+                list(d.Diary.streamNotes(fname, chunkSize=7)), refData)
+
+            compressedDiary.saveNote("# Nový\n\nŽluťoučký kůň", "123",
+                                     "2016-01-01")
+            compressedDiary.updateNote("Updated", refData[0]["note_id"],
+                                       refData[0]["date"])
+            compressedDiary.close()
+            with open(fname, "rb") as f:
+                self.assertEqual(str(codec.decompress(f.read()),
+                                     encoding="UTF-8"),
+                                 compressedDiary.rawData)
+            self.assertListEqual(d.Diary(fname).data, compressedDiary.data)
+            if codec is d.gzip:
+                # No timestamp, so the same diary compresses the same
+                with open(fname, "rb") as f:
+                    self.assertEqual(f.read()[4:8], bytes(4))
+
+            # Replacing the file with a different one is a conflict
+            with open(fname, "wb") as f:
+                f.write(codec.compress(diaryData))
+            self.assertTrue(compressedDiary.isChangedOnDisk())
+            self.assertTrue(compressedDiary.reloadFromDisk())
+            self.assertListEqual(compressedDiary.data, refData)
+            self.assertFalse(compressedDiary.isChangedOnDisk())
+
+            # A truncated file isn't mistaken for a shorter diary
+            with open(fname, "wb") as f:
+                f.write(codec.compress(diaryData)[:-10])
+            with self.assertRaises(EOFError):
+                d.Diary(fname)
+
+    def testGeneratedDiary(self):
+
+        noteIds = diary_generator.generateDiary(
+            tempDiaryFileName, notes=20, noteSize=500, codeFraction=0.5,
+            mathFraction=0.5)
+        generatedDiary = d.Diary(tempDiaryFileName)
+
+        self.assertEqual([datum["note_id"] for datum in generatedDiary.data],
+                         noteIds)
+        self.assertEqual(generatedDiary.data[3]["title"].split()[:2],
+                         ["Note", "3"])
+        self.assertTrue(all(generatedDiary.isValidDate(datum["date"])
+                            for datum in generatedDiary.data))
+        self.assertTrue(generatedDiary.searchNotes("```"))
+        self.assertTrue(generatedDiary.searchNotes("$$"))
+
+        # The same seed gives the same diary
+        self.assertEqual(diary_generator.generateDiary(
+            tempDiaryFileName, notes=20, noteSize=500, codeFraction=0.5,
+            mathFraction=0.5), noteIds)
+
     def testGettingOfNote(self):
 
         with open(diaryFileName) as f:
@@ -183,6 +822,41 @@ class DiaryTest(unittest.TestCase):
 
         self.assertNotEqual(self.diary.rawData, "A whole diary")
 
+    def testDetectingChangesOnDisk(self):
+
+        self.assertFalse(self.diary.isChangedOnDisk())
+
+        # Touching the diary doesn't count as a change
+        stat = os.stat(tempDiaryFileName)
+        os.utime(tempDiaryFileName,
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertFalse(self.diary.isChangedOnDisk())
+
+        # Neither does replacing it with an identical copy
+        copyfile(diaryFileName, tempDiaryFileName + ".copy")
+        os.replace(tempDiaryFileName + ".copy", tempDiaryFileName)
+        self.assertFalse(self.diary.isChangedOnDisk())
+
+        # Changing the contents without changing the size does
+        with open(tempDiaryFileName, "r+") as f:
+            f.write("X")
+        self.assertTrue(self.diary.isChangedOnDisk())
+
+    def testDetectingChangesOnDiskLazy(self):
+
+        lazyDiary = d.Diary(tempDiaryFileName, lazy=True)
+
+        copyfile(diaryFileName, tempDiaryFileName + ".copy")
+        os.replace(tempDiaryFileName + ".copy", tempDiaryFileName)
+        self.assertFalse(lazyDiary.isChangedOnDisk())
+
+        lazyDiary.saveNote("Test", "123", "2015-03-15")
+        with open(tempDiaryFileName, "r+") as f:
+            f.write("X")
+        self.assertTrue(lazyDiary.isChangedOnDisk())
+
+        lazyDiary.close()
+
     def testChangeNoteDate(self):
 
         refNote = self.diary.getNote('a3ea0c44-ed00-11e6-a9cf-c48508000000')
@@ -211,6 +885,32 @@ class DiaryTest(unittest.TestCase):
         self.assertFalse(self.diary.isValidDate('2015-3-14'))
         self.assertTrue(self.diary.isValidDate('2015-03-14'))
 
+    def testNotesBetween(self):
+
+        firstId = 'a3ea0c44-ed00-11e6-a9cf-c48508000000'
+        middleId = 'a3ea0c44-ed00-11e6-a9cf-c4850828558c'
+        lastId = 'a3ea0c44-ed00-11e6-a9cf-c48508000001'
+
+        def notesBetween(start=None, end=None):
+            return [datum["note_id"]
+                    for datum in self.diary.notesBetween(start, end)]
+
+        self.assertEqual(notesBetween(), [firstId, middleId, lastId])
+        self.assertEqual(notesBetween("2015-05-06", "2015-05-09"),
+                         [middleId, lastId])
+        self.assertEqual(notesBetween("2015-05", "2015-05"),
+                         [firstId, middleId, lastId])
+        self.assertEqual(notesBetween(end="2015-05-05"), [firstId])
+        self.assertEqual(notesBetween("2016"), [])
+
+        # The index is kept up to date as notes are saved
+        self.diary.saveNote("# New", "123", "2014-12-31")
+        self.diary.saveNote("# Undated", "456", "someday")
+        self.diary.changeNoteDate(lastId, "2015-05-01")
+        self.diary.deleteNote(middleId)
+        self.assertEqual(notesBetween(), ["123", lastId, firstId])
+        self.assertEqual(notesBetween("2015"), [lastId, firstId])
+
     def testSearchNotes(self):
 
         refIds = ['a3ea0c44-ed00-11e6-a9cf-c4850828558c',
@@ -219,6 +919,522 @@ class DiaryTest(unittest.TestCase):
                for metadatum in self.diary.searchNotes("2")]
         self.assertEqual(ids, refIds)
 
+    def testSearchNotesWithWordIndex(self):
+
+        indexedDiary = d.Diary(tempDiaryFileName, wordIndex=True)
+        indexedDiary.saveNote("# New\n\nPython snippets", "123",
+                              "2016-01-01")
+        indexedDiary.updateNote("# Short note\n\nNo more tests",
+                                'a3ea0c44-ed00-11e6-a9cf-c48508000000',
+                                "2015-05-05")
+        indexedDiary.deleteNote('a3ea0c44-ed00-11e6-a9cf-c48508000001')
+
+        diary = d.Diary(tempDiaryFileName)
+        for pattern in ["2", "test", "PYTHON", "ython s", "short note", "#",
+                        "no-highlight", "nonexistent"]:
+            self.assertEqual(
+                [datum['note_id'] for datum in indexedDiary.searchNotes(
+                    pattern)],
+                [datum['note_id'] for datum in diary.searchNotes(pattern)])
+
+    def testWordIndexCandidates(self):
+
+        index = WordIndex([("1", "Python snippets"), ("2", "cpython"),
+                           ("3", "pythons, snip")])
+        self.assertEqual(index.candidates("ytho"), ({"1", "2", "3"}, True))
+        self.assertEqual(index.candidates("python s"), ({"1"}, False))
+        self.assertEqual(index.candidates("hon,"), ({"1", "2"}, False))
+        self.assertEqual(index.candidates("ns, s"), ({"3"}, False))
+        self.assertIsNone(index.candidates("--"))
+
+        # Words starting or ending at a non-word character aren't scanned for
+        with mock.patch.object(index, "wordsContaining") as scan:
+            index.candidates(" python ")
+            index.candidates(" pyth")
+        scan.assert_not_called()
+
+        # A pattern extending an earlier one only scans the words found then
+        index.candidates("s")
+        with mock.patch.object(index, "words", []):
+            self.assertEqual(index.candidates("sn"), ({"1", "3"}, True))
+
+        # New words aren't missed
+        index.addNote("4", "snow")
+        self.assertEqual(index.candidates("sn"), ({"1", "3", "4"}, True))
+        index.removeNote("1")
+        self.assertEqual(index.candidates("snip"), ({"3"}, True))
+
+    def testSearchNotesWithTrigramIndex(self):
+
+        indexedDiary = d.Diary(tempDiaryFileName, trigramIndex=True)
+        indexedDiary.saveNote("# New\n\nhttps://example.com/a_b?c=1",
+                              "123", "2016-01-01")
+        indexedDiary.deleteNote('a3ea0c44-ed00-11e6-a9cf-c48508000001')
+
+        diary = d.Diary(tempDiaryFileName)
+        for pattern in ["2", "es", "EXAMPLE.com/", "a_b?c", "nt a", "-->",
+                        "nonexistent"]:
+            self.assertEqual(
+                [datum['note_id'] for datum in indexedDiary.searchNotes(
+                    pattern)],
+                [datum['note_id'] for datum in diary.searchNotes(pattern)])
+
+        self.assertEqual(indexedDiary.trigramIndex.postings["a_b"], {"123"})
+        indexedDiary.deleteNote("123")
+        self.assertNotIn("a_b", indexedDiary.trigramIndex.postings)
+
+        indexedDiary.saveNote("# Žluťoučký kůň", "456", "2016-01-01")
+        self.assertEqual(indexedDiary.trigramIndex.postings["ťou"], {"456"})
+        indexedDiary.deleteNote("456")
+        self.assertNotIn("ťou", indexedDiary.trigramIndex.postings)
+
+        # Opt-in only, it's too big for the GUI
+        diary.buildSearchIndexes()
+        self.assertIsNotNone(diary.wordIndex)
+        self.assertIsNone(diary.trigramIndex)
+
+    def testSearchWords(self):
+
+        indexedDiary = d.Diary(tempDiaryFileName, wordIndex=True)
+        for diary in (self.diary, indexedDiary):
+            self.assertEqual(
+                [datum['note_id'] for datum in diary.searchWords("tes")],
+                ['a3ea0c44-ed00-11e6-a9cf-c48508000000',
+                 'a3ea0c44-ed00-11e6-a9cf-c4850828558c',
+                 'a3ea0c44-ed00-11e6-a9cf-c48508000001'])
+            self.assertEqual(
+                [datum['note_id'] for datum in diary.searchWords(
+                    "short 2", prefix=False)],
+                ['a3ea0c44-ed00-11e6-a9cf-c48508000001'])
+
+
+class SegmentedDiaryTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tempDir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tempDir, 'diary.md')
+        self.manifestName = os.path.join(self.tempDir, 'diary.json')
+        self.noteIds = diary_generator.generateDiary(
+            self.fname, notes=40, noteSize=200)
+        segmented_diary.splitDiary(self.fname, self.manifestName)
+        self.diary = segmented_diary.openDiary(self.manifestName)
+
+    def tearDown(self):
+
+        self.diary.close()
+        rmtree(self.tempDir)
+
+    def readSegments(self):
+
+        segments = {}
+        for key, segment in self.diary.segments.items():
+            with open(segment.fname, 'rb') as f:
+                segments[key] = f.read()
+        return segments
+
+    def testSplitAndJoin(self):
+
+        self.assertTrue(segmented_diary.isManifest(self.manifestName))
+        self.assertFalse(segmented_diary.isManifest(self.fname))
+        self.assertIsInstance(self.diary, segmented_diary.SegmentedDiary)
+
+        # The generated notes are sorted by date, so nothing gets reordered
+        singleDiary = d.Diary(self.fname)
+        self.assertEqual(self.diary.data, singleDiary.data)
+        self.assertEqual(list(self.diary.segments), [
+            str(year) for year in range(2000, 2010)])
+
+        joinedName = os.path.join(self.tempDir, 'joined.md')
+        segmented_diary.joinDiary(self.manifestName, joinedName)
+        with open(self.fname, 'rb') as f, open(joinedName, 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+
+        # Compressed diaries are split and joined just the same
+        compressedName = os.path.join(self.tempDir, 'joined.md.gz')
+        segmented_diary.joinDiary(self.manifestName, compressedName)
+        manifestName = os.path.join(self.tempDir, 'compressed.json')
+        segmented_diary.splitDiary(compressedName, manifestName)
+        compressedDiary = segmented_diary.openDiary(manifestName)
+        self.assertEqual(compressedDiary.data, singleDiary.data)
+        compressedDiary.close()
+        self.assertEqual(d.Diary(compressedName).data, singleDiary.data)
+
+        # Existing segments are never overwritten
+        segments = self.readSegments()
+        with open(self.fname, 'a') as f:
+            f.write("\nChanged")
+        for name in (self.manifestName,
+                     os.path.join(self.tempDir, 'other.json')):
+            os.rename(self.manifestName, name)
+            with self.assertRaises(FileExistsError):
+                segmented_diary.splitDiary(self.fname, self.manifestName)
+            os.rename(name, self.manifestName)
+        self.assertEqual(self.readSegments(), segments)
+
+    def testSavingRewritesOnlyOneSegment(self):
+
+        segments = self.readSegments()
+        noteId = self.noteIds[len(self.noteIds) // 2]
+        key = self.diary.index[noteId]
+
+        self.diary.updateNote("# Updated", noteId,
+                              self.diary.getNoteMetadata(noteId)["date"])
+        self.diary.saveNote("# New", "123", key + "-06-01")
+
+        newSegments = self.readSegments()
+        for otherKey in segments:
+            if otherKey != key:
+                self.assertEqual(segments[otherKey], newSegments[otherKey])
+        self.assertNotEqual(segments[key], newSegments[key])
+        self.assertEqual(self.diary.getNote(noteId), "# Updated\n")
+        self.assertEqual(self.diary.index["123"], key)
+
+    def testMovingNotesBetweenSegments(self):
+
+        noteId = self.noteIds[0]
+        self.diary.changeNoteDate(noteId, "2015-03-01")
+        self.diary.saveNote("# Undated", "123", "someday")
+
+        self.assertEqual(self.diary.index[noteId], "2015")
+        self.assertFalse(self.diary.segments["2000"].hasNote(noteId))
+        self.assertEqual(self.diary.data[-2]["note_id"], noteId)
+        self.assertEqual(self.diary.data[-1]["note_id"], "123")
+        self.assertEqual(
+            [datum["note_id"] for datum in self.diary.searchNotes("undated")],
+            ["123"])
+
+        reopened = segmented_diary.openDiary(self.manifestName)
+        self.assertEqual(reopened.data, self.diary.data)
+        self.assertFalse(reopened.isChangedOnDisk())
+
+        self.diary.deleteNote(noteId)
+        self.assertFalse(self.diary.hasNote(noteId))
+        self.assertTrue(reopened.isChangedOnDisk())
+
+    def testSegmentedNotesBetween(self):
+
+        notes = self.diary.notesBetween("2003-02", "2004")
+        self.assertEqual(notes, d.Diary(self.fname).notesBetween(
+            "2003-02", "2004"))
+        self.assertTrue(notes)
+        self.assertTrue(all("2003-02" <= datum["date"] < "2005"
+                            for datum in notes))
+        # Only the overlapping segments were indexed
+        self.assertIsNone(self.diary.segments["2001"].dateIndex)
+
+    def testSegmentedBatch(self):
+
+        segments = self.readSegments()
+        with self.assertRaises(RuntimeError):
+            with self.diary.batch():
+                self.diary.deleteNote(self.noteIds[0])
+                self.diary.changeNoteDate(self.noteIds[-1], "2001-01-01")
+                raise RuntimeError
+
+        self.assertEqual(self.readSegments(), segments)
+        self.assertTrue(self.diary.hasNote(self.noteIds[0]))
+        self.assertEqual(self.diary.index[self.noteIds[-1]], "2009")
+
+        with self.diary.batch():
+            self.diary.changeNoteDate(self.noteIds[0], "2001-01-01")
+            self.diary.changeNoteDate(self.noteIds[-1], "2000-01-01")
+            # Only a single copy of each note, even before the save
+            self.assertEqual(len(self.diary.data), len(self.noteIds))
+        reopened = segmented_diary.openDiary(self.manifestName)
+        self.assertEqual(reopened.data, self.diary.data)
+        self.assertEqual(reopened.index[self.noteIds[0]], "2001")
+        self.assertEqual(reopened.index[self.noteIds[-1]], "2000")
+        reopened.close()
+
+    def testSegmentedBatchSaveFailures(self):
+
+        noteId = self.noteIds[0]
+        segments = self.readSegments()
+
+        # The new segment fails to save, the old one keeps the note
+        target = self.diary.segments["2001"]
+        with mock.patch.object(target, "writeDiaryTail", return_value=False):
+            with self.diary.batch():
+                self.diary.changeNoteDate(noteId, "2001-01-01")
+                self.diary.deleteNote(self.noteIds[1])
+        self.assertEqual(self.diary.index[noteId], "2000")
+        self.assertEqual(self.diary.getNoteMetadata(noteId)["date"],
+                         d.Diary(self.fname).getNoteMetadata(noteId)["date"])
+        self.assertFalse(self.diary.hasNote(self.noteIds[1]))
+        reopened = segmented_diary.openDiary(self.manifestName)
+        self.assertEqual(reopened.data, self.diary.data)
+        reopened.close()
+
+        # A segment changed externally rolls back all of them
+        segments = self.readSegments()
+        with open(target.fname, "a") as f:
+            f.write("\n")
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            with self.diary.batch():
+                self.diary.changeNoteDate(noteId, "2001-01-01")
+        self.assertEqual(self.diary.index[noteId], "2000")
+        self.assertTrue(self.diary.segments["2000"].hasNote(noteId))
+        segments["2001"] += b"\n"
+        self.assertEqual(self.readSegments(), segments)
+
+
+class DiaryCLITest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tempDir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tempDir, 'diary.md')
+        copyfile(diaryFileName, self.fname)
+
+    def tearDown(self):
+
+        rmtree(self.tempDir)
+
+    def runCLI(self, *args, stdin=""):
+
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout, \
+                mock.patch("sys.stdin", io.StringIO(stdin)), \
+                mock.patch("sys.stderr", new_callable=io.StringIO):
+            status = diary_cli.main([self.fname] + list(args))
+        return status, stdout.getvalue()
+
+    def testListAndSearch(self):
+
+        status, output = self.runCLI("list")
+        self.assertEqual(status, 0)
+        self.assertEqual(output.splitlines(), [
+            "2015-05-05\ta3ea0c44-ed00-11e6-a9cf-c48508000000\tShort note",
+            "2015-05-06\ta3ea0c44-ed00-11e6-a9cf-c4850828558c\t"
+            "Updated Markdown Test",
+            "2015-05-09\ta3ea0c44-ed00-11e6-a9cf-c48508000001\tShort note 2"])
+
+        self.assertEqual(self.runCLI("list", "--from", "2015-05-06")[1],
+                         "".join(output.splitlines(True)[1:]))
+        self.assertEqual(self.runCLI("search", "GRUBER")[1],
+                         output.splitlines(True)[1])
+
+    def testShowAndAdd(self):
+
+        # An ambiguous prefix
+        self.assertEqual(self.runCLI("show", "a3ea0c44-ed00-11e6"), (1, ""))
+        self.assertEqual(
+            self.runCLI("show", "a3ea0c44-ed00-11e6-a9cf-c48508000000"),
+            (0, "# Short note\n\nTest\n\n"))
+
+        status, noteId = self.runCLI("add", "--date", "2016-01-01",
+                                  stdin="# Nový\n\nŽluťoučký kůň")
+        self.assertEqual(status, 0)
+        self.assertEqual(self.runCLI("show", noteId.strip()[:32]),
+                         (0, "# Nový\n\nŽluťoučký kůň"))
+        self.assertEqual(d.Diary(self.fname).getNoteMetadata(
+            noteId.strip())["date"], "2016-01-01")
+        self.assertEqual(self.runCLI("add", "--date", "2016-13-01",
+                                  stdin="Invalid")[0], 1)
+
+    def testExportAndStats(self):
+
+        status, html = self.runCLI("export",
+                                   "a3ea0c44-ed00-11e6-a9cf-c48508000000")
+        self.assertEqual(status, 0)
+        self.assertIn('<link rel="stylesheet" href="css/github-markdown.css">',
+                      html)
+        self.assertIn("<h1>Short note</h1>", html)
+
+        status, stats = self.runCLI("stats")
+        self.assertIn("Notes:\t3\n", stats)
+        self.assertIn("First:\t2015-05-05\n", stats)
+
+    def testNoQtImports(self):
+
+        script = ("import sys; before = set(sys.modules); import diary_cli; "
+                  "diary_cli.main(sys.argv[1:]); "
+                  "assert not [m for m in set(sys.modules) - before "
+                  "if 'Qt' in m]")
+        for command in (["list"], ["export", "a3ea0c44"], ["stats"]):
+            subprocess.run([sys.executable, "-c", script, self.fname] +
+                           command, check=True, stdout=subprocess.DEVNULL)
+
+
+class RenderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        rmtree(self.tempDir)
+
+    def testKeys(self):
+
+        key = RenderCache.key("# Note", "config")
+        self.assertEqual(key, RenderCache.key("# Note", "config"))
+        self.assertNotEqual(key, RenderCache.key("# Note", "other config"))
+        self.assertNotEqual(key, RenderCache.key("# Note\n", "config"))
+
+    def testLRUEviction(self):
+
+        cache = RenderCache(maxSize=10)
+        cache.put("a", "aaaa")
+        cache.put("b", "bbbb")
+        self.assertEqual(cache.get("a"), "aaaa")
+        # Evicts "b", the least recently used page
+        cache.put("c", "cccc")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "aaaa")
+        self.assertEqual(cache.get("c"), "cccc")
+        self.assertEqual(cache.size, 8)
+
+        # A page bigger than the whole cache is kept until the next one
+        cache.put("d", "d" * 20)
+        self.assertEqual(list(cache.pages), ["d"])
+
+    def testDiskTier(self):
+
+        cache = RenderCache(directory=self.tempDir, maxDiskSize=120)
+        cache.put("a", "<p>Žluťoučký kůň</p>\r\n")
+        cache.put("b", "b" * 50)
+
+        # Survives restarts
+        cache = RenderCache(directory=self.tempDir, maxDiskSize=120)
+        self.assertEqual(cache.diskSize, 78)
+        self.assertEqual(cache.get("a"), "<p>Žluťoučký kůň</p>\r\n")
+
+        # "b" is the least recently used file
+        os.utime(cache.fileName("b"), ns=(0, 0))
+        cache.put("c", "c" * 50)
+        self.assertFalse(os.path.exists(cache.fileName("b")))
+        self.assertTrue(os.path.exists(cache.fileName("a")))
+        self.assertEqual(cache.diskSize, 78)
+
+
+class HighlightRendererTest(unittest.TestCase):
+
+    def setUp(self):
+
+        markdown_math.HighlightRenderer.highlightCache.clear()
+        self.toMarkdown = markdown_math.MarkdownWithMath(
+            renderer=markdown_math.HighlightRenderer())
+
+    def testMemoizedHighlighting(self):
+
+        note = ("```python\nprint(1)\n```\n\n"
+                "```python\nprint(2)\n```\n\n"
+                "```nosuchlanguage\n<b>\n```\n")
+        highlight = mock.Mock(wraps=markdown_math.pygments.highlight)
+        with mock.patch("markdown_math.pygments.highlight", highlight):
+            html = self.toMarkdown(note)
+            self.assertEqual(highlight.call_count, 2)
+            self.assertEqual(self.toMarkdown(note), html)
+            self.assertEqual(highlight.call_count, 2)
+
+        self.assertIn('<span class="nb">print</span>', html)
+        self.assertIn("<pre><code>&lt;b&gt;</code></pre>", html)
+
+        # The same code in another language is highlighted separately
+        with mock.patch("markdown_math.pygments.highlight", highlight):
+            self.toMarkdown("```py3\nprint(1)\n```\n")
+        self.assertEqual(highlight.call_count, 3)
+
+    def testSharedLexers(self):
+
+        lexer = markdown_math.HighlightRenderer.getLexer("python")
+        self.assertIs(markdown_math.HighlightRenderer.getLexer("python"),
+                      lexer)
+        self.assertIsNone(
+            markdown_math.HighlightRenderer.getLexer("nosuchlanguage"))
+
+
+class IncrementalRenderingTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.toMarkdown = markdown_math.MarkdownWithMath(
+            renderer=markdown_math.HighlightRenderer())
+        self.blocks = [
+            "# Title\n\n",
+            "Some *text* with $x^2$ math.\n\n",
+            "```python\nx = 1\n\ny = 2\n```\n\n",
+            "$$\na\n\nb\n$$\n\n",
+            "\\begin{align}\nx\n\n\\end{align}\n\n",
+            "- item\n\n  continued\n- item\n\n",
+            "> quote\n\n> more\n\n",
+            "Last paragraph.\n"]
+
+    def fullRender(self, text):
+
+        toMarkdown = markdown_math.MarkdownWithMath(
+            renderer=markdown_math.HighlightRenderer())
+        return markdown_math.mistune.Markdown.parse(toMarkdown, text)
+
+    def assertRendersIdentically(self, text):
+
+        self.assertEqual(self.toMarkdown(text), self.fullRender(text))
+
+    def testEdits(self):
+
+        self.assertRendersIdentically("".join(self.blocks))
+        for index in range(len(self.blocks)):
+            edited = list(self.blocks)
+            edited[index] = "Edited.\n\n"
+            self.assertRendersIdentically("".join(edited))
+            del edited[index]
+            self.assertRendersIdentically("".join(edited))
+
+        # Opening a fence changes how the rest of the note is lexed
+        self.assertRendersIdentically("```\n\n" + "".join(self.blocks))
+        self.assertRendersIdentically("".join(self.blocks))
+
+        # Reference links apply to the whole note
+        self.assertRendersIdentically(
+            "[link][ref]\n\n" + "".join(self.blocks) + "[ref]: /url\n")
+        self.assertRendersIdentically("".join(self.blocks))
+
+    def testOnlyChangedBlocksAreRendered(self):
+
+        text = "".join(self.blocks)
+        self.toMarkdown(text)
+        edited = text.replace("Some *text*", "Some *edited text*")
+        with mock.patch.object(self.toMarkdown, "renderTokens",
+                               wraps=self.toMarkdown.renderTokens) as render:
+            self.toMarkdown(edited)
+            self.assertEqual(render.call_count, 1)
+            # Reverting the edit renders nothing
+            self.toMarkdown(text)
+            self.assertEqual(render.call_count, 1)
+
+            self.toMarkdown.clearCache()
+            self.toMarkdown(text)
+            # The blank lines after the math blocks are blocks too
+            self.assertEqual(render.call_count, 1 + 9)
+
+
+class PreviewShellTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.toMarkdown = markdown_math.MarkdownWithMath(
+            renderer=markdown_math.HighlightRenderer())
+
+    def testSplitHTML(self):
+
+        for note, math in (("# Plain", False), ("# Math $x^2$", True)):
+            html = markdown_math.createHTML(note, self.toMarkdown, "/mathjax")
+            body, hasMath = markdown_math.splitHTML(html, "/mathjax")
+            self.assertEqual(body, self.toMarkdown(note))
+            self.assertEqual(hasMath, math)
+
+    def testShell(self):
+
+        shell = markdown_math.createShell()
+        self.assertIn("function showNote(", shell)
+        self.assertIn('<body class="markdown-body"></body>', shell)
+
+        script = markdown_math.showNoteScript('<p>"</p>', True, "/mathjax")
+        self.assertEqual(script, 'showNote("<p>\\"</p>", true, '
+                         '"/mathjax?config=TeX-AMS-MML_HTMLorMML");')
+
 
 class DiaryAppTest(unittest.TestCase):
 
@@ -234,6 +1450,8 @@ class DiaryAppTest(unittest.TestCase):
 
         # Delete the temporary diary
         os.remove(tempDiaryFileName)
+        if os.path.exists(tempIndexFileName):
+            os.remove(tempIndexFileName)
 
     def testLoadTree(self):
 
@@ -279,9 +1497,10 @@ class DiaryAppTest(unittest.TestCase):
         with open(HTMLNoteFileName) as f:
             refNoteHtml = f.read().rstrip()
 
+        # The note is swapped into the page shell once the shell is loaded
+        self.diary_app.webNoteDisplayed = self._noteDisplayed
         self.diary_app.displayHTMLRenderedMarkdown(note)
 
-        self.diary_app.web.loadFinished.connect(self._loadFinished)
         self.noteHtml = None
         app.exec_()
 
@@ -297,9 +1516,12 @@ class DiaryAppTest(unittest.TestCase):
         # Remove the added extra newline
         self.noteHtml = newNoteHtml[:-1]
 
-        self.assertMultiLineEqual(self.noteHtml, refNoteHtml)
+        # The shell's head differs, it also has the MathJax configuration
+        self.assertMultiLineEqual(
+            self.noteHtml[self.noteHtml.index("<body"):],
+            refNoteHtml[refNoteHtml.index("<body"):])
 
-    def _loadFinished(self, result):
+    def _noteDisplayed(self, result):
 
         self.diary_app.web.page().toHtml(self._saveHtml)
 
@@ -308,6 +1530,131 @@ class DiaryAppTest(unittest.TestCase):
         self.noteHtml = html
         app.quit()
 
+    def testSwitchingNotesDoesntRender(self):
+
+        firstId = 'a3ea0c44-ed00-11e6-a9cf-c48508000000'
+        lastId = 'a3ea0c44-ed00-11e6-a9cf-c48508000001'
+
+        self.diary_app.renderCache.clear()
+        with mock.patch.object(markdown_diary.markdown_math, "createHTML",
+                               wraps=markdown_diary.markdown_math.createHTML
+                               ) as createHTML:
+            for noteId in (firstId, lastId, firstId, lastId):
+                self.diary_app.displayNote(noteId)
+                waitForRendering(self.diary_app.renderWorker)
+            self.assertEqual(createHTML.call_count, 2)
+
+            # Changed notes do get rendered
+            self.diary_app.displayHTMLRenderedMarkdown("# Changed")
+            waitForRendering(self.diary_app.renderWorker)
+            self.assertEqual(createHTML.call_count, 3)
+
+    def testRenderingInBackground(self):
+
+        worker = self.diary_app.renderWorker
+        waitForRendering(worker)
+        started = threading.Event()
+        release = threading.Event()
+        rendered = []
+
+        def render(markdownText):
+            started.set()
+            release.wait(10)
+            rendered.append(markdownText)
+            return "<p>" + markdownText + "</p>"
+
+        displayed = mock.Mock()
+        worker.rendered.connect(displayed)
+        with mock.patch.object(worker, "render", render):
+            worker.requestRender("first")
+            started.wait(10)
+            worker.requestRender("second")
+            worker.requestRender("third")
+            release.set()
+            waitForRendering(worker)
+            app.processEvents()
+
+        # "second" was superseded before being rendered, "first" while being
+        # rendered
+        self.assertEqual(rendered, ["first", "third"])
+        displayed.assert_called_once_with("<p>third</p>")
+
+    def testNotesAreSwappedIntoShell(self):
+
+        diaryApp = self.diary_app
+        waitForRendering(diaryApp.renderWorker)
+        diaryApp.shellUrl = None
+        html = diaryApp.createHTML("# First")
+        with mock.patch.object(diaryApp.web, "setHtml") as setHtml, \
+                mock.patch.object(diaryApp.page, "runJavaScript") as run:
+            diaryApp.displayHTML(html)
+            setHtml.assert_called_once_with(
+                markdown_math.createShell(), baseUrl=diaryApp.shellUrl)
+            # Waits for the shell to load
+            self.assertFalse(run.called)
+            diaryApp.displayHTML(diaryApp.createHTML("# Second"))
+            diaryApp.webLoadFinished(True)
+            self.assertEqual(run.call_count, 1)
+            self.assertIn("Second", run.call_args[0][0])
+
+            diaryApp.displayHTML(html)
+            self.assertEqual(setHtml.call_count, 1)
+            self.assertEqual(run.call_count, 2)
+            self.assertIn("First", run.call_args[0][0])
+
+    def testExportToPDFWaitsForNote(self):
+
+        diaryApp = self.diary_app
+        waitForRendering(diaryApp.renderWorker)
+        diaryApp.shellUrl = None
+        diaryApp.stack.setCurrentIndex(0)
+        diaryApp.text.setText("# Exported")
+        with mock.patch.object(QtWidgets.QFileDialog, "getSaveFileName",
+                               return_value=("note.pdf", "")), \
+                mock.patch.object(diaryApp.web, "setHtml"), \
+                mock.patch.object(diaryApp.page, "printToPdf") as printToPdf, \
+                mock.patch.object(diaryApp.page, "runJavaScript") as run:
+            diaryApp.exportToPDF()
+            # Waits for the shell to load and then for the note to be shown
+            diaryApp.webLoadFinished(True)
+            self.assertIn("Exported", run.call_args[0][0])
+            self.assertFalse(printToPdf.called)
+
+            run.call_args[0][1](None)
+            self.assertEqual(printToPdf.call_args[0][0], "note.pdf")
+
+            # Printed right away when the note is already displayed
+            diaryApp.stack.setCurrentIndex(1)
+            diaryApp.exportToPDF()
+            self.assertEqual(printToPdf.call_count, 2)
+
+    def testReloadingExternalChanges(self):
+
+        app = self.diary_app
+        noteId = app.noteId
+        with open(tempDiaryFileName, encoding='UTF-8') as f:
+            rawData = f.read()
+        rawData = rawData.replace(app.diary.getNote(noteId),
+                                  "# Externally changed\n")
+        rawData += "\n" + app.diary.createNoteHeader("123", "2016-01-01")
+        rawData += "# New"
+        with open(tempDiaryFileName, 'w', encoding='UTF-8') as f:
+            f.write(rawData)
+
+        changed = mock.Mock()
+        app.diaryWatcher.diaryChanged.connect(changed)
+        app.diaryWatcher.reload()
+
+        changed.assert_called_once_with()
+        self.assertEqual(app.tree.topLevelItemCount(), 4)
+        self.assertEqual(app.tree.currentItem().text(0), noteId)
+        self.assertTrue(
+            app.text.toPlainText().startswith("# Externally changed\n"))
+
+        # Nothing changed since
+        app.diaryWatcher.reload()
+        changed.assert_called_once_with()
+
     def testOpenDiary(self):
 
         pass
@@ -384,6 +1731,7 @@ class DiaryAppTest(unittest.TestCase):
         self.assertEqual(self.diary_app.noteId, noteToRemember)
 
         os.remove(secondTempFile)
+        os.remove("tests/.diary_temp2.md.index")
 
     def testClearRecentDiaries(self):
 